@@ -3,50 +3,273 @@ import csv
 import numpy as np
 import os
 from typing import List
-import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
 import argparse
-from matplotlib import patches
-from phase_utilities import *
-from ETS_Dataframe import HEADER_ETS, ETS_Dataframe
+import sys
+import copy
+from collections import namedtuple
+from ETS_Dataframe import HEADER_ETS, ETS_Dataframe, CHANNEL_DATA, parse_frame_slice, format_frame_slice, \
+    parse_channels
+from capture_archive import ARCHIVE_EXT
+from results_store import ResultsStore
+from capture_prefetch import CapturePrefetcher
+from bootstrap_ci import bootstrap_snr
+from detrend import parse_detrend
+from percentile_noise import parse_noise, noise_label
+from snr_map import idw_interpolate, snr_db, min_over_panel
+from phase_sweep import phase_sweep, optimal_angle_map, panel_min_curve, best_panel_angle
+from frame_series import FRAME_SERIES_EXT, node_series, frame_noise, write_frame_series
+from common_mode import estimate_common_mode, common_mode_metrics
+from memory_budget import MemoryBudget, parse_memory_size
+from batch_shards import parse_shard, read_manifest, select_shard, write_partial, load_partials
+from result_cache import ResultCache
+from metric_plan import MetricPlan, VENDOR_REPORTS, FINAL_RESULT_COLUMNS, compute_metrics, report_summary
 
 file_dir = os.path.dirname(__file__)  # the directory that class "option" resides in
-pd.set_option('display.max_columns', None)
+
+# picklable reference to the shared captures of an analysis, see AnalyseData.share
+AnalysisHandle = namedtuple("AnalysisHandle", ["pattern", "output_folder", "notouch", "touches"])
 
 
 class AnalyseData:
     def __init__(self,
                  no_touch_file_path: str = None,
                  touch_file_paths=None,
-                 Header_index=None):
+                 Header_index=None,
+                 frames=None,
+                 channels=None,
+                 prefetcher=None,
+                 detrend=None,
+                 outliers=None,
+                 memory_budget=None,
+                 noise=None):
+        """
+        :param frames: optional frame window (slice) loaded from every capture
+        :param channels: optional list of channels to load
+        :param prefetcher: optional CapturePrefetcher providing the raw file bytes
+        :param detrend: optional (method, param) drift removal applied to every capture after loading
+        :param outliers: optional (z_threshold, frame_fraction) outlier rejection applied to every capture
+        :param memory_budget: optional MemoryBudget, only per node statistics are kept in memory then
+        :param noise: optional (lo, hi) percentiles, the percentile spread replaces max - min as p2p noise term
+        without no_touch_file_path nothing is loaded, see from_frames for captures already in memory
+        """
         if touch_file_paths is None:
             touch_file_paths = []
-        self.pattern = os.path.basename(os.path.dirname(no_touch_file_path))
+        self.pattern = None
+        self._output_folder = None
         self.standard_width_picture = [12.99, 8.49]
         self.Rows = None
         self.Columns = None
 
         self.NoTouchFrame: ETS_Dataframe = None
         self.TouchFrameSets: List[ETS_Dataframe] = []
-        self.init_data_FrameSets(no_touch_file_path, touch_file_paths, Header_index)
+        self.frames = frames
+        self.channels = channels
+        self.prefetcher = prefetcher
+        self.detrend_spec = detrend
+        self.outlier_spec = outliers
+        self.memory_budget = memory_budget
+        self.noise = noise
+        if no_touch_file_path is not None:
+            self.pattern = os.path.basename(os.path.dirname(no_touch_file_path))
+            self._output_folder = os.path.join(os.path.dirname(no_touch_file_path), "output")
+            self.init_data_FrameSets(no_touch_file_path, touch_file_paths, Header_index)
+
+    @classmethod
+    def from_frames(cls, NoTouchFrame, TouchFrames, pattern="in_memory", output_folder=None, detrend=None,
+                    outliers=None, memory_budget=None, noise=None):
+        """
+        analysis of captures which are already in memory, i.e. ETS_Dataframe.from_arrays, nothing touches the disk
+        until a report writer or plot is called with output_folder set
+        :param NoTouchFrame: no touch ETS_Dataframe
+        :param TouchFrames: list of touch ETS_Dataframe
+        """
+        analysis = cls(detrend=detrend, outliers=outliers, memory_budget=memory_budget, noise=noise)
+        analysis.pattern = pattern
+        analysis._output_folder = output_folder
+        analysis.NoTouchFrame = analysis.prepare_frame("No Touch", NoTouchFrame)
+        analysis.Rows = NoTouchFrame.row_num
+        analysis.Columns = NoTouchFrame.col_num
+        for idx, TouchFrame in enumerate(TouchFrames):
+            analysis.TouchFrameSets.append(analysis.prepare_frame(f"Touch {idx + 1}", TouchFrame))
+        return analysis
+
+    def share(self, store):
+        """
+        move every capture into shared buffers of store
+        :param store: SharedFrameStore
+        :return: AnalysisHandle for AnalyseData.attach in worker processes
+        """
+        return AnalysisHandle(self.pattern, self._output_folder, self.NoTouchFrame.share(store),
+                              [TouchFrame.share(store) for TouchFrame in self.TouchFrameSets])
 
-        self.output_folder = os.path.join(os.path.dirname(no_touch_file_path), "output")
-        if not os.path.exists(self.output_folder):
-            os.makedirs(self.output_folder)
+    @classmethod
+    def attach(cls, handle):
+        """
+        analysis on the shared captures of an AnalysisHandle, no frame is copied
+        """
+        return cls.from_frames(ETS_Dataframe.attach(handle.notouch),
+                               [ETS_Dataframe.attach(touch) for touch in handle.touches],
+                               pattern=handle.pattern, output_folder=handle.output_folder)
+
+    def detach(self):
+        for _, Frame in self.all_frames:
+            Frame.detach()
+
+    @property
+    def output_folder(self):
+        """
+        report folder, only created when the first report is written
+        """
+        if self._output_folder is None:
+            raise ValueError(f"analysis {self.pattern} has no output folder, set output_folder to write reports")
+        if not os.path.exists(self._output_folder):
+            os.makedirs(self._output_folder)
+        return self._output_folder
+
+    @output_folder.setter
+    def output_folder(self, folder):
+        self._output_folder = folder
+
+    def load_frame(self, file_path, Header_index):
+        raw_bytes = self.prefetcher.take(file_path) if self.prefetcher is not None else None
+        # under a memory budget captures are streamed into spill files, preprocessing recomputes the statistics
+        Frame = ETS_Dataframe(file_path=file_path, Header_index=Header_index,
+                              frames=self.frames, channels=self.channels, raw_bytes=raw_bytes,
+                              memory_budget=self.memory_budget)
+        return self.prepare_frame(os.path.basename(file_path), Frame)
+
+    def prepare_frame(self, name, Frame):
+        """
+        per capture preprocessing right after loading, so that under a memory budget
+        only one capture is held as raw frames at a time
+        """
+        if Frame.frame_num == 0:
+            raise ValueError(f"frame window {format_frame_slice(self.frames)} selects no frames of {name} in "
+                             f"{self.pattern}")
+        if self.detrend_spec is not None:
+            Frame.detrend(*self.detrend_spec)
+        if self.outlier_spec is not None:
+            rejected = Frame.detect_outliers(*self.outlier_spec)
+            if len(rejected) > 0:
+                print(f"{self.pattern} {name}: reject {len(rejected)} outlier frames")
+        if self.memory_budget is not None:
+            Frame.compact(self.memory_budget)
+            self.memory_budget.check(f"after loading {name} of {self.pattern}")
+        return Frame
+
+    def check_memory(self, what):
+        """
+        enforce the memory budget (if any) at a memory peak of the analysis
+        """
+        if self.memory_budget is not None:
+            self.memory_budget.check(f"{what} of {self.pattern}")
+
+    def release_spill(self):
+        """
+        drop the memory mapped raw frames of all captures and remove their spill files
+        """
+        paths = []
+        for _, Frame in self.all_frames:
+            paths.extend(Frame.spill_paths)
+            for channel in ["mct", "sct_row", "sct_col"]:
+                if Frame.channel_data(channel) is not None:
+                    setattr(Frame, CHANNEL_DATA[channel], None)
+            Frame.masks = {}
+        if self.memory_budget is not None:
+            self.memory_budget.release(paths)
 
     def init_data_FrameSets(self,
                             no_touch_file_path=None,
                             touch_file_paths=[],
                             Header_index=None):
-        self.NoTouchFrame = ETS_Dataframe(file_path=no_touch_file_path, Header_index=Header_index)
+        self.NoTouchFrame = self.load_frame(no_touch_file_path, Header_index)
         self.Rows = self.NoTouchFrame.row_num
         self.Columns = self.NoTouchFrame.col_num
         for touch_file_path in touch_file_paths:
-            TouchFrame = ETS_Dataframe(file_path=touch_file_path, Header_index=Header_index)
+            TouchFrame = self.load_frame(touch_file_path, Header_index)
             self.TouchFrameSets.append(TouchFrame)
             print(f"successfull load file {touch_file_path}")
 
+    @property
+    def all_frames(self):
+        """
+        every loaded capture with its report name
+        :return: list [("No Touch", ETS_Dataframe), ("Touch 1", ETS_Dataframe), ...]
+        """
+        ret = [("No Touch", self.NoTouchFrame)]
+        for idx, TouchFrame in enumerate(self.TouchFrameSets):
+            ret.append((f"Touch {idx + 1}", TouchFrame))
+        return ret
+
+    def detrend(self, method="poly", param=1):
+        """
+        remove baseline drift from every capture, see ETS_Dataframe.detrend
+        """
+        for _, Frame in self.all_frames:
+            Frame.detrend(method, param)
+
+    def write_out_drift_csv(self):
+        """
+        drift magnitude which was removed from every capture, reported separately from the noise
+        """
+        output_path = os.path.join(self.output_folder, self.pattern + "_drift.csv")
+        with open(output_path, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["capture", "channel", "drift max", "drift mean", "node of drift max"])
+            for name, Frame in self.all_frames:
+                for channel, drift in Frame.drift.items():
+                    node = tuple(int(idx) for idx in np.unravel_index(drift.argmax(), drift.shape))
+                    writer.writerow([name, channel, "{:.2f}".format(drift.max()), "{:.2f}".format(drift.mean()),
+                                     node if len(node) > 1 else node[0]])
+        print("Successfully generate {}!!!!!".format(output_path))
+
+    def reject_outliers(self, z_threshold=6.0, frame_fraction=0.05):
+        """
+        detect glitch frames and spike nodes in every capture, statistics use the masked data afterwards
+        :return: dict capture name -> rejected frame indices
+        """
+        ret = {}
+        for name, Frame in self.all_frames:
+            ret[name] = Frame.detect_outliers(z_threshold=z_threshold, frame_fraction=frame_fraction)
+            if len(ret[name]) > 0:
+                print(f"{self.pattern} {name}: reject {len(ret[name])} outlier frames")
+        return ret
+
+    def write_out_outlier_csv(self):
+        """
+        list rejected frames of every capture and compare raw and masked p2p noise
+        """
+        output_path = os.path.join(self.output_folder, self.pattern + "_rejected_frames.csv")
+        with open(output_path, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["capture", "channel", "rejected frames", "raw p2p max", "masked p2p max",
+                             "raw rms max", "masked rms max"])
+            for name, Frame in self.all_frames:
+                for channel in Frame.masks:
+                    raw = Frame.channel_stats(channel, masked=False)
+                    masked = Frame.channel_stats(channel, masked=True)
+                    writer.writerow([name, channel, len(Frame.rejected_frames),
+                                     raw["p2p"].max(), masked["p2p"].max(),
+                                     "{:.2f}".format(raw["rms"].max()), "{:.2f}".format(masked["rms"].max())])
+
+            writer.writerow("\n")
+            writer.writerow(["capture", "frame", "outlier node fraction"])
+            for name, Frame in self.all_frames:
+                for frame_idx in Frame.rejected_frames:
+                    writer.writerow([name, int(frame_idx), "{:.4f}".format(Frame.frame_score[frame_idx])])
+        print("Successfully generate {}!!!!!".format(output_path))
+
+    @property
+    def frames_used(self):
+        """
+        number of frames actually loaded from every capture
+        :return: dict {"No Touch": n, "Touch 1": n, ...}
+        """
+        ret = {"No Touch": self.NoTouchFrame.frame_num}
+        for idx, TouchFrame in enumerate(self.TouchFrameSets):
+            ret[f"Touch {idx + 1}"] = TouchFrame.frame_num
+        return ret
+
     # ********************************************************
     # ***********MCT Field ***********************************
     # ********************************************************
@@ -565,99 +788,26 @@ class AnalyseData:
         ret_col = [20 * np.log10(val) for val in self.all_sct_SmeanNrmsR[1]]
         return [ret_row, ret_col]
 
-    def BOE_snr_summary(self):
-        ret = {"Vendor": "BOE"}
-        if self.NoTouchFrame.mct_grid is not None:
-            min_SmaxNppfullscreenR_dB = min(self.all_SmaxNppfullscreenR_dB)
-            min_SmaxNppfullscreenR_dB_index = self.all_SmaxNppfullscreenR_dB.index(min(self.all_SmaxNppfullscreenR_dB))
-            min_SmeanNrmsR_dB = min(self.all_SmeanNrmsR_dB)
-            min_SmeanNrmsR_dB_index = self.all_SmeanNrmsR_dB.index(min(self.all_SmeanNrmsR_dB))
-            mct_ret = {
-                "snr_summary": {
-                    "touched node": self.all_touched_position,
-                    "noise_p2p_fullscreen": [self.mct_noise_p2p_max] * len(self.TouchFrameSets),
-                    "noise_p2p_notouch": self.all_mct_noise_p2p_notouch_node,
-                    "noise_rms_touch": self.all_mct_noise_rms_touch,
-                    "signal_max": self.all_mct_signal_max,
-                    "signal_mean": self.all_mct_signal_mean,
-                    "SmaxNppmotouchR": self.all_SmaxNppnotouchR,
-                    "SmaxNppnotouchR_dB": self.all_SmaxNppnotouchR_dB,
-                    "SmaxNppfullscreenR": self.all_SmaxNppfullscreenR,
-                    "SmaxNppfullscreenR_dB": self.all_SmaxNppfullscreenR_dB,
-                    "SmaxNrmsR": self.all_SmeanNrmsR,
-                    "SmeanNrmsR_dB": self.all_SmeanNrmsR_dB
-                },
-                "final_results": {
-                    "min_SmaxNppfullscreenR_dB": "{:.2f}".format(min_SmaxNppfullscreenR_dB),
-                    "Position_P2P": f"Touch {min_SmaxNppfullscreenR_dB_index + 1}",
-                    "min_SmeanNrmsR_dB": "{:.2f}".format(min_SmeanNrmsR_dB),
-                    "Position_RMS": f"Touch {min_SmeanNrmsR_dB_index + 1}"
-                }
-            }
-            ret["mct_summary"] = mct_ret
-
-        if self.NoTouchFrame.sct_row is not None:
-            min_sct_row_SmaxNppfullscreenR_dB = min(self.all_sct_SmaxNppfullscreenR_dB[0])
-            min_sct_row_SmaxNppfullscreenR_dB_index = self.all_sct_SmaxNppfullscreenR_dB[0].index(
-                min(self.all_sct_SmaxNppfullscreenR_dB[0]))
-            min_sct_row_SmeanNrmsR_dB = min(self.all_sct_SmeanNrmsR_dB[0])
-            min_sct_row_SmeanNrmsR_dB_index = self.all_sct_SmeanNrmsR_dB[0].index(min(self.all_sct_SmeanNrmsR_dB[0]))
-
-            sct_row_ret = {
-                "snr_sct_row_summary": {
-                    "touched node": self.all_sct_touched_position[0],
-                    "noise_p2p_fullscreen": [self.sct_row_p2p_max] * len(self.TouchFrameSets),
-                    "noise_p2p_notouch": self.all_sct_noise_p2p_notouch_node[0],
-                    "noise_rms_touch": self.all_sct_noise_rms_touch[0],
-                    "signal_max": self.all_sct_signal_max[0],
-                    "signal_mean": self.all_sct_signal_mean[0],
-                    "SmaxNppmotouchR": self.all_sct_SmaxNppnotouchR[0],
-                    "SmaxNppnotouchR_dB": self.all_sct_SmaxNppnotouchR_dB[0],
-                    "SmaxNppfullscreenR": self.all_sct_SmaxNppfullscreenR[0],
-                    "SmaxNppfullscreenR_dB": self.all_sct_SmaxNppfullscreenR_dB[0],
-                    "SmaxNrmsR": self.all_sct_SmeanNrmsR[0],
-                    "SmeanNrmsR_dB": self.all_sct_SmeanNrmsR_dB[0]
-                },
-                "final_results": {
-                    "min_sct_row_SmaxNppfullscreenR_dB": "{:.2f}".format(min_sct_row_SmaxNppfullscreenR_dB),
-                    "Position_P2P": f"Touch {min_sct_row_SmaxNppfullscreenR_dB_index + 1}",
-                    "min_sct_row_SmeanNrmsR_dB": "{:.2f}".format(min_sct_row_SmeanNrmsR_dB),
-                    "Position_RMS": f"Touch {min_sct_row_SmeanNrmsR_dB_index + 1}"
-                }
-            }
-            ret["sct_row_summary"] = sct_row_ret
-
-        if self.NoTouchFrame.sct_col is not None:
-            min_sct_col_SmaxNppfullscreenR_dB = min(self.all_sct_SmaxNppfullscreenR_dB[1])
-            min_sct_col_SmaxNppfullscreenR_dB_index = self.all_sct_SmaxNppfullscreenR_dB[1].index(
-                min(self.all_sct_SmaxNppfullscreenR_dB[1]))
-            min_sct_col_SmeanNrmsR_dB = min(self.all_sct_SmeanNrmsR_dB[1])
-            min_sct_col_SmeanNrmsR_dB_index = self.all_sct_SmeanNrmsR_dB[1].index(min(self.all_sct_SmeanNrmsR_dB[1]))
-            sct_col_ret = {
-                "snr_sct_col_summary": {
-                    "touched node": self.all_sct_touched_position[1],
-                    "noise_p2p_fullscreen": [self.sct_col_p2p_max] * len(self.TouchFrameSets),
-                    "noise_p2p_notouch": self.all_sct_noise_p2p_notouch_node[1],
-                    "noise_rms_touch": self.all_sct_noise_rms_touch[1],
-                    "signal_max": self.all_sct_signal_max[1],
-                    "signal_mean": self.all_sct_signal_mean[1],
-                    "SmaxNppmotouchR": self.all_sct_SmaxNppnotouchR[1],
-                    "SmaxNppnotouchR_dB": self.all_sct_SmaxNppnotouchR_dB[1],
-                    "SmaxNppfullscreenR": self.all_sct_SmaxNppfullscreenR[1],
-                    "SmaxNppfullscreenR_dB": self.all_sct_SmaxNppfullscreenR_dB[1],
-                    "SmaxNrmsR": self.all_sct_SmeanNrmsR[1],
-                    "SmeanNrmsR_dB": self.all_sct_SmeanNrmsR_dB[1]
-                },
-                "final_results": {
-                    "min_sct_col_SmaxNppfullscreenR_dB": "{:.2f}".format(min_sct_col_SmaxNppfullscreenR_dB),
-                    "Position_P2P": f"Touch {min_sct_col_SmaxNppfullscreenR_dB_index + 1}",
-                    "min_sct_col_SmeanNrmsR_dB": "{:.2f}".format(min_sct_col_SmeanNrmsR_dB),
-                    "Position_RMS": f"Touch {min_sct_col_SmeanNrmsR_dB_index + 1}"
-                }
-            }
-            ret["sct_col_summary"] = sct_col_ret
+    def snr_results(self, vendors):
+        """
+        Compute the results of all selected vendors from one deduplicated metric plan,
+        shared pieces like touch positions and no touch p2p are only computed once.
+        :param vendors: list of report vendors, i.e. ["BOE", "Huawei_quick"]
+        :return: dict vendor -> VendorResult with numeric values
+        """
+        return {vendor: result._replace(frames_used=self.frames_used)
+                for vendor, result in MetricPlan(vendors, self.noise).results(self).items()}
 
-        return ret
+    def snr_summaries(self, vendors):
+        """
+        vendor summaries in the report layout of write_out_csv, rendered from snr_results
+        :param vendors: list of report vendors, i.e. ["BOE", "Huawei_quick"]
+        :return: dict vendor -> summary
+        """
+        return {vendor: report_summary(result) for vendor, result in self.snr_results(vendors).items()}
+
+    def BOE_snr_summary(self):
+        return self.snr_summaries(["BOE"])["BOE"]
 
     def HW_quick_snr_summary(self):
         '''
@@ -665,25 +815,7 @@ class AnalyseData:
         only peak-peak snr is calculated!!
         :return:
         '''
-        ret = {"Vendor": "Huawei_quick"}
-
-        min_SminNpptouch_dB = min(self.all_SminNpptouchR_dB)
-        min_SminNpptouch_dB_index = self.all_SminNpptouchR_dB.index(min(self.all_SminNpptouchR_dB))
-        mct_ret = {
-            "snr_summary": {
-                "touched node": self.all_touched_position,
-                "noise_p2p_touch": self.all_mct_noise_p2p_touch_node,
-                "signal_min": self.all_mct_signal_min,
-                "SminNpptouchR": self.all_SminNpptouchR,
-                "SminNpptouchR_dB": self.all_SminNpptouchR_dB,
-            },
-            "final_results": {
-                "min_SminNpptouch_dB": "{:.2f}".format(min_SminNpptouch_dB),
-                "min_SminNpptouch_dB_index": f"Touch {min_SminNpptouch_dB_index + 1}",
-            }
-        }
-        ret["mct_summary"] = mct_ret
-        return ret
+        return self.snr_summaries(["Huawei_quick"])["Huawei_quick"]
 
     def HW_thp_afe_snr_summary(self):
         '''
@@ -691,96 +823,300 @@ class AnalyseData:
         only peak-peak snr is calculated!!
         :return:
         '''
-        ret = {"Vendor": "Huawei_quick"}
-
-        min_SminNppnotouch_dB = min(self.all_SminNppnotouchR_dB)
-        min_SminNppnotouch_dB_index = self.all_SminNppnotouchR_dB.index(min(self.all_SminNppnotouchR_dB))
-        min_SmeanNppnotouch_dB = min(self.all_SmeanNppnotouchR_dB)
-        min_SmeanNppnotouch_dB_index = self.all_SmeanNppnotouchR_dB.index(min(self.all_SmeanNppnotouchR_dB))
-        mct_ret = {
-            "snr_summary": {
-                "touched node": self.all_touched_position,
-                "noise_p2p_notouch": self.all_mct_noise_p2p_notouch_node,
-                "signal_min": self.all_mct_signal_min,
-                "signal_mean": self.all_mct_signal_mean,
-                "SminNppnotouchR": self.all_SminNppnotouchR,
-                "SminNppnotouchR_dB": self.all_SminNppnotouchR_dB,
-                "SmeanNppnotouchR": self.all_SmeanNppnotouchR,
-                "SmeanNppnotouchR_dB": self.all_SmeanNppnotouchR_dB,
-            },
-            "final_results": {
-                "min_SminNppnotouch_dB": "{:.2f}".format(min_SminNppnotouch_dB),
-                "min_SminNppnotouch_dB_index": f"Touch {min_SminNppnotouch_dB_index + 1}",
-                "min_SmeanNppnotouch_dB": "{:.2f}".format(min_SmeanNppnotouch_dB),
-                "min_SmeanNppnotouch_dB_index": f"Touch {min_SmeanNppnotouch_dB_index + 1}",
-            }
-        }
-        ret["mct_summary"] = mct_ret
-        return ret
+        return self.snr_summaries(["Huawei_thp_afe"])["Huawei_thp_afe"]
 
     def write_out_csv(self, result_dict):
-
-        row = ["Touch {}".format(idx + 1) for idx in range(len(self.TouchFrameSets))]
         output_path = os.path.join(self.output_folder, result_dict["Vendor"] + "_" + self.pattern + "_output_info.csv")
+        write_summary_csv(output_path, result_dict, len(self.TouchFrameSets))
+        return output_path
 
-        with open(output_path, 'w', newline='') as f:
-
-            if self.NoTouchFrame.mct_grid is not None:
-                data_out = pd.DataFrame(index=row,
-                                        data=result_dict["mct_summary"]["snr_summary"])
-                # print(data_out)
-                data_out = data_out.round(2)
-                # print(data_out)
-                csv_write = csv.writer(f)
-                csv_write.writerow(["MCT Summary"])
-                data_out.to_csv(f)
-
-            if self.NoTouchFrame.sct_row is not None:
-                data_out = pd.DataFrame(index=row,
-                                        data=result_dict["sct_row_summary"]["snr_sct_row_summary"])
-                data_out = data_out.round(2)
-                csv_write = csv.writer(f)
-                csv_write.writerow("\n")
-                csv_write.writerow(["SCT Row Summary"])
+    def write_out_bootstrap_csv(self, resamples=1000, block_len=16, level=0.95, seed=0):
+        """
+        write blocked bootstrap confidence intervals of all per touch snr metrics and the final minima
+        """
+        # under a memory budget the resample batches fit into what is left of the budget
+        headroom = self.memory_budget.headroom if self.memory_budget is not None else None
+        rows = bootstrap_snr(self, resamples=resamples, block_len=block_len, level=level, seed=seed,
+                             check=self.check_memory, headroom=headroom)
+        output_path = os.path.join(self.output_folder, self.pattern + "_bootstrap_ci.csv")
+        with open(output_path, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([f"Bootstrap {resamples} resamples, block {block_len} frames, level {level}"])
+            writer.writerow(["channel", "touch", "metric", "value", "ci_low", "ci_high", "std"])
+            for row in rows:
+                writer.writerow(row[:3] + ["{:.2f}".format(val) for val in row[3:]])
+        print("Successfully generate {}!!!!!".format(output_path))
+        return rows
+
+    def common_mode_rejected(self):
+        """
+        copy of this analysis with row / column common mode removed from every mutual capture
+        :return: (AnalyseData with cmr corrected mct data, dict capture name -> CommonModeResult)
+        """
+        results = {}
+        cmr_frames = []
+        for name, Frame in self.all_frames:
+            results[name] = estimate_common_mode(Frame.mct_grid)
+            CmrFrame = copy.copy(Frame)
+            CmrFrame.mct_grid = results[name].corrected
+            CmrFrame.sct_row = None
+            CmrFrame.sct_col = None
+            CmrFrame.masks = {channel: mask for channel, mask in Frame.masks.items() if channel == "mct"}
+            CmrFrame.compact_stats = {}
+            CmrFrame.spill_paths = []
+            cmr_frames.append(CmrFrame)
+            self.check_memory(f"after common mode rejection of {name}")
+
+        CmrAnalyse = copy.copy(self)
+        CmrAnalyse.NoTouchFrame = cmr_frames[0]
+        CmrAnalyse.TouchFrameSets = cmr_frames[1:]
+        return CmrAnalyse, results
+
+    def write_out_common_mode_csv(self, plot=True):
+        """
+        raw and common mode rejected (cmr) mutual noise / snr side by side, plus the common mode noise itself
+        """
+        CmrAnalyse, results = self.common_mode_rejected()
+        raw = self.snr_summaries(["BOE"])["BOE"]["mct_summary"]
+        cmr = CmrAnalyse.snr_summaries(["BOE"])["BOE"]["mct_summary"]
 
-                data_out.to_csv(f)
+        output_path = os.path.join(self.output_folder, self.pattern + "_cmr_summary.csv")
+        with open(output_path, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["MCT Common Mode Rejection Summary"])
+            columns = ["noise_p2p_notouch", "noise_rms_touch", "SmaxNppfullscreenR_dB", "SmeanNrmsR_dB"]
+            writer.writerow(["", "touched node"] + [f"{col} {kind}" for col in columns for kind in ["raw", "cmr"]])
+            for idx in range(len(self.TouchFrameSets)):
+                row = [f"Touch {idx + 1}", raw["snr_summary"]["touched node"][idx]]
+                for col in columns:
+                    row.extend("{:.2f}".format(ret["snr_summary"][col][idx]) for ret in [raw, cmr])
+                writer.writerow(row)
+
+            writer.writerow("\n")
+            writer.writerow(["Final Result MCT:", "raw", "cmr"])
+            for key in raw["final_results"]:
+                writer.writerow([key, raw["final_results"][key], cmr["final_results"][key]])
+
+            writer.writerow("\n")
+            writer.writerow(["Common Mode Noise:"] + list(common_mode_metrics(results["No Touch"]).keys()))
+            for name, result in results.items():
+                writer.writerow([name] + ["{:.2f}".format(val) for val in common_mode_metrics(result).values()])
+        print("Successfully generate {}!!!!!".format(output_path))
+
+        if plot:
+            self.plot_mct_common_mode_noise(results["No Touch"].cm_p2p)
+        return raw, cmr, results
+
+    def plot_mct_common_mode_noise(self, grid_Data):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        import seaborn as sns
+        from matplotlib import pyplot as plt
+        fig = plt.figure(figsize=self.standard_width_picture, dpi=110)
+        ax = sns.heatmap(data=grid_Data, annot=True, fmt='.0f', vmin=0)
+        ax.set_ylabel('Row')
+        ax.set_xlabel('Column')
+        plt.title('Grid Common Mode Peak-Peak Noise without Touch [%d , %d]\n Mean=%.0f; Min=%.0f; Max=%.0f' % (
+            self.NoTouchFrame.row_num, self.NoTouchFrame.col_num, grid_Data.mean(), grid_Data.min(), grid_Data.max())
+                  )
 
-            if self.NoTouchFrame.sct_col is not None:
-                data_out = pd.DataFrame(index=row,
-                                        data=result_dict["sct_col_summary"]["snr_sct_col_summary"])
-                data_out = data_out.round(2)
-                csv_write = csv.writer(f)
-                csv_write.writerow("\n")
-                csv_write.writerow(["SCT Column Summary"])
-                data_out.to_csv(f)
+        plt.tight_layout()
+        fig.savefig(os.path.join(self.output_folder, "Figure_MCT_common_mode_noise.png"))
+        return fig
 
-        if os.path.exists(output_path):
-            with open(output_path, 'a+', newline='') as f:
-                csv_write = csv.writer(f)
+    def full_panel_snr_map(self, power=2.0):
+        """
+        SNR of every mutual node: signal of the touched nodes interpolated over the whole panel (inverse distance
+        weighting) against no touch p2p and rms noise of every node, the p2p noise is the --noise term of the run
+        :return: dict of grids signal_max, signal_mean, noise_p2p, noise_rms, SmaxNppR_dB, SmeanNrmsR_dB and
+                 noise_label of the p2p noise term
+        """
+        metrics = compute_metrics(self, "mct", ["touch_position", "signal_max", "signal_mean", "notouch_p2p"],
+                                  noise=self.noise)
+        shape = self.NoTouchFrame.mct_grid_p2p.shape
+        ret = {
+            "signal_max": idw_interpolate(metrics["touch_position"], metrics["signal_max"], shape, power),
+            "signal_mean": idw_interpolate(metrics["touch_position"], metrics["signal_mean"], shape, power),
+            "noise_p2p": metrics["notouch_p2p"],
+            "noise_rms": self.NoTouchFrame.mct_grid_rms,
+        }
+        ret["SmaxNppR_dB"] = snr_db(ret["signal_max"], ret["noise_p2p"])
+        ret["SmeanNrmsR_dB"] = snr_db(ret["signal_mean"], ret["noise_rms"])
+        ret["noise_label"] = noise_label(self.noise)
+        self.check_memory("after full panel snr map")
+        return ret
 
-                if self.NoTouchFrame.mct_grid is not None:
-                    csv_write.writerow("\n")
+    def write_out_snr_map(self, power=2.0, plot=True):
+        """
+        export full panel snr maps as matrices, the min over panel summary and heatmaps
+        """
+        snr_map = self.full_panel_snr_map(power)
+        for name in ["signal_max", "SmaxNppR_dB", "SmeanNrmsR_dB"]:
+            np.savetxt(os.path.join(self.output_folder, f"{self.pattern}_snr_map_{name}.csv"), snr_map[name],
+                       delimiter=",", fmt="%.2f")
 
-                    csv_write.writerow(["Final Result MCT:"])
-                    for x, y in zip(list(result_dict["mct_summary"]["final_results"].keys()),
-                                    list(result_dict["mct_summary"]["final_results"].values())):
-                        csv_write.writerow([x, y])
+        output_path = os.path.join(self.output_folder, self.pattern + "_snr_map_summary.csv")
+        with open(output_path, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["metric", "min over panel", "node of min", "mean over panel", "noise"])
+            for name, label in [("SmaxNppR_dB", snr_map["noise_label"]), ("SmeanNrmsR_dB", "rms")]:
+                min_val, node = min_over_panel(snr_map[name])
+                writer.writerow([name, "{:.2f}".format(min_val), node, "{:.2f}".format(np.nanmean(snr_map[name])),
+                                 label])
+        print("Successfully generate {}!!!!!".format(output_path))
+
+        if plot:
+            self.plot_mct_snr_map(snr_map["SmaxNppR_dB"], "SmaxNppR_dB", snr_map["noise_label"])
+            self.plot_mct_snr_map(snr_map["SmeanNrmsR_dB"], "SmeanNrmsR_dB", "rms")
+        return snr_map
+
+    def plot_mct_snr_map(self, grid_Data, name, noise_name="p2p"):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        import seaborn as sns
+        from matplotlib import pyplot as plt
+        fig = plt.figure(figsize=self.standard_width_picture, dpi=110)
+        ax = sns.heatmap(data=grid_Data, annot=True, fmt='.1f')
+        ax.set_ylabel('Row')
+        ax.set_xlabel('Column')
+        min_val, (ynode, xnode) = min_over_panel(grid_Data)
+        plt.title('Full Panel %s (%s noise) [%d , %d]\n Min=%.1f at [%d,%d]; Mean=%.1f' % (
+            name, noise_name, self.NoTouchFrame.row_num, self.NoTouchFrame.col_num, min_val, ynode, xnode, np.nanmean(grid_Data))
+                  )
+        for idx, (y_touch, x_touch) in enumerate(self.all_touched_position):
+            self.annotate_grid_figure(ax=ax, ynode=y_touch, xnode=x_touch, Text=f"Touch {idx + 1}")
 
-                if self.NoTouchFrame.sct_row is not None:
-                    csv_write.writerow("\n")
+        plt.tight_layout()
+        fig.savefig(os.path.join(self.output_folder, f"Figure_MCT_snr_map_{name}.png"))
+        return fig
 
-                    csv_write.writerow(["Final Result SCT Row:"])
-                    for x, y in zip(list(result_dict["sct_row_summary"]["final_results"].keys()),
-                                    list(result_dict["sct_row_summary"]["final_results"].values())):
-                        csv_write.writerow([x, y])
+    def phase_sweeps(self, angle_num=72):
+        """
+        snr of every node against the demodulation phase compensation angle, for complex captures the angle which
+        maximizes the min snr over the touched nodes, see phase_sweep.py
+        :return: dict channel -> PhaseSweep
+        """
+        ret = {}
+        for channel in CHANNEL_DATA:
+            notouch = self.NoTouchFrame.channel_data(channel)
+            if notouch is None or len(self.TouchFrameSets) == 0:
+                continue
+            ret[channel] = phase_sweep(notouch, [TouchFrame.channel_data(channel)
+                                                 for TouchFrame in self.TouchFrameSets], angle_num)
+            self.check_memory(f"after {channel} phase sweep")
+        return ret
 
-                if self.NoTouchFrame.sct_col is not None:
-                    csv_write.writerow("\n")
+    def write_out_phase_sweep(self, angle_num=72, plot=True):
+        """
+        export snr vs angle curves, the optimal angle map of every channel and the best panel wide angle
+        """
+        sweeps = self.phase_sweeps(angle_num)
+        for channel, sweep in sweeps.items():
+            output_path = os.path.join(self.output_folder, f"{self.pattern}_phase_sweep_{channel}.csv")
+            with open(output_path, 'w', encoding='UTF8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(["angle_deg"] + [f"Touch {idx + 1} {node}" for idx, node in
+                                                 enumerate(sweep.touch_nodes)] + ["min over touches"])
+                for idx, (angle, min_snr) in enumerate(zip(sweep.angles, panel_min_curve(sweep))):
+                    writer.writerow(["{:.2f}".format(np.degrees(angle))] +
+                                    ["{:.2f}".format(val) for val in sweep.touch_snr_dB[:, idx]] +
+                                    ["{:.2f}".format(min_snr)])
+            print("Successfully generate {}!!!!!".format(output_path))
+
+            np.savetxt(os.path.join(self.output_folder, f"{self.pattern}_phase_sweep_{channel}_optimal_angle.csv"),
+                       optimal_angle_map(sweep), delimiter=",", fmt="%.2f")
+
+        output_path = os.path.join(self.output_folder, self.pattern + "_phase_sweep_summary.csv")
+        with open(output_path, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["channel", "best angle deg", "min snr dB at best angle", "min snr dB at 0 deg",
+                             "peak node angles deg"])
+            for channel, sweep in sweeps.items():
+                best_angle, best_snr = best_panel_angle(sweep)
+                writer.writerow([channel, "{:.2f}".format(best_angle), "{:.2f}".format(best_snr),
+                                 "{:.2f}".format(panel_min_curve(sweep)[0]),
+                                 " ".join("{:.2f}".format(np.degrees(angle)) for angle in sweep.peak_angles)])
+        print("Successfully generate {}!!!!!".format(output_path))
+
+        if plot:
+            for channel, sweep in sweeps.items():
+                self.plot_phase_sweep(channel, sweep)
+        return sweeps
+
+    def plot_phase_sweep(self, channel, sweep):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        from matplotlib import pyplot as plt
+        fig = plt.figure(figsize=self.standard_width_picture, dpi=110)
+        degrees = np.degrees(sweep.angles)
+        for idx, node in enumerate(sweep.touch_nodes):
+            plt.plot(degrees, sweep.touch_snr_dB[idx], label=f"Touch {idx + 1} {node}")
+        plt.plot(degrees, panel_min_curve(sweep), 'k--', linewidth=2, label="min over touches")
+        best_angle, best_snr = best_panel_angle(sweep)
+        plt.axvline(best_angle, color='r', linestyle=':')
+        plt.xlabel('Compensation angle [deg]')
+        plt.ylabel('SNR [dB]')
+        plt.title('%s phase sweep\n best angle=%.1f deg, min SNR=%.1f dB' % (channel.upper(), best_angle, best_snr))
+        plt.legend()
+        plt.grid()
+        plt.tight_layout()
+        fig.savefig(os.path.join(self.output_folder, f"Figure_{channel.upper()}_phase_sweep.png"))
+        return fig
+
+    def frame_series(self):
+        """
+        per frame signal at the touched node of every touch capture and per frame noise of the no touch capture
+        :return: dict of arrays, per channel <channel>_signal [touches, frames] (nan padded), <channel>_touch_nodes,
+                 <channel>_notouch_at_touch [touches, frames], <channel>_noise_p2p and <channel>_noise_rms [frames]
+        """
+        ret = {}
+        for channel in CHANNEL_DATA:
+            notouch = self.NoTouchFrame.channel_data(channel)
+            if notouch is None or len(self.TouchFrameSets) == 0:
+                continue
+            nodes = compute_metrics(self, channel, ["touch_position"])["touch_position"]
+            ret[f"{channel}_signal"] = node_series([TouchFrame.channel_data(channel)
+                                                    for TouchFrame in self.TouchFrameSets], nodes,
+                                                   [TouchFrame.active_mask(channel)
+                                                    for TouchFrame in self.TouchFrameSets])
+            ret[f"{channel}_touch_nodes"] = np.array(nodes)
+            notouch_mask = self.NoTouchFrame.active_mask(channel)
+            ret[f"{channel}_notouch_at_touch"] = node_series([notouch] * len(nodes), nodes,
+                                                             [notouch_mask] * len(nodes))
+            ret[f"{channel}_noise_p2p"], ret[f"{channel}_noise_rms"] = frame_noise(notouch, notouch_mask)
+            self.check_memory(f"after {channel} frame series")
+        return ret
 
-                    csv_write.writerow(["Final Result SCT Col:"])
-                    for x, y in zip(list(result_dict["sct_col_summary"]["final_results"].keys()),
-                                    list(result_dict["sct_col_summary"]["final_results"].values())):
-                        csv_write.writerow([x, y])
+    def write_out_frame_series(self, plot=False):
+        """
+        export the per frame time series of the pattern as one compressed columnar file
+        """
+        series = self.frame_series()
+        output_path = write_frame_series(os.path.join(self.output_folder,
+                                                      self.pattern + "_frame_series" + FRAME_SERIES_EXT), series)
+        print("Successfully generate {}!!!!!".format(output_path))
+        if plot:
+            for channel in CHANNEL_DATA:
+                if f"{channel}_signal" in series:
+                    self.plot_frame_series(channel, series)
+        return series
+
+    def plot_frame_series(self, channel, series):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        from matplotlib import pyplot as plt
+        fig, (ax_signal, ax_noise) = plt.subplots(2, 1, sharex=True, figsize=self.standard_width_picture, dpi=110)
+        for idx, (signal, node) in enumerate(zip(series[f"{channel}_signal"], series[f"{channel}_touch_nodes"])):
+            ax_signal.plot(signal, linewidth=0.8, label=f"Touch {idx + 1} {tuple(node)}")
+        ax_signal.set_ylabel('Signal at touched node')
+        ax_signal.legend()
+        ax_signal.grid()
+        ax_noise.plot(series[f"{channel}_noise_p2p"], linewidth=0.8, label="No Touch p2p over nodes")
+        ax_noise.plot(series[f"{channel}_noise_rms"], linewidth=0.8, label="No Touch rms over nodes")
+        ax_noise.set_xlabel('Frame')
+        ax_noise.set_ylabel('Noise')
+        ax_noise.legend()
+        ax_noise.grid()
+        fig.suptitle(f'{self.pattern} {channel.upper()} per frame signal and noise')
+        plt.tight_layout()
+        fig.savefig(os.path.join(self.output_folder, f"Figure_{channel.upper()}_frame_series.png"))
+        return fig
 
     def write_out_decode_mct_csv(self):
 
@@ -798,6 +1134,7 @@ class AnalyseData:
                     writer.writerow(li)
                 writer.writerow("\n")
         f.close()
+        self.check_memory("after raw grid export of No Touch")
 
         for idx, TouchFrame in enumerate(self.TouchFrameSets):
             touch_out_path = os.path.join(self.output_folder,
@@ -814,8 +1151,12 @@ class AnalyseData:
                         writer.writerow(li)
                     writer.writerow("\n")
             f.close()
+            self.check_memory(f"after raw grid export of {os.path.basename(touch_out_path)}")
 
     def plot_mct_noise_rms(self):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        import seaborn as sns
+        from matplotlib import pyplot as plt
         ret = []
         touched_node_list = self.all_touched_position
         for idx, TouchFrame in enumerate(self.TouchFrameSets):
@@ -838,6 +1179,9 @@ class AnalyseData:
         return ret
 
     def plot_mct_noise_p2p_annotated(self):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        import seaborn as sns
+        from matplotlib import pyplot as plt
         grid_Data = self.NoTouchFrame.mct_grid_p2p
         fig = plt.figure(figsize=self.standard_width_picture, dpi=110)
         ax = sns.heatmap(data=grid_Data, annot=True, fmt='.0f', vmin=0, vmax=1000)
@@ -856,6 +1200,9 @@ class AnalyseData:
         return fig
 
     def plot_mct_noise_p2p(self):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        import seaborn as sns
+        from matplotlib import pyplot as plt
         grid_Data = self.NoTouchFrame.mct_grid_p2p
         fig = plt.figure(figsize=self.standard_width_picture, dpi=110)
         ax = sns.heatmap(data=grid_Data, annot=True, fmt='.0f', vmin=0, vmax=1000)
@@ -870,6 +1217,9 @@ class AnalyseData:
         return fig
 
     def plot_touch_signal_all(self):
+        # plotting libraries take most of the startup time, they are only imported once a figure is drawn
+        import seaborn as sns
+        from matplotlib import pyplot as plt
         touch_data = []
         signal_list = []
         for TouchFrame in self.TouchFrameSets:
@@ -898,6 +1248,7 @@ class AnalyseData:
         return fig
 
     def annotate_grid_figure(self, ax, ynode, xnode, Text, boxcoler="cyan", arrowcolor="cyan"):
+        from matplotlib import patches
 
         ax.add_patch(patches.Rectangle((xnode, ynode), 1, 1, fill=False,
                                        facecolor=None, edgecolor=boxcoler, linewidth=4.0))
@@ -952,7 +1303,177 @@ def get_touched_num(folder, prefix):
         if re.search('{}(\d+)'.format(prefix), file):
             ret.append(re.search('{}(\d+)'.format(prefix), file).group(1))
 
-    return ret
+    # a capture may exist as csv and as archive
+    return list(dict.fromkeys(ret))
+
+
+def write_summary_csv(output_path, result_dict, touch_num):
+    """
+    write one vendor summary (per touch table and final results) into a csv report
+    :param output_path: csv file path
+    :param result_dict: vendor summary, i.e. from AnalyseData.snr_summaries
+    :param touch_num: number of touch captures
+    """
+    # pandas is only needed to format the per touch tables
+    import pandas as pd
+
+    row = ["Touch {}".format(idx + 1) for idx in range(touch_num)]
+
+    with open(output_path, 'w', newline='') as f:
+
+        if result_dict.get("mct_summary", None) is not None:
+            data_out = pd.DataFrame(index=row,
+                                    data=result_dict["mct_summary"]["snr_summary"])
+            # print(data_out)
+            data_out = data_out.round(2)
+            # print(data_out)
+            csv_write = csv.writer(f)
+            csv_write.writerow(["MCT Summary"])
+            data_out.to_csv(f)
+
+        if result_dict.get("sct_row_summary", None) is not None:
+            data_out = pd.DataFrame(index=row,
+                                    data=result_dict["sct_row_summary"]["snr_sct_row_summary"])
+            data_out = data_out.round(2)
+            csv_write = csv.writer(f)
+            csv_write.writerow("\n")
+            csv_write.writerow(["SCT Row Summary"])
+
+            data_out.to_csv(f)
+
+        if result_dict.get("sct_col_summary", None) is not None:
+            data_out = pd.DataFrame(index=row,
+                                    data=result_dict["sct_col_summary"]["snr_sct_col_summary"])
+            data_out = data_out.round(2)
+            csv_write = csv.writer(f)
+            csv_write.writerow("\n")
+            csv_write.writerow(["SCT Column Summary"])
+            data_out.to_csv(f)
+
+    if os.path.exists(output_path):
+        with open(output_path, 'a+', newline='') as f:
+            csv_write = csv.writer(f)
+
+            if result_dict.get("mct_summary", None) is not None:
+                csv_write.writerow("\n")
+
+                csv_write.writerow(["Final Result MCT:"])
+                for x, y in zip(list(result_dict["mct_summary"]["final_results"].keys()),
+                                list(result_dict["mct_summary"]["final_results"].values())):
+                    csv_write.writerow([x, y])
+
+            if result_dict.get("sct_row_summary", None) is not None:
+                csv_write.writerow("\n")
+
+                csv_write.writerow(["Final Result SCT Row:"])
+                for x, y in zip(list(result_dict["sct_row_summary"]["final_results"].keys()),
+                                list(result_dict["sct_row_summary"]["final_results"].values())):
+                    csv_write.writerow([x, y])
+
+            if result_dict.get("sct_col_summary", None) is not None:
+                csv_write.writerow("\n")
+
+                csv_write.writerow(["Final Result SCT Col:"])
+                for x, y in zip(list(result_dict["sct_col_summary"]["final_results"].keys()),
+                                list(result_dict["sct_col_summary"]["final_results"].values())):
+                    csv_write.writerow([x, y])
+
+            if result_dict.get("noise_term", None) is not None:
+                csv_write.writerow("\n")
+
+                csv_write.writerow(["Noise Term:", result_dict["noise_term"]])
+
+            if result_dict.get("frames_used", None) is not None:
+                csv_write.writerow("\n")
+
+                csv_write.writerow(["Frames Used:"])
+                for x, y in result_dict["frames_used"].items():
+                    csv_write.writerow([x, y])
+
+
+def get_pattern_capture_paths(dataset, pattern, prefix_notouch, prefix_touch):
+    """
+    locate the no touch and touch captures of a pattern folder
+    path format is **.edl.csv, i.e:
+    notouch path "wo.edl.csv" -> prefix_notouch = "wo"
+    touch path "wi5.edl.csv" -> prefix_touch = "wi"
+    :return: (no touch path, [touch path, ...])
+    """
+    # csv captures, or their archives (capture_archive.py) when the csv files are gone
+    notouch_data_path = os.path.join(dataset, pattern, "{}.csv".format(prefix_notouch))
+    touch_path = os.path.join(dataset, pattern, prefix_touch + "{}.csv")
+    for ext in [".edl.csv", ".csv", ".edl." + ARCHIVE_EXT, "." + ARCHIVE_EXT]:
+        if os.path.exists(os.path.join(dataset, pattern, prefix_notouch + ext)):
+            notouch_data_path = os.path.join(dataset, pattern, prefix_notouch + ext)
+            touch_path = os.path.join(dataset, pattern, prefix_touch + "{}" + ext)
+            break
+
+    touch_list = get_touched_num(os.path.join(dataset, pattern), prefix_touch)
+
+    # match touch raw data file
+    touch_data_path_list = [touch_path.format(i) for i in touch_list if os.path.exists(touch_path.format(i))]
+    return notouch_data_path, touch_data_path_list
+
+
+def build_final_result_row(pattern, BOE_ret):
+    """
+    one row of result_summary.csv from the BOE summary of a pattern
+    """
+    # "min_SmaxNppfullscreenR_dB": "{:.2f}".format(min_SmaxNppfullscreenR_dB),
+    # "Position_P2P": f"Touch {min_SmaxNppfullscreenR_dB_index + 1}",
+    # "min_SmeanNrmsR_dB": "{:.2f}".format(min_SmeanNrmsR_dB),
+    # "Position_RMS": f"Touch {min_SmeanNrmsR_dB_index + 1}"
+    tmp_res = [pattern]
+    if BOE_ret.get("mct_summary", None) is not None:
+        tmp_res.extend([BOE_ret["mct_summary"]["final_results"]["min_SmaxNppfullscreenR_dB"],
+                        BOE_ret["mct_summary"]["final_results"]["min_SmeanNrmsR_dB"]])
+    else:
+        tmp_res.extend(["NaN", "NaN"])
+
+    if BOE_ret.get("sct_row_summary", None) is not None:
+        tmp_res.extend([BOE_ret["sct_row_summary"]["final_results"]["min_sct_row_SmaxNppfullscreenR_dB"],
+                        BOE_ret["sct_row_summary"]["final_results"]["min_sct_row_SmeanNrmsR_dB"]])
+    else:
+        tmp_res.extend(["NaN", "NaN"])
+
+    if BOE_ret.get("sct_col_summary", None) is not None:
+        tmp_res.extend([BOE_ret["sct_col_summary"]["final_results"]["min_sct_col_SmaxNppfullscreenR_dB"],
+                        BOE_ret["sct_col_summary"]["final_results"]["min_sct_col_SmeanNrmsR_dB"]])
+    else:
+        tmp_res.extend(["NaN", "NaN"])
+    return tmp_res
+
+
+def merge_partial_results(partial_dirs, out_folder=None):
+    """
+    combine partial results of shard workers into the vendor csv files and result_summary.csv,
+    with the same ordering as a single node run
+    :param partial_dirs: list of folders holding *.partial.json files
+    :param out_folder: folder of result_summary.csv, default is the dataset of the partials
+    """
+    partials = load_partials(partial_dirs)
+    if len(partials) == 0:
+        print(f"no partial results found in {partial_dirs}")
+        return []
+
+    final_results = []
+    for partial in partials:
+        if not os.path.exists(partial["output_folder"]):
+            os.makedirs(partial["output_folder"])
+        for summary in partial["summaries"].values():
+            output_path = os.path.join(partial["output_folder"],
+                                       summary["Vendor"] + "_" + partial["pattern"] + "_output_info.csv")
+            write_summary_csv(output_path, summary, partial["touch_num"])
+        if partial["final_result"] is not None:
+            final_results.append(partial["final_result"])
+
+    if out_folder is None:
+        out_folder = partials[0]["dataset"]
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    write_out_final_result_csv(out_folder, final_results)
+    print(f"merged {len(partials)} partial results into {out_folder}")
+    return final_results
 
 
 def write_out_final_result_csv(folder, data):
@@ -961,8 +1482,7 @@ def write_out_final_result_csv(folder, data):
     with open(out_path, 'w', encoding='UTF8', newline='') as f:
         writer = csv.writer(f)
         # write a row to the csv file
-        writer.writerow(["pattern (fullscreen)", "SNppR MCT", "SNrmsR MCT", "SNppR SCT Row",
-                         "SNrmsR SCT Row","SNppR SCT Col", "SNrmsR SCT Col"])
+        writer.writerow(FINAL_RESULT_COLUMNS)
         for idx, line in enumerate(data):
             li = list(line)
             writer.writerow(li)
@@ -982,9 +1502,8 @@ class SNRToolingOptions:
 
         self.parser.add_argument('--pattern_folder',
                                  nargs='+',
-                                 default=['white'],
-                                 help='<Required> Set flag',
-                                 required=True)
+                                 default=None,
+                                 help='<Required> Set flag, unless --manifest or --merge_partials is used')
 
         # todo now output path is hard coded
         # self.parser.add_argument("--log_dir",
@@ -1000,9 +1519,8 @@ class SNRToolingOptions:
 
         self.parser.add_argument('--report_vendor',
                                  action='append',
-                                 help='<Required> Set flag',
-                                 default=[],
-                                 required=True)
+                                 help='<Required> Set flag, unless --merge_partials is used',
+                                 default=[])
         self.parser.add_argument("--prefix_notouch",
                                  type=str,
                                  help="pattern type",
@@ -1034,8 +1552,170 @@ class SNRToolingOptions:
                                  help="convert mct rawdata into grid foramt",
                                  action="store_true")
 
+        self.parser.add_argument("--frames",
+                                 type=str,
+                                 help="only load this frame window start:stop:step, i.e. :300 or 100:400:2",
+                                 default=None)
+
+        self.parser.add_argument("--channels",
+                                 type=parse_channels,
+                                 help="only convert these channels, comma separated from mct,sct_row,sct_col",
+                                 default=None)
+
+        self.parser.add_argument("--prefetch_depth",
+                                 type=int,
+                                 help="number of capture files read ahead in background, 0 disables prefetch",
+                                 default=0)
+
+        self.parser.add_argument("--prefetch_memory_mb",
+                                 type=float,
+                                 help="max memory of capture files read ahead in background",
+                                 default=512)
+
+        self.parser.add_argument("--detrend",
+                                 type=parse_detrend,
+                                 help="remove baseline drift before noise statistics: poly:<order> or movavg:<frames>",
+                                 default=None)
+
+        self.parser.add_argument("--noise",
+                                 type=parse_noise,
+                                 help="peak-peak noise term of the snr: p2p (max - min over frames) or a robust "
+                                      "percentile spread pctl:<lo>:<hi>, i.e. pctl:0.1:99.9",
+                                 default=None)
+
+        self.parser.add_argument("--memory_budget", "--memory-budget",
+                                 type=parse_memory_size,
+                                 dest="memory_budget",
+                                 help="max resident memory, i.e. 2G: only per node statistics are kept per capture "
+                                      "and raw frames are spilled to memory mapped files",
+                                 default=None)
+
+        self.parser.add_argument("--spill_dir",
+                                 type=str,
+                                 help="folder for spilled raw frames under --memory_budget, temporary if not set",
+                                 default=None)
+
+        self.parser.add_argument("--reject_outliers",
+                                 help="mask spike nodes and glitch frames before computing statistics",
+                                 action="store_true")
+
+        self.parser.add_argument("--outlier_z",
+                                 type=float,
+                                 help="robust z-score (median / MAD per node) above which a sample is a spike",
+                                 default=6.0)
+
+        self.parser.add_argument("--outlier_frame_fraction",
+                                 type=float,
+                                 help="fraction of spike nodes above which a whole frame is rejected",
+                                 default=0.05)
+
+        self.parser.add_argument("--common_mode",
+                                 help="estimate row / column common mode of mct frames, report cmr corrected noise "
+                                      "and snr next to the raw ones and plot the common mode noise heatmap",
+                                 action="store_true")
+
+        self.parser.add_argument("--snr_map",
+                                 help="full panel snr map: touch signal interpolated over all nodes against the "
+                                      "no touch noise of every node, exported as matrix and heatmap",
+                                 action="store_true")
+
+        self.parser.add_argument("--phase_sweep",
+                                 type=int,
+                                 help="number of phase compensation angles over 0-360 deg for the snr vs angle "
+                                      "sweep of complex captures, 0 disables",
+                                 default=0)
+
+        self.parser.add_argument("--frame_series",
+                                 help="export per frame touch signal and no touch noise of every capture as "
+                                      "<pattern>_frame_series.npz",
+                                 action="store_true")
+
+        self.parser.add_argument("--plot_frame_series",
+                                 help="plot the per frame signal and noise overlay, implies --frame_series",
+                                 action="store_true")
+
+        self.parser.add_argument("--bootstrap",
+                                 type=int,
+                                 help="number of blocked bootstrap resamples for snr confidence intervals, 0 disables",
+                                 default=0)
+
+        self.parser.add_argument("--bootstrap_block",
+                                 type=int,
+                                 help="frames per bootstrap block, keeps temporal correlation inside a block",
+                                 default=16)
+
+        self.parser.add_argument("--bootstrap_level",
+                                 type=float,
+                                 help="confidence level of the bootstrap intervals",
+                                 default=0.95)
+
+        self.parser.add_argument("--bootstrap_seed",
+                                 type=int,
+                                 help="random seed of the bootstrap",
+                                 default=0)
+
+        self.parser.add_argument("--manifest",
+                                 type=str,
+                                 help="text file with one pattern folder per line, replaces --pattern_folder",
+                                 default=None)
+
+        self.parser.add_argument("--shard",
+                                 type=str,
+                                 help="worker mode: only analyse the share index/count of the patterns, i.e. 0/4",
+                                 default=None)
+
+        self.parser.add_argument("--partial_dir",
+                                 type=str,
+                                 help="write self describing partial results into this (shared) folder, "
+                                      "vendor csv and result_summary.csv are left to --merge_partials",
+                                 default=None)
+
+        self.parser.add_argument("--merge_partials",
+                                 nargs='+',
+                                 help="merge partial result folders into vendor csv files and result_summary.csv",
+                                 default=None)
+
+        self.parser.add_argument("--merge_output",
+                                 type=str,
+                                 help="folder of the merged result_summary.csv, default is the dataset of the partials",
+                                 default=None)
+
+        self.parser.add_argument("--results_db",
+                                 type=str,
+                                 help="append all vendor summaries to this sqlite results store",
+                                 default=None)
+
+        self.parser.add_argument("--result_cache",
+                                 help="reuse the results of patterns whose captures and options are unchanged since "
+                                      "the last run, only changed patterns are analysed again",
+                                 action="store_true")
+
+        self.parser.add_argument("--result_cache_dir",
+                                 type=str,
+                                 help="folder of the per pattern result cache, <dataset>/result_cache if not set",
+                                 default=None)
+
+        self.parser.add_argument("--run_id",
+                                 type=str,
+                                 help="run id recorded in the results store, random if not set",
+                                 default=None)
+
     def parse(self):
         self.options = self.parser.parse_args()
+        if self.options.merge_partials is None:
+            if self.options.pattern_folder is None and self.options.manifest is None:
+                self.parser.error("the following arguments are required: --pattern_folder (or --manifest)")
+            if len(self.options.report_vendor) == 0:
+                self.parser.error("the following arguments are required: --report_vendor")
+        if self.options.shard is not None:
+            try:
+                parse_shard(self.options.shard)
+            except ValueError as err:
+                self.parser.error(str(err))
+        try:
+            self.options.frames = parse_frame_slice(self.options.frames)
+        except ValueError as err:
+            self.parser.error(str(err))
         return self.options
 
 
@@ -1045,69 +1725,136 @@ if __name__ == '__main__':
     opts = options.parse()
     final_results = []
 
-    for pattern in opts.pattern_folder:
-        # # rawdata folder
-        # pattern_folder = opts.pattern_folder
-        # print(pattern_folder)
-        # pattern = os.path.basename(pattern_folder)
-
-        # modify rawdata paths: path format is **.edl.csv, i.e:
-        # notouch path "wo.edl.csv" -> prefix_notouch = "wo"
-        # touch path "wi5.edl.csv" -> prefix_touch = "wi"
-        prefix_notouch = opts.prefix_notouch
-        prefix_touch = opts.prefix_touch
-
-        if os.path.exists(os.path.join(opts.dataset, pattern, "{}.edl.csv".format(prefix_notouch))):
-            notouch_data_path = os.path.join(opts.dataset, pattern, "{}.edl.csv".format(prefix_notouch))
-            touch_path = os.path.join(opts.dataset, pattern, prefix_touch + "{}.edl.csv")
-        else:
-            notouch_data_path = os.path.join(opts.dataset, pattern, "{}.csv".format(prefix_notouch))
-            touch_path = os.path.join(opts.dataset, pattern, prefix_touch + "{}.csv")
-
-        touch_list = get_touched_num(os.path.join(opts.dataset, pattern), prefix_touch)
-
-        # match touch raw data file
-        touch_data_path_list = [touch_path.format(i) for i in touch_list]
+    if opts.merge_partials is not None:
+        merge_partial_results(opts.merge_partials, opts.merge_output)
+        sys.exit(0)
+
+    patterns = read_manifest(opts.manifest) if opts.manifest is not None else opts.pattern_folder
+    if opts.shard is not None:
+        shard_patterns = select_shard(patterns, *parse_shard(opts.shard))
+        print(f"shard {opts.shard}: analyse {len(shard_patterns)} of {len(patterns)} patterns")
+    else:
+        shard_patterns = list(enumerate(patterns))
+
+    results_store = None
+    if opts.results_db is not None:
+        results_store = ResultsStore(opts.results_db)
+        run_seq, run_id = results_store.begin_run(opts.dataset, " ".join(sys.argv), opts.run_id)
+        print(f"record results as run {run_id} in {opts.results_db}")
+
+    pattern_paths = {pattern: get_pattern_capture_paths(opts.dataset, pattern, opts.prefix_notouch, opts.prefix_touch)
+                     for _, pattern in shard_patterns}
+
+    # results of patterns whose captures and options are unchanged are taken from the cache
+    result_cache = None
+    cache_keys = {}
+    cached_results = {}
+    if opts.result_cache:
+        result_cache = ResultCache(opts.result_cache_dir or os.path.join(opts.dataset, "result_cache"))
+        for _, pattern in shard_patterns:
+            notouch_data_path, touch_data_path_list = pattern_paths[pattern]
+            cache_keys[pattern] = result_cache.key(pattern, [notouch_data_path] + touch_data_path_list, opts)
+            cached_results[pattern] = result_cache.get(pattern, cache_keys[pattern][0])
+
+    memory_budget = None
+    if opts.memory_budget is not None:
+        memory_budget = MemoryBudget(opts.memory_budget, opts.spill_dir)
+
+    # read upcoming captures in background while the current one is analysed
+    prefetcher = None
+    if opts.prefetch_depth > 0:
+        prefetch_files = []
+        for pattern, (notouch_data_path, touch_data_path_list) in pattern_paths.items():
+            if cached_results.get(pattern, None) is not None:
+                continue
+            prefetch_files.append(notouch_data_path)
+            prefetch_files.extend(touch_data_path_list)
+        prefetcher = CapturePrefetcher(prefetch_files, opts.prefetch_depth, opts.prefetch_memory_mb).start()
+
+    for order, pattern in shard_patterns:
+        notouch_data_path, touch_data_path_list = pattern_paths[pattern]
+
+        cached = cached_results.get(pattern, None)
+        if cached is not None:
+            if cached["final_result"] is not None:
+                final_results.append(cached["final_result"])
+            if opts.partial_dir is not None:
+                write_partial(opts.partial_dir, order, pattern, opts.dataset, cached["output_folder"],
+                              cached["touch_num"], cached["summaries"], cached["final_result"], opts.shard)
+            if results_store is not None:
+                input_hash = results_store.add_inputs(run_seq, pattern, [notouch_data_path] + touch_data_path_list,
+                                                      cached["input_hashes"])
+                for vendor, summary in cached["summaries"].items():
+                    results_store.append_summary(run_seq, opts.dataset, pattern, vendor, summary, input_hash)
+            print(f"Reuse cached results of {pattern} !!!!!!!!!!!!!!")
+            continue
 
         # AnalyseData is main class for snr analysis
         DataAnalyse = AnalyseData(no_touch_file_path=notouch_data_path,
                                   touch_file_paths=touch_data_path_list,
-                                  Header_index=HEADER_ETS)
+                                  Header_index=HEADER_ETS,
+                                  frames=opts.frames,
+                                  channels=opts.channels,
+                                  prefetcher=prefetcher,
+                                  detrend=opts.detrend,
+                                  outliers=(opts.outlier_z, opts.outlier_frame_fraction) if opts.reject_outliers
+                                  else None,
+                                  memory_budget=memory_budget,
+                                  noise=opts.noise)
+
+        if opts.detrend is not None:
+            DataAnalyse.write_out_drift_csv()
+
+        if opts.reject_outliers:
+            DataAnalyse.write_out_outlier_csv()
+
+        if results_store is not None:
+            # the result cache key already hashed the captures
+            input_hash = results_store.add_inputs(run_seq, pattern, [notouch_data_path] + touch_data_path_list,
+                                                  cache_keys[pattern][1] if pattern in cache_keys else None)
 
         # print(pd.DataFrame(DataAnalyse.BOE_snr_summary()))
 
-        # select vendor for different report
-        if "BOE" in opts.report_vendor:
-            BOE_ret = DataAnalyse.BOE_snr_summary()
-            DataAnalyse.write_out_csv(BOE_ret)
-            # "min_SmaxNppfullscreenR_dB": "{:.2f}".format(min_SmaxNppfullscreenR_dB),
-            # "Position_P2P": f"Touch {min_SmaxNppfullscreenR_dB_index + 1}",
-            # "min_SmeanNrmsR_dB": "{:.2f}".format(min_SmeanNrmsR_dB),
-            # "Position_RMS": f"Touch {min_SmeanNrmsR_dB_index + 1}"
-            tmp_res = [pattern]
-            if BOE_ret.get("mct_summary", None) is not None:
-                tmp_res.extend([ BOE_ret["mct_summary"]["final_results"]["min_SmaxNppfullscreenR_dB"],
-                                BOE_ret["mct_summary"]["final_results"]["min_SmeanNrmsR_dB"]])
-            else:
-                tmp_res.extend(["NaN", "NaN"])
-
-            if BOE_ret.get("sct_row_summary", None) is not None:
-                tmp_res.extend([BOE_ret["sct_row_summary"]["final_results"]["min_sct_row_SmaxNppfullscreenR_dB"],
-                                BOE_ret["sct_row_summary"]["final_results"]["min_sct_row_SmeanNrmsR_dB"]])
-            else:
-                tmp_res.extend(["NaN", "NaN"])
-
-            if BOE_ret.get("sct_col_summary", None) is not None:
-                tmp_res.extend([BOE_ret["sct_col_summary"]["final_results"]["min_sct_col_SmaxNppfullscreenR_dB"],
-                                BOE_ret["sct_col_summary"]["final_results"]["min_sct_col_SmeanNrmsR_dB"]])
-            else:
-                tmp_res.extend(["NaN", "NaN"])
-            final_results.append(tmp_res)
-        if "Huawei_quick" in opts.report_vendor:
-            DataAnalyse.write_out_csv(DataAnalyse.HW_quick_snr_summary())
-
-        if "Huawei_thp_afe" in opts.report_vendor:
-            DataAnalyse.write_out_csv(DataAnalyse.HW_thp_afe_snr_summary())
+        # select vendor for different report, all selected vendors share one metric plan
+        vendors = [vendor for vendor in VENDOR_REPORTS if vendor in opts.report_vendor]
+        summaries = DataAnalyse.snr_summaries(vendors)
+        vendor_outputs = []
+        for vendor in vendors:
+            # shard workers leave the vendor csv to the merge step
+            if opts.partial_dir is None:
+                vendor_outputs.append(DataAnalyse.write_out_csv(summaries[vendor]))
+            if results_store is not None:
+                results_store.append_summary(run_seq, opts.dataset, pattern, vendor, summaries[vendor], input_hash)
+
+        final_result = None
+        if "BOE" in summaries:
+            final_result = build_final_result_row(pattern, summaries["BOE"])
+            final_results.append(final_result)
+
+        if opts.partial_dir is not None:
+            write_partial(opts.partial_dir, order, pattern, opts.dataset, DataAnalyse.output_folder,
+                          len(DataAnalyse.TouchFrameSets), summaries, final_result, opts.shard)
+
+        # common mode noise and cmr corrected snr
+        if opts.common_mode and DataAnalyse.NoTouchFrame.mct_grid is not None:
+            DataAnalyse.write_out_common_mode_csv()
+
+        # snr of every node of the panel
+        if opts.snr_map and DataAnalyse.NoTouchFrame.mct_grid is not None:
+            DataAnalyse.write_out_snr_map()
+
+        # snr against the demodulation phase compensation angle
+        if opts.phase_sweep > 0:
+            DataAnalyse.write_out_phase_sweep(opts.phase_sweep)
+
+        # per frame signal and noise
+        if opts.frame_series or opts.plot_frame_series:
+            DataAnalyse.write_out_frame_series(plot=opts.plot_frame_series)
+
+        # confidence intervals of the snr figures
+        if opts.bootstrap > 0:
+            DataAnalyse.write_out_bootstrap_csv(opts.bootstrap, opts.bootstrap_block, opts.bootstrap_level,
+                                                opts.bootstrap_seed)
 
         # convert mct rawdata into grid foramt
         if opts.log_grid_rawdata:
@@ -1128,6 +1875,29 @@ if __name__ == '__main__':
         if opts.plot_noise_p2p_annotated:
             DataAnalyse.plot_mct_noise_p2p_annotated()
 
+        if memory_budget is not None:
+            DataAnalyse.release_spill()
+
+        if result_cache is not None:
+            result_cache.put(pattern, *cache_keys[pattern], summaries, final_result, len(DataAnalyse.TouchFrameSets),
+                             DataAnalyse.output_folder, vendor_outputs)
+
         print(f"Already successful finish {pattern} !!!!!!!!!!!!!!")
 
-    write_out_final_result_csv(opts.dataset, final_results)
+    if opts.partial_dir is None:
+        write_out_final_result_csv(opts.dataset, final_results)
+
+    if result_cache is not None:
+        result_cache.save()
+        print(result_cache.report())
+
+    if prefetcher is not None:
+        prefetcher.stop()
+        print(prefetcher.report())
+
+    if memory_budget is not None:
+        memory_budget.cleanup()
+        print(memory_budget.report())
+
+    if results_store is not None:
+        results_store.close()
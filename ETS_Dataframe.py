@@ -1,17 +1,21 @@
 import re
+import io
 import csv
+import itertools
+import weakref
+from collections import namedtuple
 import numpy as np
 import os
 from typing import List
-import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
-import argparse
-from matplotlib import patches
-from phase_utilities import *
+from detrend import detrend_frames
+from memory_budget import spill_array, SpillWriter
+from shared_frames import attach_array
+from capture_archive import CaptureArchive, RunningStats, ARCHIVE_EXT
+from percentile_noise import percentile_spread
+from outlier_detection import detect_outliers, build_mask, masked_max, masked_min, masked_mean, masked_rms, \
+    masked_signal_position
 
 file_dir = os.path.dirname(__file__)  # the directory that class "option" resides in
-pd.set_option('display.max_columns', None)
 
 MCT_DELTAGEN_DATA = 0
 SCTY_DELTAGEN_DATA = 1
@@ -24,126 +28,614 @@ HEADER_ETS = [
 ]
 
 
+def new_header_index():
+    """
+    copy of HEADER_ETS with reset column indices, the loader fills the indices in place
+    """
+    return [entry[:3] + [0, 0] for entry in HEADER_ETS]
+
+
+CHANNEL_NAMES = ["mct", "sct_row", "sct_col"]
+
+# channel -> ETS_Dataframe data attribute
+CHANNEL_DATA = {
+    "mct": "mct_grid",
+    "sct_row": "sct_row",
+    "sct_col": "sct_col",
+}
+
+# per capture state passed along with the shared arrays of ETS_Dataframe.share
+FrameHandle = namedtuple("FrameHandle", ["arrays", "masks", "meta"])
+
+SHARED_META = ["row_num", "col_num", "frame_num", "channels", "apply_mask", "rejected_frames", "frame_score",
+               "drift", "compact_stats"]
+
+# frames of a csv capture converted at once, bounds the python objects alive while parsing
+CSV_BLOCK_FRAMES = 256
+
+# ETS_Dataframe channel -> header index of its columns (sct_row data is stored in the sct_col_deltas columns)
+CHANNEL_HEADER = {
+    "mct": MCT_DELTAGEN_DATA,
+    "sct_row": SCTX_DELTAGEN_DATA,
+    "sct_col": SCTY_DELTAGEN_DATA,
+}
+
+
+def compact_stat(func):
+    """
+    property which is served from ETS_Dataframe.compact_stats once the raw frames were compacted away
+    """
+    name = func.__name__
+
+    def getter(self):
+        value = self.compact_stats.get(self.compact_key(name), None)
+        if value is None:
+            return func(self)
+        return value.copy() if isinstance(value, np.ndarray) else value
+
+    getter.__name__ = name
+    getter.__doc__ = func.__doc__
+    return property(getter)
+
+
+def parse_frame_slice(text):
+    """
+    parse a frame window "start:stop:step" as used by --frames, every field is optional
+    :param text: i.e. "100:400", ":300", "::2" or None
+    :return: slice object or None (all frames)
+    """
+    if text is None or text == "":
+        return None
+    fields = text.split(":")
+    if len(fields) > 3:
+        raise ValueError(f"invalid frame window {text}, expected start:stop:step")
+    try:
+        fields = [int(field) if field.strip() != "" else None for field in fields]
+    except ValueError:
+        raise ValueError(f"invalid frame window {text}, expected integers start:stop:step") from None
+    if len(fields) == 3 and fields[2] is not None and fields[2] <= 0:
+        raise ValueError(f"invalid frame window {text}, the step must be positive")
+    return slice(*fields) if len(fields) > 1 else slice(fields[0], fields[0] + 1 or None)
+
+
+def format_frame_slice(window):
+    """
+    frame window as text, the inverse of parse_frame_slice, i.e. "100:400"
+    """
+    if window is None:
+        return ":"
+    text = ":".join("" if val is None else str(val) for val in (window.start, window.stop, window.step))
+    return text[:-1] if window.step is None else text
+
+
+def parse_channels(text):
+    """
+    parse a comma separated channel list as used by --channels
+    :return: list of channel names or None (all channels)
+    """
+    if text is None or text == "":
+        return None
+    channels = [channel.strip() for channel in text.split(",") if channel.strip() != ""]
+    for channel in channels:
+        if channel not in CHANNEL_NAMES:
+            raise ValueError(f"unknown channel {channel}, choose from {CHANNEL_NAMES}")
+    return channels
+
+
 class ETS_Dataframe:
-    def __init__(self, file_path=None, Header_index=None):
+    def __init__(self, file_path=None, Header_index=None, frames=None, channels=None, raw_bytes=None,
+                 memory_budget=None):
+        """
+        :param file_path: ETS capture file
+        :param Header_index: column header definition, i.e. HEADER_ETS
+        :param frames: optional slice of frames to load, skipped rows are never tokenized
+        :param channels: optional list of channels to convert ("mct", "sct_row", "sct_col")
+        :param raw_bytes: optional content of file_path which was already read, i.e. by a prefetcher,
+                          or the csv content of a capture without file (file_path None)
+        :param memory_budget: optional MemoryBudget, archive captures are then streamed: the statistics are computed
+                              chunk by chunk and the raw frames go straight into spill files
+        """
 
         self.mct_grid = None
         self.sct_row = None
         self.sct_col = None
         self.row_num = None
         self.col_num = None
+        self.frame_num = 0
         self.Header_index = Header_index
+        self.frames = frames
+        self.channels = CHANNEL_NAMES if channels is None else list(channels)
 
-        self.file_ext = os.path.basename(file_path).split(".")[-1]
-        if self.file_ext == "csv":
-            self.data_init = self.load_data_from_ets_csv(file_path)
-        elif self.file_ext == "txt":
-            pass
-        elif self.file_ext == "json":
-            pass
+        # outlier masks per channel, True = sample excluded from statistics when apply_mask is set
+        self.masks = {}
+        self.apply_mask = False
+        self.rejected_frames = np.array([], dtype=int)
+        self.frame_score = None
 
-    def load_data_from_ets_csv(self, file_path):
-        mutual_raw = []
-        col_raw = []
-        row_raw = []
-        with open(file_path) as f:
-            reader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE)
-            for csv_line_idx, csv_line in enumerate(reader):
-                # Split comma separated data in line into list
-                # in case line end with space ""
-                if csv_line[-1] == "":
-                    csv_data = csv_line[:-1]
-                else:
-                    csv_data = csv_line
-
-                # Process header at first line
-                if csv_line_idx == 0:
-                    header = csv_data
-                    # Search header in first row to identify column indices for playback data
-                    # print(csv_data[3])
-                    for column_idx, column_str in enumerate(csv_line):
-                        # print(column_str)
-                        for idx, playback_data in enumerate(self.Header_index):
-                            # print(playback_data[1])
-                            if playback_data[1] in column_str:
-                                # print("Found start of " + column_str + " idx=" + str(column_idx))
-                                # print("Looking for end at " + str(playback_data[2]))
-                                playback_data[3] = int(column_idx)
-
-                            elif playback_data[2] in column_str:
-                                self.Header_index[idx][4] = int(column_idx)
-
-                    for playback_data in self.Header_index:
-                        if playback_data[3] > playback_data[4]:
-                            playback_data[4] = len(csv_data)
-
-                    # print(self.Header_index)
-                else:
+        # drift removed per channel, p2p of the trend per node
+        self.drift = {}
 
-                    mct_data = list(map(int, csv_data[self.Header_index[MCT_DELTAGEN_DATA][3]:
-                                                      self.Header_index[MCT_DELTAGEN_DATA][4] + 1]))
+        # per node statistics kept after compact(), raw frames are memory mapped from spill files then
+        self.compact_stats = {}
+        self.spill_paths = []
 
-                    col_data = list(map(int, csv_data[self.Header_index[SCTY_DELTAGEN_DATA][3]:
-                                                      self.Header_index[SCTY_DELTAGEN_DATA][4] + 1]))
+        self.memory_budget = memory_budget
 
-                    row_data = list(map(int, csv_data[self.Header_index[SCTX_DELTAGEN_DATA][3]:
-                                                      self.Header_index[SCTX_DELTAGEN_DATA][4] + 1]))
+        # shared memory blocks this capture is attached to with a weak reference to the view on each, see attach()
+        self.shared_blocks = []
+        # views on the buffers of a SharedFrameStore which replaced the own arrays, see share()
+        self.shared_views = {}
 
-                    mutual_raw.append(mct_data)
-                    col_raw.append(col_data)
-                    row_raw.append(row_data)
-        f.close()
+        if file_path is None:
+            # in memory capture, see from_csv_bytes / from_arrays
+            self.file_ext = None
+            if raw_bytes is not None:
+                self.data_init = self.load_data_from_ets_csv(None, raw_bytes)
+            return
 
-        # header[self.Header_index[MCT_DELTAGEN_DATA][4]]) : [row][col]
-        # header[self.Header_index[SCTX_DELTAGEN_DATA][4]] : [row]
-        # header[self.Header_index[SCTY_DELTAGEN_DATA][4]] : [col]
+        self.file_ext = os.path.basename(file_path).split(".")[-1]
+        if self.file_ext == "csv":
+            self.data_init = self.load_data_from_ets_csv(file_path, raw_bytes)
+        elif self.file_ext == ARCHIVE_EXT:
+            self.data_init = self.load_data_from_archive(file_path, raw_bytes)
+        elif self.file_ext == "txt":
+            pass
+        elif self.file_ext == "json":
+            pass
 
-        if self.Header_index[MCT_DELTAGEN_DATA][4] > self.Header_index[MCT_DELTAGEN_DATA][3]:  # if  mct data exist
-            # find the tx num and rx num using re
-            row, col = re.findall(r"[\[](.*?)[\]]", header[self.Header_index[MCT_DELTAGEN_DATA][4]])
-            self.row_num = int(row) + 1
-            self.col_num = int(col) + 1
-            self.mct_grid = np.array(mutual_raw).reshape([len(mutual_raw), self.row_num, self.col_num])
-            # self.mct_grid = self.mct_grid[:300,:,:]
-            # print(f"using {self.mct_grid.shape[0]} frames for evaluation!!")
-        else:  # only sct data
-            row = re.search(r"[\[](.*?)[\]]", header[self.Header_index[SCTX_DELTAGEN_DATA][4]]).group(1)
-            col = re.search(r"[\[](.*?)[\]]", header[self.Header_index[SCTY_DELTAGEN_DATA][4]]).group(1)
+    @classmethod
+    def from_csv_bytes(cls, raw_bytes, Header_index=None, frames=None, channels=None):
+        """
+        capture from the content of an ETS csv capture, nothing is read from or written to disk
+        :param raw_bytes: csv content as bytes
+        :param Header_index: column header definition, a fresh copy of HEADER_ETS if None
+        """
+        if Header_index is None:
+            Header_index = new_header_index()
+        return cls(Header_index=Header_index, frames=frames, channels=channels, raw_bytes=raw_bytes)
+
+    @classmethod
+    def from_arrays(cls, mct=None, sct_row=None, sct_col=None, frames=None, channels=None):
+        """
+        capture from frames which are already in memory, i.e. from the acquisition driver
+        :param mct: mutual frames [frames, rows, cols]
+        :param sct_row: self cap row frames [frames, rows]
+        :param sct_col: self cap column frames [frames, cols]
+        :param frames: optional slice of frames to keep
+        :param channels: optional list of channels to keep
+        """
+        Frame = cls(channels=channels)
+        for channel, data in [("mct", mct), ("sct_row", sct_row), ("sct_col", sct_col)]:
+            if data is None or channel not in Frame.channels:
+                continue
+            data = np.asarray(data)
+            if frames is not None:
+                data = data[frames]
+            setattr(Frame, CHANNEL_DATA[channel], data)
+            Frame.frame_num = data.shape[0]
+
+        if mct is not None:
+            Frame.row_num, Frame.col_num = np.shape(mct)[1:]
+        else:
+            Frame.row_num = None if sct_row is None else np.shape(sct_row)[1]
+            Frame.col_num = None if sct_col is None else np.shape(sct_col)[1]
+        return Frame
+
+    @classmethod
+    def from_buffers(cls, row_num, col_num, mct=None, sct_row=None, sct_col=None, dtype=np.int16, frames=None,
+                     channels=None):
+        """
+        capture from raw driver buffers (bytes, memoryview, ...) of frame major samples, the buffers are not copied
+        :param dtype: sample type of the buffers
+        """
+        return cls.from_arrays(
+            mct=None if mct is None else np.frombuffer(mct, dtype=dtype).reshape(-1, row_num, col_num),
+            sct_row=None if sct_row is None else np.frombuffer(sct_row, dtype=dtype).reshape(-1, row_num),
+            sct_col=None if sct_col is None else np.frombuffer(sct_col, dtype=dtype).reshape(-1, col_num),
+            frames=frames, channels=channels)
+
+    def share(self, store):
+        """
+        move the raw frames and outlier masks into shared buffers of store, this capture keeps using them until
+        the store is closed, then it gets private copies back (see unshare)
+        :param store: SharedFrameStore owning the buffers
+        :return: FrameHandle, cheap to pickle, for ETS_Dataframe.attach in other processes
+        """
+        self.unshare()
+        arrays = {}
+        for channel in CHANNEL_NAMES:
+            data = self.channel_data(channel)
+            if data is not None:
+                arrays[channel], view = store.share(data, channel)
+                setattr(self, CHANNEL_DATA[channel], view)
+                self.shared_views[channel] = view
+        masks = {}
+        for channel, mask in self.masks.items():
+            masks[channel], self.masks[channel] = store.share(mask, channel + "_mask")
+            self.shared_views[channel + "_mask"] = self.masks[channel]
+        store.adopt(self)
+        return FrameHandle(arrays, masks, {name: getattr(self, name) for name in SHARED_META})
+
+    def unshare(self):
+        """
+        replace the views on shared buffers (see share) which are still in use by private copies
+        """
+        for channel in CHANNEL_NAMES:
+            data = self.channel_data(channel)
+            if data is not None and data is self.shared_views.get(channel, None):
+                setattr(self, CHANNEL_DATA[channel], np.array(data))
+        for channel, mask in self.masks.items():
+            if mask is self.shared_views.get(channel + "_mask", None):
+                self.masks[channel] = np.array(mask)
+        self.shared_views = {}
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        capture on the shared buffers of a FrameHandle, the frames are read only and never copied
+        """
+        Frame = cls(channels=handle.meta["channels"])
+        for name, value in handle.meta.items():
+            setattr(Frame, name, value)
+        for channel, array_handle in handle.arrays.items():
+            data, block = attach_array(array_handle)
+            setattr(Frame, CHANNEL_DATA[channel], data)
+            Frame.shared_blocks.append((block, weakref.ref(data)))
+        for channel, array_handle in handle.masks.items():
+            Frame.masks[channel], block = attach_array(array_handle)
+            Frame.shared_blocks.append((block, weakref.ref(Frame.masks[channel])))
+        return Frame
+
+    def detach(self):
+        """
+        drop the views on shared buffers and close the attached blocks, closing is refused while a view (or a
+        slice of it) is still referenced elsewhere since the block is unmapped by close
+        """
+        for channel in CHANNEL_NAMES:
+            setattr(self, CHANNEL_DATA[channel], None)
+        self.masks = {}
+        if any(view() is not None for block, view in self.shared_blocks if block is not None):
+            raise BufferError("views on the attached shared buffers are still referenced, drop them before detach")
+        for block, _ in self.shared_blocks:
+            if block is not None:
+                block.close()
+        self.shared_blocks = []
+
+    def select_frame_lines(self, f):
+        """
+        apply the frame window to the data lines of an opened capture without splitting them
+        """
+        if self.frames is None:
+            return f
+        if any(val is not None and val < 0 for val in (self.frames.start, self.frames.stop)):
+            # negative window needs the total frame count
+            return f.readlines()[self.frames]
+        return itertools.islice(f, self.frames.start, self.frames.stop, self.frames.step)
+
+    def load_data_from_ets_csv(self, file_path, raw_bytes=None):
+        if raw_bytes is not None:
+            f = io.StringIO(raw_bytes.decode())
+        else:
+            f = open(file_path)
+        with f:
+            # Process header at first line
+            csv_line = next(csv.reader([f.readline()], delimiter=',', quoting=csv.QUOTE_NONE))
+            # in case line end with space ""
+            if csv_line[-1] == "":
+                header = csv_line[:-1]
+            else:
+                header = csv_line
+
+            # Search header in first row to identify column indices for playback data
+            for column_idx, column_str in enumerate(csv_line):
+                for idx, playback_data in enumerate(self.Header_index):
+                    if playback_data[1] in column_str:
+                        playback_data[3] = int(column_idx)
+
+                    elif playback_data[2] in column_str:
+                        self.Header_index[idx][4] = int(column_idx)
+
+            for playback_data in self.Header_index:
+                if playback_data[3] > playback_data[4]:
+                    playback_data[4] = len(header)
+
+            # header[self.Header_index[MCT_DELTAGEN_DATA][4]]) : [row][col]
+            # header[self.Header_index[SCTX_DELTAGEN_DATA][4]] : [row]
+            # header[self.Header_index[SCTY_DELTAGEN_DATA][4]] : [col]
+
+            if self.Header_index[MCT_DELTAGEN_DATA][4] > self.Header_index[MCT_DELTAGEN_DATA][3]:  # if  mct data exist
+                # find the tx num and rx num using re
+                row, col = re.findall(r"[\[](.*?)[\]]", header[self.Header_index[MCT_DELTAGEN_DATA][4]])
+            else:  # only sct data
+                row = re.search(r"[\[](.*?)[\]]", header[self.Header_index[SCTX_DELTAGEN_DATA][4]]).group(1)
+                col = re.search(r"[\[](.*?)[\]]", header[self.Header_index[SCTY_DELTAGEN_DATA][4]]).group(1)
             self.row_num = int(row) + 1
             self.col_num = int(col) + 1
 
-        if self.Header_index[SCTX_DELTAGEN_DATA][4] > self.Header_index[SCTX_DELTAGEN_DATA][3]:  # if sct row data exist
-            self.sct_row = np.array(row_raw)
-        if self.Header_index[SCTY_DELTAGEN_DATA][4] > self.Header_index[SCTY_DELTAGEN_DATA][3]:  # if sct col data exist
-            self.sct_col = np.array(col_raw)
+            # only requested channels which exist in the file are converted
+            column_ranges = []
+            for channel in self.channels:
+                playback_data = self.Header_index[CHANNEL_HEADER[channel]]
+                if playback_data[4] > playback_data[3]:
+                    node_shape = (self.row_num, self.col_num) if channel == "mct" else \
+                        (playback_data[4] + 1 - playback_data[3],)
+                    column_ranges.append((channel, playback_data[3], playback_data[4] + 1, node_shape))
+
+            # frames are converted block by block, under a memory budget every block goes straight into a spill
+            # file so the text of the whole capture is never held as python ints
+            blocks = {channel: [] for channel, _, _, _ in column_ranges}
+            rows = {channel: [] for channel, _, _, _ in column_ranges}
+            writers, running = {}, {}
+            if self.memory_budget is not None:
+                for channel, _, _, node_shape in column_ranges:
+                    path = self.memory_budget.spill_path(channel, ".raw")
+                    writers[channel] = SpillWriter(path, np.int64, node_shape)
+                    running[channel] = RunningStats(node_shape)
+                    self.spill_paths.append(path)
+
+            def flush():
+                for channel, _, _, node_shape in column_ranges:
+                    block = np.array(rows[channel], dtype=np.int64).reshape((-1,) + node_shape)
+                    rows[channel] = []
+                    if channel in writers:
+                        writers[channel].append(block)
+                        running[channel].update(block)
+                    else:
+                        blocks[channel].append(block)
+                if self.memory_budget is not None:
+                    self.memory_budget.check(f"while loading {os.path.basename(file_path or 'capture')}")
+
+            for line in self.select_frame_lines(f):
+                if line.strip() == "":
+                    continue
+                csv_data = line.rstrip("\r\n").split(",")
+                for channel, start, stop, _ in column_ranges:
+                    rows[channel].append(list(map(int, csv_data[start:stop])))
+                self.frame_num += 1
+                if self.frame_num % CSV_BLOCK_FRAMES == 0:
+                    flush()
+            if self.frame_num % CSV_BLOCK_FRAMES:
+                flush()
+
+        for channel, _, _, node_shape in column_ranges:
+            if channel in writers:
+                setattr(self, CHANNEL_DATA[channel], writers[channel].close())
+                if self.frame_num:
+                    self.set_streamed_stats(channel, running[channel].result())
+            else:
+                # blocks are released while they are copied so the capture is not held twice
+                data = np.empty((self.frame_num,) + node_shape, dtype=np.int64)
+                pos = 0
+                while blocks[channel]:
+                    block = blocks[channel].pop(0)
+                    data[pos:pos + len(block)] = block
+                    pos += len(block)
+                setattr(self, CHANNEL_DATA[channel], data)
+
+    def load_data_from_archive(self, file_path, raw_bytes=None):
+        """
+        load the requested channels and frame window from a capture archive, chunks outside of the window are
+        never decompressed
+        """
+        fileobj = io.BytesIO(raw_bytes) if raw_bytes is not None else None
+        with CaptureArchive(file_path, fileobj) as archive:
+            window = range(archive.frame_num)[self.frames] if self.frames is not None else range(archive.frame_num)
+            stream = self.memory_budget is not None and window.step == 1 and len(window) > 0
+            for channel in self.channels:
+                if channel not in archive.channels:
+                    continue
+                if stream:
+                    self.stream_channel(archive, channel)
+                else:
+                    setattr(self, CHANNEL_DATA[channel], archive.read(channel, self.frames))
+                self.frame_num = self.channel_data(channel).shape[0]
+            self.row_num = archive.meta.get("row_num", None)
+            self.col_num = archive.meta.get("col_num", None)
+
+    def set_streamed_stats(self, channel, stats):
+        """
+        fill compact_stats of a channel from statistics computed while its frames were streamed
+        :param stats: RunningStats.result()
+        """
+        prefix = CHANNEL_DATA[channel]
+        for stat in ["max", "min", "mean", "rms"]:
+            self.compact_stats[f"{prefix}_{stat}"] = stats[stat]
+        self.compact_stats["mct_signal_position" if channel == "mct" else f"{channel}_signal_position"] = \
+            stats["position"]
+
+    def stream_channel(self, archive, channel):
+        """
+        fill compact_stats of a channel from the streamed archive statistics and memory map its raw frames from a
+        spill file, so that only one chunk of the capture is in memory at a time
+        """
+        self.set_streamed_stats(channel, archive.stream_stats(channel, self.frames))
+        path = self.memory_budget.spill_path(channel)
+        setattr(self, CHANNEL_DATA[channel], archive.spill(channel, path, self.frames))
+        self.spill_paths.append(path)
+
+    def channel_data(self, channel):
+        return getattr(self, CHANNEL_DATA[channel])
+
+    def active_mask(self, channel):
+        if not self.apply_mask:
+            return None
+        return self.masks.get(channel, None)
+
+    def detrend(self, method="poly", param=1):
+        """
+        remove slow baseline drift over frames from every channel before noise statistics are computed
+        :param method: "poly" (per node polynomial of order param) or "movavg" (moving baseline of param frames)
+        :return: dict channel -> drift p2p per node
+        """
+        # statistics of the frames before drift removal are stale
+        self.compact_stats = {}
+        for channel in CHANNEL_NAMES:
+            data = self.channel_data(channel)
+            if data is None:
+                continue
+            detrended, self.drift[channel] = detrend_frames(data, method, param)
+            setattr(self, CHANNEL_DATA[channel], detrended)
+        return self.drift
+
+    def detect_outliers(self, z_threshold=6.0, frame_fraction=0.05, apply_mask=True):
+        """
+        Detect spike nodes (robust z-score per node over frames) and glitch frames (fraction of spike nodes).
+        A frame is rejected in all channels when any channel rejects it.
+        :param z_threshold: robust z-score above which a sample is an outlier
+        :param frame_fraction: fraction of outlier nodes above which the whole frame is rejected
+        :param apply_mask: compute the statistics with the mask applied from now on
+        :return: array of rejected frame indices
+        """
+        # cached masked statistics belong to the previous masks
+        self.compact_stats = {}
+        results = {}
+        frame_score = None
+        for channel in CHANNEL_NAMES:
+            data = self.channel_data(channel)
+            if data is None:
+                continue
+            results[channel] = detect_outliers(data, z_threshold=z_threshold)
+            score = results[channel].frame_score
+            frame_score = score if frame_score is None else np.maximum(frame_score, score)
+
+        if frame_score is None:
+            return self.rejected_frames
+        rejected = frame_score > frame_fraction
+        self.frame_score = frame_score
+        self.rejected_frames = np.flatnonzero(rejected)
+        self.masks = {channel: build_mask(result.node_mask, rejected) for channel, result in results.items()}
+        self.apply_mask = apply_mask
+        return self.rejected_frames
+
+    def compact_key(self, name):
+        return name + "#masked" if self.apply_mask and len(self.masks) > 0 else name
+
+    def cache_stats(self):
+        """
+        compute the per node statistics of every channel once (raw and masked), later reads are served from
+        compact_stats
+        """
+        names = []
+        for channel in CHANNEL_NAMES:
+            if self.channel_data(channel) is None:
+                continue
+            prefix = CHANNEL_DATA[channel]
+            names.extend(f"{prefix}_{stat}" for stat in ["max", "min", "mean", "rms"])
+            names.append("mct_signal_position" if channel == "mct" else f"{channel}_signal_position")
+
+        apply_mask = self.apply_mask
+        for masked in ([False, True] if len(self.masks) > 0 else [apply_mask]):
+            self.apply_mask = masked
+            for name in names:
+                # statistics streamed at load time are kept
+                if self.compact_key(name) not in self.compact_stats:
+                    self.compact_stats[self.compact_key(name)] = getattr(self, name)
+        self.apply_mask = apply_mask
+
+    @property
+    def nbytes(self):
+        """
+        memory held by raw frames, masks and cached statistics
+        """
+        arrays = [self.channel_data(channel) for channel in CHANNEL_NAMES] + list(self.masks.values())
+        arrays += [val for val in self.compact_stats.values() if isinstance(val, np.ndarray)]
+        return sum(array.nbytes for array in arrays if array is not None and not isinstance(array, np.memmap))
+
+    def compact(self, budget):
+        """
+        Keep only per node statistics in memory and spill the raw frames (and outlier masks) to memory mapped
+        files, consumers which really need raw frames (raw grid export, bootstrap) read them from disk.
+        :param budget: MemoryBudget providing the spill folder
+        """
+        self.cache_stats()
+
+        for channel in CHANNEL_NAMES:
+            data = self.channel_data(channel)
+            if data is None or isinstance(data, np.memmap):
+                continue
+            path = budget.spill_path(channel)
+            setattr(self, CHANNEL_DATA[channel], spill_array(data, path))
+            self.spill_paths.append(path)
+        for channel, mask in self.masks.items():
+            if not isinstance(mask, np.memmap):
+                path = budget.spill_path(channel + "_mask")
+                self.masks[channel] = spill_array(mask, path)
+                self.spill_paths.append(path)
+
+    def channel_stats(self, channel, masked=False):
+        """
+        per node statistics of a channel, raw or with the outlier mask applied
+        :return: dict max, min, mean, p2p, rms
+        """
+        prefix = CHANNEL_DATA[channel]
+        apply_mask = self.apply_mask
+        self.apply_mask = masked
+        try:
+            return {stat: getattr(self, f"{prefix}_{stat}") for stat in ["max", "min", "mean", "p2p", "rms"]}
+        finally:
+            self.apply_mask = apply_mask
+
+    def channel_pctl(self, channel, lo=0.1, hi=99.9):
+        """
+        Robust spread noise per node, percentile hi - percentile lo over frames (with the outlier mask applied
+        when active). Results are kept in compact_stats, so every spread is only computed once.
+        """
+        key = self.compact_key(f"{CHANNEL_DATA[channel]}_pctl_{lo:g}_{hi:g}")
+        if key not in self.compact_stats:
+            self.compact_stats[key] = percentile_spread(self.channel_data(channel), lo, hi, self.active_mask(channel))
+        return self.compact_stats[key].copy()
+
+    def mct_grid_pctl(self, lo=0.1, hi=99.9):
+        return self.channel_pctl("mct", lo, hi)
+
+    def sct_row_pctl(self, lo=0.1, hi=99.9):
+        return self.channel_pctl("sct_row", lo, hi)
+
+    def sct_col_pctl(self, lo=0.1, hi=99.9):
+        return self.channel_pctl("sct_col", lo, hi)
 
     # *******************************************************************
     # ************    mutual grid field *********************************
     # *******************************************************************
-    @property
+    @compact_stat
     def mct_grid_max(self):
+        mask = self.active_mask("mct")
+        if mask is not None:
+            return masked_max(self.mct_grid, mask)
         return self.mct_grid.max(axis=0)
 
-    @property
+    @compact_stat
     def mct_grid_min(self):
+        mask = self.active_mask("mct")
+        if mask is not None:
+            return masked_min(self.mct_grid, mask)
         return self.mct_grid.min(axis=0)
 
-    @property
+    @compact_stat
     def mct_grid_mean(self):
+        mask = self.active_mask("mct")
+        if mask is not None:
+            return masked_mean(self.mct_grid, mask)
         return self.mct_grid.mean(axis=0)
 
     @property
     def mct_grid_p2p(self):
         return self.mct_grid_max - self.mct_grid_min
 
-    @property
+    @compact_stat
     def mct_grid_rms(self):
+        mask = self.active_mask("mct")
+        if mask is not None:
+            return masked_rms(self.mct_grid, mask)
         # alternative method
         # return np.sqrt(((self.mct_grid - self.mct_grid_mean) ** 2).mean(axis=0))
         return np.sqrt(np.var(self.mct_grid, axis=0))
 
-    @property
+    @compact_stat
     def mct_signal_position(self):
+        mask = self.active_mask("mct")
+        if mask is not None:
+            return masked_signal_position(self.mct_grid, mask)
         n, y_node, x_node = np.unravel_index(self.mct_grid.argmax(), self.mct_grid.shape)
         return n, y_node, x_node
 
@@ -166,29 +658,44 @@ class ETS_Dataframe:
     # ************************    self cap row field ********************
     # *******************************************************************
 
-    @property
+    @compact_stat
     def sct_row_max(self):
+        mask = self.active_mask("sct_row")
+        if mask is not None:
+            return masked_max(self.sct_row, mask)
         return self.sct_row.max(axis=0)
 
-    @property
+    @compact_stat
     def sct_row_min(self):
+        mask = self.active_mask("sct_row")
+        if mask is not None:
+            return masked_min(self.sct_row, mask)
         return self.sct_row.min(axis=0)
 
-    @property
+    @compact_stat
     def sct_row_mean(self):
+        mask = self.active_mask("sct_row")
+        if mask is not None:
+            return masked_mean(self.sct_row, mask)
         return self.sct_row.mean(axis=0)
 
     @property
     def sct_row_p2p(self):
         return self.sct_row_max - self.sct_row_min
 
-    @property
+    @compact_stat
     def sct_row_rms(self):
+        mask = self.active_mask("sct_row")
+        if mask is not None:
+            return masked_rms(self.sct_row, mask)
         # alternative method
         return np.sqrt(np.var(self.sct_row, axis=0))
 
-    @property
+    @compact_stat
     def sct_row_signal_position(self):
+        mask = self.active_mask("sct_row")
+        if mask is not None:
+            return masked_signal_position(self.sct_row, mask)
         n, x_node = np.unravel_index(self.sct_row.argmax(), self.sct_row.shape)
         return n, x_node
 
@@ -211,29 +718,44 @@ class ETS_Dataframe:
     # ************************  self cap columns field ******************
     # *******************************************************************
 
-    @property
+    @compact_stat
     def sct_col_max(self):
+        mask = self.active_mask("sct_col")
+        if mask is not None:
+            return masked_max(self.sct_col, mask)
         return self.sct_col.max(axis=0)
 
-    @property
+    @compact_stat
     def sct_col_min(self):
+        mask = self.active_mask("sct_col")
+        if mask is not None:
+            return masked_min(self.sct_col, mask)
         return self.sct_col.min(axis=0)
 
-    @property
+    @compact_stat
     def sct_col_mean(self):
+        mask = self.active_mask("sct_col")
+        if mask is not None:
+            return masked_mean(self.sct_col, mask)
         return self.sct_col.mean(axis=0)
 
     @property
     def sct_col_p2p(self):
         return self.sct_col_max - self.sct_col_min
 
-    @property
+    @compact_stat
     def sct_col_rms(self):
+        mask = self.active_mask("sct_col")
+        if mask is not None:
+            return masked_rms(self.sct_col, mask)
         # alternative method
         return np.sqrt(np.var(self.sct_col, axis=0))
 
-    @property
+    @compact_stat
     def sct_col_signal_position(self):
+        mask = self.active_mask("sct_col")
+        if mask is not None:
+            return masked_signal_position(self.sct_col, mask)
         n, y_node = np.unravel_index(self.sct_col.argmax(), self.sct_col.shape)
         return n, y_node
 
@@ -0,0 +1,102 @@
+"""Module providing shard selection and partial result files for multi node batch runs """
+
+import os
+import re
+import json
+import glob
+import socket
+import datetime
+from result_files import safe_name, restore_summary, write_json
+
+PARTIAL_FORMAT = "ets_snr_partial_v1"
+PARTIAL_EXT = ".partial.json"
+
+
+def parse_shard(text):
+    """
+    parse a shard spec "index/count" with 0 based index, i.e. "2/8"
+    :return: (index, count)
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", text)
+    if match is None:
+        raise ValueError(f"invalid shard {text}, expected index/count i.e. 0/4")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        raise ValueError(f"invalid shard {text}, index must be in 0..count-1")
+    return index, count
+
+
+def read_manifest(manifest_path):
+    """
+    read a pattern manifest, one pattern folder per line, empty lines and lines starting with # are ignored
+    :return: list of pattern folders
+    """
+    patterns = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if line != "" and not line.startswith("#"):
+                patterns.append(line)
+    return patterns
+
+
+def select_shard(patterns, index, count):
+    """
+    round robin share of the patterns for one worker, the global order of each pattern is kept
+    :return: list of (order, pattern)
+    """
+    return [(order, pattern) for order, pattern in enumerate(patterns) if order % count == index]
+
+
+def write_partial(partial_dir, order, pattern, dataset, output_folder, touch_num, summaries, final_result,
+                  shard=None):
+    """
+    write the self describing partial result of one pattern
+    :param order: position of the pattern in the full pattern list, used to restore single node ordering
+    :param output_folder: folder the vendor csv files of this pattern belong to
+    :param summaries: dict vendor -> summary
+    :param final_result: row of result_summary.csv or None
+    :return: path of the partial file
+    """
+    if not os.path.exists(partial_dir):
+        os.makedirs(partial_dir, exist_ok=True)
+    partial = {
+        "format": PARTIAL_FORMAT,
+        "order": order,
+        "pattern": pattern,
+        "dataset": dataset,
+        "output_folder": output_folder,
+        "touch_num": touch_num,
+        "shard": shard,
+        "host": socket.gethostname(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "summaries": summaries,
+        "final_result": final_result,
+    }
+    # written then renamed so a merge never sees half written files
+    return write_json(os.path.join(partial_dir, f"{order:06d}_{safe_name(pattern)}{PARTIAL_EXT}"), partial)
+
+
+def load_partials(partial_dirs):
+    """
+    load every partial result in the given folders, sorted as a single node run would produce them
+    a pattern found several times keeps its most recent partial
+    :param partial_dirs: folder or list of folders
+    :return: list of partial dicts
+    """
+    if isinstance(partial_dirs, str):
+        partial_dirs = [partial_dirs]
+    partials = {}
+    for partial_dir in partial_dirs:
+        for path in glob.glob(os.path.join(partial_dir, "*" + PARTIAL_EXT)):
+            with open(path, encoding="UTF8") as f:
+                partial = json.load(f)
+            if partial.get("format") != PARTIAL_FORMAT:
+                print(f"skip {path}, unknown format")
+                continue
+            key = (partial["order"], partial["pattern"])
+            if key not in partials or partials[key]["created"] <= partial["created"]:
+                partial["summaries"] = {vendor: restore_summary(summary)
+                                        for vendor, summary in partial["summaries"].items()}
+                partials[key] = partial
+    return [partials[key] for key in sorted(partials)]
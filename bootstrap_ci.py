@@ -0,0 +1,269 @@
+"""Module providing blocked bootstrap confidence intervals for snr figures """
+
+import math
+import numpy as np
+from metric_plan import CHANNELS, RATIOS, PlanContext, available_channels
+from outlier_detection import masked_max, masked_min, masked_mean, masked_rms
+from percentile_noise import percentile_spread
+
+# memory allowed for one batch of resampled no touch frames
+BOOTSTRAP_BATCH_BYTES = 256 * 1024 * 1024
+# peak memory of a no touch batch in multiples of batch_bytes (gathered samples plus the float reduction copies)
+BOOTSTRAP_BATCH_TEMPORARIES = 3
+
+
+def block_bootstrap_indices(frame_num, resamples, block_len, rng):
+    """
+    Circular blocked bootstrap: every resample is built from randomly placed blocks of consecutive frames,
+    which keeps the temporal correlation of the noise inside each block.
+    :param frame_num: number of frames in the capture
+    :param resamples: number of resamples
+    :param block_len: frames per block
+    :param rng: numpy Generator
+    :return: int array [resamples, frame_num] of frame indices
+    """
+    block_len = max(1, min(int(block_len), frame_num))
+    block_num = math.ceil(frame_num / block_len)
+    starts = rng.integers(0, frame_num, size=(resamples, block_num))
+    idx = (starts[:, :, None] + np.arange(block_len)) % frame_num
+    return idx.reshape(resamples, block_num * block_len)[:, :frame_num]
+
+
+def _flat_frames(data):
+    """
+    view capture data as [frames, nodes]
+    """
+    return data.reshape(data.shape[0], -1)
+
+
+def _frame_stats(data, mask, noise):
+    """
+    per node statistics over frames (axis 0) computed like ETS_Dataframe does for the analysis: masked samples are
+    left out and the p2p noise term is the percentile spread when noise is set
+    :param data: [frames, ...] samples
+    :param mask: optional bool mask like data, True = excluded
+    :param noise: optional (lo, hi) percentiles, see percentile_noise.parse_noise
+    :return: dict max, min, mean, rms, spread of [...] float arrays, nan where every sample is masked
+    """
+    if mask is None:
+        stats = {"max": data.max(axis=0), "min": data.min(axis=0), "mean": data.mean(axis=0),
+                 "rms": np.sqrt(np.var(data, axis=0))}
+    else:
+        stats = {"max": masked_max(data, mask), "min": masked_min(data, mask), "mean": masked_mean(data, mask),
+                 "rms": masked_rms(data, mask)}
+    stats = {key: np.asarray(val, dtype=float) for key, val in stats.items()}
+    if noise is None:
+        stats["spread"] = stats["max"] - stats["min"]
+    else:
+        stats["spread"] = percentile_spread(data, noise[0], noise[1], mask)
+    if mask is not None:
+        # a resample may consist of masked samples only
+        empty = mask.all(axis=0)
+        for val in stats.values():
+            val[empty] = np.nan
+    return stats
+
+
+def _sliding_extreme(data, width, reduce):
+    """
+    circular sliding window reduction over frames: out[s] = reduce of frames s .. s + width - 1 (mod frames)
+    :param data: [frames, nodes]
+    :param width: window length in frames, 1 <= width <= frames
+    :param reduce: np.maximum or np.minimum
+    :return: [frames, nodes]
+    """
+    frame_num = data.shape[0]
+    level = np.concatenate([data, data[:width - 1]])
+    span = 1
+    # level[i] covers frames i .. i + span - 1, doubled until span is the largest power of two <= width
+    while 2 * span <= width:
+        level = reduce(level[:-span], level[span:])
+        span *= 2
+    return reduce(level[:frame_num], level[width - span:width - span + frame_num])
+
+
+def _resampled_notouch_p2p(frames, mask, idx, block_len, nodes, noise, batch_bytes, check=None):
+    """
+    p2p noise of resampled no touch frames at the touched nodes and over the full screen. Without a percentile noise
+    term the max and min of every possible block are computed once per node, so a resample only reduces over its
+    gathered block extremes instead of all its frames.
+    :param frames: [frames, nodes] no touch data
+    :param mask: optional [frames, nodes] outlier mask
+    :param idx: [resamples, frames] bootstrap indices, see block_bootstrap_indices
+    :param block_len: frames per bootstrap block used for idx
+    :param nodes: flat indices of touched nodes
+    :param noise: optional (lo, hi) percentiles of the noise term
+    :param check: optional check(what) called while a batch is held in memory, i.e. MemoryBudget.check
+    :return: ([resamples, touches], [resamples])
+    """
+    if noise is not None:
+        p2p = _resampled_percentile_spread(frames, mask, idx, noise, batch_bytes, check)
+    else:
+        resamples, frame_num = idx.shape
+        block_len = max(1, min(int(block_len), frame_num))
+        # first frame of every block, the last block is cut to the remaining frames
+        starts = idx[:, ::block_len]
+        block_num = starts.shape[1]
+        last_len = frame_num - (block_num - 1) * block_len
+        node_num = frames.shape[1]
+        chunk = min(node_num, max(1, batch_bytes // (resamples * block_num * 8)))
+        batch = max(1, batch_bytes // (block_num * chunk * 8))
+        p2p = np.empty((resamples, node_num))
+        for col in range(0, node_num, chunk):
+            data = np.asarray(frames[:, col:col + chunk])
+            if mask is None:
+                high, low = data, data
+            else:
+                # masked samples never win the max or min
+                high = np.where(mask[:, col:col + chunk], -np.inf, data)
+                low = np.where(mask[:, col:col + chunk], np.inf, data)
+            block_max = _sliding_extreme(high, block_len, np.maximum)
+            block_min = _sliding_extreme(low, block_len, np.minimum)
+            last_max = block_max if last_len == block_len else _sliding_extreme(high, last_len, np.maximum)
+            last_min = block_min if last_len == block_len else _sliding_extreme(low, last_len, np.minimum)
+            for start in range(0, resamples, batch):
+                batch_starts = starts[start:start + batch]
+                grid_max = last_max[batch_starts[:, -1]]
+                grid_min = last_min[batch_starts[:, -1]]
+                if block_num > 1:
+                    grid_max = np.maximum(grid_max, block_max[batch_starts[:, :-1]].max(axis=1))
+                    grid_min = np.minimum(grid_min, block_min[batch_starts[:, :-1]].min(axis=1))
+                if check is not None:
+                    check(f"in bootstrap batch of {len(batch_starts)} no touch resamples")
+                spread = np.asarray(grid_max - grid_min, dtype=float)
+                if mask is not None:
+                    # a resample may consist of masked samples only
+                    spread[np.isinf(grid_max)] = np.nan
+                p2p[start:start + batch, col:col + chunk] = spread
+    with np.errstate(invalid="ignore"):
+        p2p_fullscreen = np.nanmax(p2p, axis=1)
+    return p2p[:, nodes], p2p_fullscreen
+
+
+def _resampled_percentile_spread(frames, mask, idx, noise, batch_bytes, check=None):
+    """
+    percentile spread of every resample of the no touch frames, the resampled frames are gathered batch by batch
+    :return: [resamples, nodes], nan where every sample of a resample is masked
+    """
+    resamples = idx.shape[0]
+    batch = max(1, batch_bytes // max(1, idx.shape[1] * frames.shape[1] * 8))
+    p2p = np.empty((resamples, frames.shape[1]))
+    for start in range(0, resamples, batch):
+        # [frames, batch, nodes], keeps the data dtype
+        resampled = frames[idx[start:start + batch]].transpose(1, 0, 2)
+        resampled_mask = None if mask is None else mask[idx[start:start + batch]].transpose(1, 0, 2)
+        spread = percentile_spread(resampled, noise[0], noise[1], resampled_mask)
+        if check is not None:
+            check(f"in bootstrap batch of {resampled.shape[1]} no touch resamples")
+        if resampled_mask is not None:
+            spread[resampled_mask.all(axis=0)] = np.nan
+        p2p[start:start + batch] = spread
+    return p2p
+
+
+def bootstrap_channel(analysis, channel, resamples, block_len, rng, batch_bytes=BOOTSTRAP_BATCH_BYTES, check=None,
+                      headroom=None):
+    """
+    Resample every capture of one channel and compute all snr ratios per touch and resample. The point estimates
+    are read through the metric plan context, the resamples use the same outlier masks and noise term.
+    :param check: optional check(what) called at the memory peaks, i.e. MemoryBudget.check
+    :param headroom: optional headroom() -> bytes left of the memory budget, limits batch_bytes when the no touch
+                     resamples start
+    :return: (point estimates dict ratio -> [touches], resampled dict ratio -> [resamples, touches])
+    """
+    spec = CHANNELS[channel]
+    ctx = PlanContext(analysis, channel, analysis.noise)
+    NoTouchFrame = analysis.NoTouchFrame
+    notouch = _flat_frames(getattr(NoTouchFrame, spec.data))
+    notouch_mask = NoTouchFrame.active_mask(channel)
+    notouch_mask = None if notouch_mask is None else _flat_frames(notouch_mask)
+    node_shape = getattr(NoTouchFrame, spec.data).shape[1:]
+
+    positions = []
+    nodes = []
+    touch_series = []
+    touch_masks = []
+    for TouchFrame in analysis.TouchFrameSets:
+        position = tuple(int(idx) for idx in getattr(TouchFrame, spec.position)[1:])
+        node = int(np.ravel_multi_index(position, node_shape))
+        positions.append(position)
+        nodes.append(node)
+        touch_series.append(_flat_frames(getattr(TouchFrame, spec.data))[:, node])
+        mask = TouchFrame.active_mask(channel)
+        touch_masks.append(None if mask is None else _flat_frames(mask)[:, node])
+
+    # point estimates on the original frames, the same values as in the vendor reports
+    point = {"signal_max": [], "signal_min": [], "signal_mean": [], "noise_p2p_touch": [], "noise_rms_touch": []}
+    for TouchFrame, position in zip(analysis.TouchFrameSets, positions):
+        point["signal_max"].append(ctx.stat(TouchFrame, "max")[position])
+        point["signal_min"].append(ctx.stat(TouchFrame, "min")[position])
+        point["signal_mean"].append(ctx.stat(TouchFrame, "mean")[position])
+        point["noise_p2p_touch"].append(ctx.spread(TouchFrame)[position])
+        point["noise_rms_touch"].append(ctx.stat(TouchFrame, "rms")[position])
+    point = {key: np.array(val, dtype=float)[None, :] for key, val in point.items()}
+    notouch_p2p = ctx.spread(NoTouchFrame)
+    point["noise_p2p_notouch"] = np.array([notouch_p2p[position] for position in positions], dtype=float)[None, :]
+    point["noise_p2p_fullscreen"] = np.full((1, len(nodes)), notouch_p2p.max(), dtype=float)
+
+    # resampled estimates, one index tensor per capture covering all its resamples
+    boot = {"signal_max": [], "signal_min": [], "signal_mean": [], "noise_p2p_touch": [], "noise_rms_touch": []}
+    for series, mask in zip(touch_series, touch_masks):
+        idx = block_bootstrap_indices(len(series), resamples, block_len, rng)
+        with np.errstate(invalid="ignore"):
+            stats = _frame_stats(series[idx].T, None if mask is None else mask[idx].T, ctx.noise)
+        boot["signal_max"].append(stats["max"])
+        boot["signal_min"].append(stats["min"])
+        boot["signal_mean"].append(stats["mean"])
+        boot["noise_p2p_touch"].append(stats["spread"])
+        boot["noise_rms_touch"].append(stats["rms"])
+        if check is not None:
+            check(f"in bootstrap of {channel} touch resamples")
+    boot = {key: np.stack(val, axis=1) for key, val in boot.items()}  # [resamples, touches]
+    notouch_idx = block_bootstrap_indices(notouch.shape[0], resamples, block_len, rng)
+    if headroom is not None:
+        # the resampled p2p and the pages of spilled no touch frames become resident next to the batches
+        fixed = resamples * notouch.shape[1] * 8 + (notouch.nbytes if isinstance(notouch, np.memmap) else 0)
+        batch_bytes = min(batch_bytes, max((headroom() - fixed) // BOOTSTRAP_BATCH_TEMPORARIES, 1))
+    boot["noise_p2p_notouch"], p2p_fullscreen = _resampled_notouch_p2p(notouch, notouch_mask, notouch_idx, block_len,
+                                                                       nodes, ctx.noise, batch_bytes, check)
+    boot["noise_p2p_fullscreen"] = np.repeat(p2p_fullscreen[:, None], len(nodes), axis=1)
+
+    point_ratios = {}
+    boot_ratios = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for ratio, (signal, noise) in RATIOS.items():
+            point_ratios[ratio + "_dB"] = 20 * np.log10(point[signal] / point[noise])[0]
+            boot_ratios[ratio + "_dB"] = 20 * np.log10(boot[signal] / boot[noise])
+    return point_ratios, boot_ratios
+
+
+def bootstrap_snr(analysis, resamples=1000, block_len=16, level=0.95, seed=0, check=None, headroom=None):
+    """
+    Confidence intervals of every per touch snr metric and of the final minima over touches.
+    :param analysis: AnalyseData instance
+    :param resamples: number of bootstrap resamples
+    :param block_len: frames per bootstrap block
+    :param level: confidence level, i.e. 0.95
+    :param seed: random seed, results are reproducible for the same seed
+    :param check: optional check(what) called at the memory peaks, i.e. MemoryBudget.check
+    :param headroom: optional headroom() -> bytes left of the memory budget, i.e. MemoryBudget.headroom
+    :return: list of rows [channel, touch, metric, point, ci_low, ci_high, std]
+    """
+    rng = np.random.default_rng(seed)
+    lo_pct, hi_pct = 50 * (1 - level), 50 * (1 + level)
+    rows = []
+    for channel in available_channels(analysis):
+        point, boot = bootstrap_channel(analysis, channel, resamples, block_len, rng, check=check,
+                                        headroom=headroom)
+        for metric in point:
+            ci_low, ci_high = np.nanpercentile(boot[metric], [lo_pct, hi_pct], axis=0)
+            std = np.nanstd(boot[metric], axis=0)
+            for touch_idx in range(len(point[metric])):
+                rows.append([channel, f"Touch {touch_idx + 1}", metric, point[metric][touch_idx],
+                             ci_low[touch_idx], ci_high[touch_idx], std[touch_idx]])
+            # final result is the minimum over touches, taken inside every resample
+            boot_min = np.nanmin(boot[metric], axis=1)
+            min_low, min_high = np.nanpercentile(boot_min, [lo_pct, hi_pct])
+            rows.append([channel, "min", "min_" + metric, np.nanmin(point[metric]), min_low, min_high,
+                         np.nanstd(boot_min)])
+    return rows
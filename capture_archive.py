@@ -0,0 +1,379 @@
+"""Module providing a chunked compressed archive format for capture tensors with random frame access """
+
+import os
+import sys
+import json
+import glob
+import time
+import zlib
+import lzma
+import struct
+import argparse
+import numpy as np
+
+ARCHIVE_EXT = "etsz"
+ARCHIVE_FORMAT = "ets_capture_archive_v1"
+MAGIC = b"ETSZ\x00\x01\r\n"
+# footer: offset of the chunk index, magic
+FOOTER = struct.Struct("<Q8s")
+
+DEFAULT_CHUNK_FRAMES = 256
+
+
+def _zstd():
+    import zstandard
+    return zstandard
+
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame
+
+
+# codec -> (compress, decompress), zstd and lz4 are optional packages, zlib and lzma are always there
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=6 if level is None else level), lzma.decompress),
+    "zstd": (lambda data, level: _zstd().ZstdCompressor(level=3 if level is None else level).compress(data),
+             lambda data: _zstd().ZstdDecompressor().decompress(data)),
+    "lz4": (lambda data, level: _lz4().compress(data, compression_level=0 if level is None else level),
+            lambda data: _lz4().decompress(data)),
+}
+
+
+def available_codecs():
+    ret = ["zlib", "lzma"]
+    for codec, probe in [("zstd", _zstd), ("lz4", _lz4)]:
+        try:
+            probe()
+            ret.append(codec)
+        except ImportError:
+            pass
+    return ret
+
+
+def resolve_codec(codec):
+    """
+    "auto" picks zstd, then lz4, then the zlib fallback of the standard library
+    """
+    codecs = available_codecs()
+    if codec == "auto":
+        return next(name for name in ["zstd", "lz4", "zlib"] if name in codecs)
+    if codec not in CODECS:
+        raise ValueError(f"unknown codec {codec}, choose from {list(CODECS)} or auto")
+    if codec not in codecs:
+        raise ValueError(f"codec {codec} needs an optional package which is not installed, available: {codecs}")
+    return codec
+
+
+def smallest_int_dtype(data):
+    """
+    smallest signed integer type holding all values of data, float data keeps its type
+    """
+    if not np.issubdtype(data.dtype, np.integer) or data.size == 0:
+        return data.dtype
+    lo, hi = data.min(), data.max()
+    for dtype in [np.int8, np.int16, np.int32]:
+        if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def write_archive(path, channels, chunk_frames=DEFAULT_CHUNK_FRAMES, codec="auto", level=None, meta=None):
+    """
+    Write capture tensors as independently compressed chunks of chunk_frames frames plus a chunk index.
+    :param path: archive file
+    :param channels: dict channel -> [frames, ...nodes] array, i.e. {"mct": grid, "sct_row": ..., "sct_col": ...}
+    :param codec: "zlib", "lzma", "zstd", "lz4" or "auto"
+    :param level: compression level of the codec, codec default if None
+    :param meta: optional json serializable dict stored with the archive, i.e. source file name
+    :return: archive header dict
+    """
+    codec = resolve_codec(codec)
+    compress = CODECS[codec][0]
+    frame_num = max([data.shape[0] for data in channels.values()], default=0)
+    header = {"format": ARCHIVE_FORMAT, "codec": codec, "chunk_frames": chunk_frames, "frame_num": frame_num,
+              "channels": {}, "meta": meta or {}}
+    index = {}
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for channel, data in channels.items():
+            data = np.asarray(data)
+            dtype = smallest_int_dtype(data)
+            header["channels"][channel] = {"dtype": dtype.str, "node_shape": list(data.shape[1:])}
+            index[channel] = []
+            for start in range(0, data.shape[0], chunk_frames):
+                block = np.ascontiguousarray(data[start:start + chunk_frames], dtype=dtype)
+                payload = compress(block.tobytes(), level)
+                index[channel].append([f.tell(), len(payload), start, block.shape[0]])
+                f.write(payload)
+
+        index_offset = f.tell()
+        f.write(json.dumps({"header": header, "index": index}).encode())
+        f.write(FOOTER.pack(index_offset, MAGIC))
+    os.replace(tmp_path, path)
+    return header
+
+
+class RunningStats:
+    def __init__(self, node_shape):
+        """
+        per node statistics over frames which arrive block by block, only one block is held in memory
+        :param node_shape: shape of one frame
+        """
+        self.max = np.full(node_shape, np.iinfo(np.int64).min)
+        self.min = np.full(node_shape, np.iinfo(np.int64).max)
+        self.total = np.zeros(node_shape)
+        self.total_sq = np.zeros(node_shape)
+        self.count = 0
+        self.position = None
+        self.peak = None
+
+    def update(self, data):
+        """
+        :param data: next frames [frames, ...nodes]
+        """
+        if len(data) == 0:
+            return
+        np.maximum(self.max, data.max(axis=0), out=self.max)
+        np.minimum(self.min, data.min(axis=0), out=self.min)
+        # first max in frame major order, a later block only wins with a larger value
+        flat = int(data.argmax())
+        if self.peak is None or data.reshape(-1)[flat] > self.peak:
+            self.peak = data.reshape(-1)[flat]
+            index = np.unravel_index(flat, data.shape)
+            self.position = (self.count + int(index[0]),) + tuple(int(val) for val in index[1:])
+        block = data.astype(np.float64)
+        self.total += block.sum(axis=0)
+        self.total_sq += np.square(block).sum(axis=0)
+        self.count += data.shape[0]
+
+    def result(self):
+        """
+        :return: dict of per node arrays max, min, mean, p2p and rms, plus "position": (frame, ...node) of the max
+                 sample like np.argmax on all frames
+        """
+        mean = self.total / self.count
+        return {"max": self.max, "min": self.min, "mean": mean, "p2p": self.max - self.min,
+                "rms": np.sqrt(np.maximum(self.total_sq / self.count - np.square(mean), 0.0)),
+                "position": self.position}
+
+
+class CaptureArchive:
+    def __init__(self, path, fileobj=None):
+        """
+        reader of a capture archive, only the chunk index is read on open
+        :param fileobj: optional binary file object with the archive content, i.e. io.BytesIO of prefetched bytes
+        """
+        self.path = path
+        self.f = open(path, "rb") if fileobj is None else fileobj
+        if self.f.read(len(MAGIC)) != MAGIC:
+            self.f.close()
+            raise ValueError(f"{path} is not a capture archive")
+        size = self.f.seek(0, os.SEEK_END)
+        self.f.seek(size - FOOTER.size)
+        index_offset, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        if magic != MAGIC:
+            self.f.close()
+            raise ValueError(f"{path}: truncated capture archive")
+        self.f.seek(index_offset)
+        content = json.loads(self.f.read(size - FOOTER.size - index_offset))
+        self.header = content["header"]
+        self.index = content["index"]
+        self.decompress = CODECS[resolve_codec(self.header["codec"])][1]
+        self.chunks_decoded = 0
+
+    @property
+    def frame_num(self):
+        return self.header["frame_num"]
+
+    @property
+    def channels(self):
+        return list(self.header["channels"])
+
+    @property
+    def meta(self):
+        return self.header["meta"]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read_chunk(self, channel, chunk):
+        offset, length, _, frames = self.index[channel][chunk]
+        spec = self.header["channels"][channel]
+        self.f.seek(offset)
+        self.chunks_decoded += 1
+        data = np.frombuffer(self.decompress(self.f.read(length)), dtype=np.dtype(spec["dtype"]))
+        return data.reshape([frames] + spec["node_shape"])
+
+    def iter_chunks(self, channel, start=0, stop=None):
+        """
+        yield (first frame, frames) of the chunks overlapping [start, stop), other chunks are not read
+        """
+        stop = self.frame_num if stop is None else stop
+        for chunk, (_, _, chunk_start, frames) in enumerate(self.index[channel]):
+            if chunk_start + frames <= start or chunk_start >= stop:
+                continue
+            yield chunk_start, self.read_chunk(channel, chunk)
+
+    def read(self, channel, frames=None):
+        """
+        frames of one channel, only the chunks covering the frame window are decompressed
+        :param frames: optional slice of frames
+        :return: [frames, ...nodes] array, integer frames as int64 like the csv loader
+        """
+        window = range(self.frame_num)[frames] if frames is not None else range(self.frame_num)
+        spec = self.header["channels"][channel]
+        if len(window) == 0:
+            return np.empty([0] + spec["node_shape"], dtype=np.int64)
+        lo, hi = min(window[0], window[-1]), max(window[0], window[-1]) + 1
+        parts = list(self.iter_chunks(channel, lo, hi))
+        block = np.concatenate([data for _, data in parts])
+        if np.issubdtype(block.dtype, np.integer):
+            block = block.astype(np.int64, copy=False)
+        return block[np.asarray(window) - parts[0][0]]
+
+    def stream_stats(self, channel, frames=None):
+        """
+        per node max, min, mean, p2p and rms of a channel, computed chunk by chunk so only one chunk is in memory
+        :param frames: optional slice with step 1
+        :return: see RunningStats.result
+        """
+        start, stop, step = (slice(None) if frames is None else frames).indices(self.frame_num)
+        if step != 1:
+            raise ValueError("streamed statistics need a frame window with step 1")
+
+        stats = RunningStats(self.header["channels"][channel]["node_shape"])
+        for chunk_start, data in self.iter_chunks(channel, start, stop):
+            stats.update(data[max(start - chunk_start, 0):stop - chunk_start])
+        return stats.result()
+
+    def spill(self, channel, path, frames=None):
+        """
+        write the frame window of a channel chunk by chunk into a .npy file and memory map it, the whole channel is
+        never held in memory
+        :param frames: optional slice with step 1
+        :return: read only memory mapped [frames, ...nodes] array, integer frames as int64 like read()
+        """
+        start, stop, step = (slice(None) if frames is None else frames).indices(self.frame_num)
+        if step != 1:
+            raise ValueError("spilled frames need a frame window with step 1")
+
+        spec = self.header["channels"][channel]
+        dtype = np.dtype(spec["dtype"])
+        dtype = np.dtype(np.int64) if np.issubdtype(dtype, np.integer) else dtype
+        header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                  "shape": tuple([max(stop - start, 0)] + spec["node_shape"])}
+        with open(path, "wb") as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for chunk_start, data in self.iter_chunks(channel, start, stop):
+                data = data[max(start - chunk_start, 0):stop - chunk_start]
+                f.write(np.ascontiguousarray(data, dtype=dtype).tobytes())
+        return np.load(path, mmap_mode="r")
+
+
+def convert_csv(csv_path, archive_path=None, chunk_frames=DEFAULT_CHUNK_FRAMES, codec="auto", level=None):
+    """
+    convert an ETS csv capture into an archive next to it, i.e. "wo.edl.csv" -> "wo.edl.etsz"
+    :return: archive path
+    """
+    from ETS_Dataframe import ETS_Dataframe, CHANNEL_DATA, new_header_index
+
+    if archive_path is None:
+        archive_path = os.path.splitext(csv_path)[0] + "." + ARCHIVE_EXT
+    Frame = ETS_Dataframe(csv_path, new_header_index())
+    channels = {channel: getattr(Frame, attr) for channel, attr in CHANNEL_DATA.items()
+                if getattr(Frame, attr) is not None}
+    write_archive(archive_path, channels, chunk_frames, codec, level,
+                  meta={"source": os.path.basename(csv_path), "row_num": Frame.row_num, "col_num": Frame.col_num})
+    return archive_path
+
+
+def benchmark(csv_path, chunk_frames=DEFAULT_CHUNK_FRAMES, codecs=None, repeat=3):
+    """
+    compression ratio and decode throughput of the archive codecs against parsing the csv
+    :return: list of (codec, size bytes, ratio, decode seconds, decode MB/s of raw int64 frames)
+    """
+    from ETS_Dataframe import ETS_Dataframe, CHANNEL_DATA, new_header_index
+
+    def best_time(func):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    csv_size = os.path.getsize(csv_path)
+    Frame = ETS_Dataframe(csv_path, new_header_index())
+    raw_bytes = sum(getattr(Frame, attr).nbytes for attr in CHANNEL_DATA.values() if getattr(Frame, attr) is not None)
+    csv_time = best_time(lambda: ETS_Dataframe(csv_path, new_header_index()))
+    ret = [("csv", csv_size, 1.0, csv_time, raw_bytes / csv_time / 1e6)]
+
+    for codec in codecs or available_codecs():
+        archive_path = os.path.splitext(csv_path)[0] + f".bench_{codec}.{ARCHIVE_EXT}"
+        try:
+            convert_csv(csv_path, archive_path, chunk_frames, codec)
+
+            def decode():
+                with CaptureArchive(archive_path) as archive:
+                    for channel in archive.channels:
+                        archive.read(channel)
+
+            decode_time = best_time(decode)
+            size = os.path.getsize(archive_path)
+            ret.append((codec, size, csv_size / size, decode_time, raw_bytes / decode_time / 1e6))
+        finally:
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+    return ret
+
+
+class CaptureArchiveOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="convert ETS csv captures into chunked compressed archives")
+
+        self.parser.add_argument("--convert", nargs='+', default=None,
+                                 help="csv captures or glob patterns to convert, i.e. 'dataset/*/*.edl.csv'")
+
+        self.parser.add_argument("--benchmark", nargs='+', default=None,
+                                 help="csv captures to benchmark against all available codecs")
+
+        self.parser.add_argument("--codec", type=str, default="auto",
+                                 help="zlib, lzma, zstd, lz4 or auto (zstd / lz4 if installed, zlib otherwise)")
+
+        self.parser.add_argument("--level", type=int, default=None, help="compression level, codec default if unset")
+
+        self.parser.add_argument("--chunk_frames", type=int, default=DEFAULT_CHUNK_FRAMES,
+                                 help="frames per independently compressed chunk")
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        if self.options.convert is None and self.options.benchmark is None:
+            self.parser.error("one of --convert or --benchmark is required")
+        return self.options
+
+
+if __name__ == '__main__':
+    opts = CaptureArchiveOptions().parse()
+
+    for pattern in opts.convert or []:
+        for csv_path in sorted(glob.glob(pattern)):
+            archive_path = convert_csv(csv_path, None, opts.chunk_frames, opts.codec, opts.level)
+            print(f"{csv_path} -> {archive_path}: {os.path.getsize(csv_path) / os.path.getsize(archive_path):.1f}x")
+
+    for csv_path in opts.benchmark or []:
+        print(f"{csv_path}:")
+        print(f"  {'codec':<6} {'bytes':>12} {'ratio':>7} {'decode s':>9} {'MB/s':>8}")
+        for codec, size, ratio, seconds, throughput in benchmark(csv_path, opts.chunk_frames):
+            print(f"  {codec:<6} {size:>12} {ratio:>7.1f} {seconds:>9.4f} {throughput:>8.1f}")
+    sys.exit(0)
@@ -0,0 +1,136 @@
+"""Module providing a background reader which prefetches raw capture bytes while the current capture is analysed """
+
+import os
+import time
+import queue
+import threading
+
+_END_OF_FILES = None
+
+
+class CapturePrefetcher:
+    def __init__(self, file_paths, queue_depth=2, memory_limit_mb=512):
+        """
+        Prefetch raw bytes of capture files in a background thread, files are handed out in the given order.
+        :param file_paths: all capture files in the order they are consumed (across touch files and patterns)
+        :param queue_depth: max number of files buffered ahead of the consumer
+        :param memory_limit_mb: max bytes buffered ahead of the consumer, one file is always allowed
+        """
+        self.file_paths = list(file_paths)
+        self.queue_depth = max(1, int(queue_depth))
+        self.memory_limit = int(memory_limit_mb * 1024 * 1024)
+        self.queue = queue.Queue(maxsize=self.queue_depth)
+
+        self.buffered_bytes = 0
+        self.peak_buffered_bytes = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.finished = False
+
+        # metrics
+        self.read_time = 0.0  # time the reader thread spent in I/O
+        self.wait_time = 0.0  # time the consumer was blocked waiting for data
+        self.bytes_read = 0
+        self.files_read = 0
+        self.files_skipped = 0
+
+        self.thread = threading.Thread(target=self._reader, name="capture-prefetch", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        # unblock a reader waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.05)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _reader(self):
+        for file_path in self.file_paths:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = 0
+
+            with self.condition:
+                while (not self.stopped and self.buffered_bytes > 0
+                       and self.buffered_bytes + size > self.memory_limit):
+                    self.condition.wait()
+                if self.stopped:
+                    break
+                self.buffered_bytes += size
+                self.peak_buffered_bytes = max(self.peak_buffered_bytes, self.buffered_bytes)
+
+            start = time.perf_counter()
+            try:
+                with open(file_path, "rb") as f:
+                    item = (file_path, f.read(), None, size)
+            except OSError as err:
+                item = (file_path, None, err, size)
+            self.read_time += time.perf_counter() - start
+            if item[1] is not None:
+                self.bytes_read += len(item[1])
+                self.files_read += 1
+            self.queue.put(item)
+        self.queue.put(_END_OF_FILES)
+
+    def _release(self, size):
+        with self.condition:
+            self.buffered_bytes -= size
+            self.condition.notify_all()
+
+    def take(self, file_path):
+        """
+        Return the raw bytes of the next capture. Files the consumer skipped are dropped,
+        files which were never prefetched are read directly.
+        :param file_path: capture file path, must be one of the file_paths in consumption order
+        :return: bytes of the file
+        """
+        while not self.finished:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.wait_time += time.perf_counter() - start
+            if item is _END_OF_FILES:
+                self.finished = True
+                break
+            path, data, err, size = item
+            self._release(size)
+            if path != file_path:
+                self.files_skipped += 1
+                continue
+            if err is not None:
+                raise err
+            return data
+
+        start = time.perf_counter()
+        with open(file_path, "rb") as f:
+            data = f.read()
+        self.wait_time += time.perf_counter() - start
+        return data
+
+    @property
+    def hidden_io_time(self):
+        """
+        I/O time which overlapped with analysis instead of blocking the consumer
+        """
+        return max(self.read_time - self.wait_time, 0.0)
+
+    def report(self):
+        hidden_ratio = self.hidden_io_time / self.read_time if self.read_time > 0 else 0.0
+        return (f"prefetch: read {self.files_read} files ({self.bytes_read / 1e6:.1f} MB) in {self.read_time:.2f}s, "
+                f"consumer waited {self.wait_time:.2f}s, hidden I/O {self.hidden_io_time:.2f}s "
+                f"({hidden_ratio * 100:.0f}%), peak buffered {self.peak_buffered_bytes / 1e6:.1f} MB, "
+                f"skipped {self.files_skipped} files")
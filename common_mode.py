@@ -0,0 +1,56 @@
+"""Module providing row / column common mode estimation and rejection for mutual grid captures """
+
+from collections import namedtuple
+import numpy as np
+
+# float64 working memory per frame block
+COMMON_MODE_CHUNK_BYTES = 64 * 1024 * 1024
+
+CommonModeResult = namedtuple("CommonModeResult", ["row_cm", "col_cm", "corrected", "cm_p2p"])
+
+
+def estimate_common_mode(grid, chunk_bytes=COMMON_MODE_CHUNK_BYTES):
+    """
+    Estimate the per frame common mode of every row (median across the row) and then of every column
+    (median down the column of the row corrected frame), for all frames in blocks of vectorized medians.
+    The median ignores the few touched nodes, so the touch signal stays in the corrected data.
+    :param grid: mutual capture [frames, rows, cols]
+    :return: CommonModeResult(row_cm [frames, rows], col_cm [frames, cols],
+             corrected [frames, rows, cols] cmr corrected frames, cm_p2p [rows, cols] p2p of the removed common mode)
+    """
+    frame_num, row_num, col_num = grid.shape
+    row_cm = np.empty((frame_num, row_num))
+    col_cm = np.empty((frame_num, col_num))
+    corrected = np.empty(grid.shape)
+    cm_max = np.full((row_num, col_num), -np.inf)
+    cm_min = np.full((row_num, col_num), np.inf)
+
+    chunk = max(1, chunk_bytes // (row_num * col_num * 8))
+    for start in range(0, frame_num, chunk):
+        stop = min(start + chunk, frame_num)
+        block = corrected[start:stop]
+        block[...] = grid[start:stop]
+        row_cm[start:stop] = np.median(block, axis=2)
+        block -= row_cm[start:stop, :, None]
+        col_cm[start:stop] = np.median(block, axis=1)
+        block -= col_cm[start:stop, None, :]
+
+        cm = row_cm[start:stop, :, None] + col_cm[start:stop, None, :]
+        np.maximum(cm_max, cm.max(axis=0), out=cm_max)
+        np.minimum(cm_min, cm.min(axis=0), out=cm_min)
+
+    return CommonModeResult(row_cm, col_cm, corrected, cm_max - cm_min)
+
+
+def common_mode_metrics(result):
+    """
+    scalar common mode noise metrics of a capture
+    """
+    row_p2p = result.row_cm.max(axis=0) - result.row_cm.min(axis=0)
+    col_p2p = result.col_cm.max(axis=0) - result.col_cm.min(axis=0)
+    return {
+        "row_cm_p2p_max": row_p2p.max(),
+        "col_cm_p2p_max": col_p2p.max(),
+        "node_cm_p2p_max": result.cm_p2p.max(),
+        "node_cm_p2p_mean": result.cm_p2p.mean(),
+    }
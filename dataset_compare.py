@@ -0,0 +1,308 @@
+"""Module providing node by node comparison of two dataset / pattern pairs, i.e. 120Hz vs 60Hz or firmware N vs N+1 """
+
+import os
+import re
+import csv
+import argparse
+import numpy as np
+from result_files import file_sha256
+from ETS_Dataframe import ETS_Dataframe, CHANNEL_DATA, new_header_index
+
+# per node statistics kept in the stats cache of a capture
+CACHE_STATS = ["mean", "var", "max", "min"]
+
+CACHE_FOLDER = "stats_cache"
+
+
+def capture_stats(file_path, cache_dir=None):
+    """
+    Per node statistics of every channel of one capture. The decoded statistics are cached by content hash in
+    cache_dir, so comparing a capture again does not parse the csv.
+    :param file_path: ETS capture file
+    :param cache_dir: folder of the stats cache, no caching if None
+    :return: dict "{channel}_{stat}" -> per node array, plus "frame_num"
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, file_sha256(file_path) + ".npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                return dict(cached)
+
+    Frame = ETS_Dataframe(file_path, new_header_index())
+    ret = {"frame_num": np.array(Frame.frame_num)}
+    for channel, attr in CHANNEL_DATA.items():
+        data = getattr(Frame, attr)
+        if data is None:
+            continue
+        ret[f"{channel}_mean"] = data.mean(axis=0)
+        ret[f"{channel}_var"] = data.var(axis=0, ddof=1)
+        ret[f"{channel}_max"] = data.max(axis=0)
+        ret[f"{channel}_min"] = data.min(axis=0)
+
+    if cache_path is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cache_path + ".tmp.npz"
+        np.savez(tmp_path, **ret)
+        os.replace(tmp_path, cache_path)
+    return ret
+
+
+def pattern_stats(notouch_path, touch_paths, cache_dir=None):
+    """
+    :return: (no touch stats, [touch stats, ...]) as returned by capture_stats
+    """
+    return capture_stats(notouch_path, cache_dir), [capture_stats(path, cache_dir) for path in touch_paths]
+
+
+def touch_number(path, prefix):
+    """
+    touch number of a touch capture, "w5.edl.csv" with prefix "w" -> 5
+    """
+    match = re.match(r"{}(\d+)".format(re.escape(prefix)), os.path.basename(path))
+    if match is None:
+        raise ValueError(f"{path} is not a touch capture with prefix {prefix}")
+    return int(match.group(1))
+
+
+def pair_touches(touch_paths_a, touch_paths_b, prefix):
+    """
+    pair the touch captures of two datasets by touch number, the listing order of the folders is arbitrary
+    :return: ([(touch number, path a, path b), ...] by touch number, numbers only in a, numbers only in b)
+    """
+    paths_a = {touch_number(path, prefix): path for path in touch_paths_a}
+    paths_b = {touch_number(path, prefix): path for path in touch_paths_b}
+    pairs = [(num, paths_a[num], paths_b[num]) for num in sorted(paths_a.keys() & paths_b.keys())]
+    return pairs, sorted(paths_a.keys() - paths_b.keys()), sorted(paths_b.keys() - paths_a.keys())
+
+
+def log_var_z(var_a, var_b, n_a, n_b):
+    """
+    z-score of the log variance ratio var_b / var_a, ln(s2) has a standard error of about sqrt(2 / (n - 1))
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.log(var_b / var_a) / np.sqrt(2.0 / (n_a - 1) + 2.0 / (n_b - 1))
+
+
+def mean_z(mean_a, var_a, mean_b, var_b, n_a, n_b):
+    """
+    Welch z-score of the mean difference mean_b - mean_a
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (mean_b - mean_a) / np.sqrt(var_a / n_a + var_b / n_b)
+
+
+def compare_channel(stats_a, stats_b, channel):
+    """
+    node by node noise comparison of two no touch captures of one channel
+    :return: dict of per node arrays: p2p_a, p2p_b, p2p_ratio_dB, rms_a, rms_b, rms_ratio_dB, rms_z, the p2p ratio
+             is nan where either p2p is 0
+    """
+    n_a, n_b = int(stats_a["frame_num"]), int(stats_b["frame_num"])
+    p2p_a = stats_a[f"{channel}_max"] - stats_a[f"{channel}_min"]
+    p2p_b = stats_b[f"{channel}_max"] - stats_b[f"{channel}_min"]
+    var_a, var_b = stats_a[f"{channel}_var"], stats_b[f"{channel}_var"]
+    # a node stuck at one value has no p2p noise, its ratio is undefined
+    valid = (p2p_a > 0) & (p2p_b > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "p2p_a": p2p_a,
+            "p2p_b": p2p_b,
+            "p2p_ratio_dB": np.where(valid, 20 * np.log10(np.where(valid, p2p_b, 1) / np.where(valid, p2p_a, 1)),
+                                     np.nan),
+            "rms_a": np.sqrt(var_a),
+            "rms_b": np.sqrt(var_b),
+            "rms_ratio_dB": 10 * np.log10(var_b / var_a),
+            "rms_z": log_var_z(var_a, var_b, n_a, n_b),
+        }
+
+
+def compare_touch_signal(notouch_a, touch_a, notouch_b, touch_b, channel, touch_numbers=None):
+    """
+    compare the signal (touch mean - no touch mean) at the touched node of every touch capture pair
+    :param touch_a: touch stats of dataset a, touch_b: touch stats of the same touches in dataset b
+    :param touch_numbers: touch number of every pair, 1, 2, ... if None
+    :return: list of (touch, node, signal_a, signal_b, delta, ratio_dB, z)
+    """
+    if len(touch_a) != len(touch_b):
+        raise ValueError(f"{len(touch_a)} touch captures can not be paired with {len(touch_b)}")
+    if touch_numbers is None:
+        touch_numbers = range(1, len(touch_a) + 1)
+    ret = []
+    for touch, capture_a, capture_b in zip(touch_numbers, touch_a, touch_b):
+        signal_a = capture_a[f"{channel}_mean"] - notouch_a[f"{channel}_mean"]
+        signal_b = capture_b[f"{channel}_mean"] - notouch_b[f"{channel}_mean"]
+        # touched node of dataset a, both captures are expected to touch the same node
+        node = np.unravel_index(signal_a.argmax(), signal_a.shape)
+        z = mean_z(capture_a[f"{channel}_mean"][node], capture_a[f"{channel}_var"][node],
+                   capture_b[f"{channel}_mean"][node], capture_b[f"{channel}_var"][node],
+                   int(capture_a["frame_num"]), int(capture_b["frame_num"]))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio_db = 20 * np.log10(signal_b[node] / signal_a[node])
+        ret.append((touch, tuple(int(val) for val in node), signal_a[node], signal_b[node],
+                    signal_b[node] - signal_a[node], ratio_db, z))
+    return ret
+
+
+def ranked_rows(pattern, channel, noise_diff, signal_diff, z_threshold):
+    """
+    rows of the ranked diff table: one per node p2p and rms noise change and one per touch signal change, the p2p
+    rows have no z-score (nan) and are never flagged significant
+    """
+    rows = []
+    ratio = noise_diff["p2p_ratio_dB"]
+    for node in zip(*np.nonzero(np.isfinite(ratio))):
+        rows.append([pattern, channel, "noise_p2p", tuple(int(val) for val in node), noise_diff["p2p_a"][node],
+                     noise_diff["p2p_b"][node], ratio[node], np.nan])
+    z = noise_diff["rms_z"]
+    for node in zip(*np.nonzero(np.isfinite(z))):
+        rows.append([pattern, channel, "noise_rms", tuple(int(val) for val in node), noise_diff["rms_a"][node],
+                     noise_diff["rms_b"][node], noise_diff["rms_ratio_dB"][node], z[node]])
+    for touch, node, signal_a, signal_b, _, ratio_db, signal_z in signal_diff:
+        rows.append([pattern, channel, f"signal touch {touch}", node, signal_a, signal_b, ratio_db, signal_z])
+    for row in rows:
+        row.append(abs(row[-1]) >= z_threshold)
+    return rows
+
+
+def compare_patterns(pattern_pairs, z_threshold=4.0, cache=True, prefix_touch="w"):
+    """
+    Compare per node noise and touch signal of pattern pairs, touch captures are paired by touch number.
+    :param pattern_pairs: list of (label, (notouch a, [touch a...]), (notouch b, [touch b...]))
+    :param z_threshold: |z| above which a change is flagged significant
+    :param cache: cache decoded statistics next to the captures
+    :param prefix_touch: touch capture prefix, the touch number follows it
+    :return: (dict label -> dict channel -> noise diff, ranked rows sorted by |z|)
+    """
+    diffs = {}
+    rows = []
+    for label, paths_a, paths_b in pattern_pairs:
+        touch_pairs, only_a, only_b = pair_touches(paths_a[1], paths_b[1], prefix_touch)
+        if only_a or only_b:
+            print(f"{label}: touches {only_a} only in dataset a and {only_b} only in dataset b are not compared")
+        touch_numbers = [num for num, _, _ in touch_pairs]
+        stats_a = pattern_stats(paths_a[0], [path for _, path, _ in touch_pairs],
+                                cache_dir=_cache_dir(paths_a[0]) if cache else None)
+        stats_b = pattern_stats(paths_b[0], [path for _, _, path in touch_pairs],
+                                cache_dir=_cache_dir(paths_b[0]) if cache else None)
+        diffs[label] = {}
+        for channel in CHANNEL_DATA:
+            if f"{channel}_var" not in stats_a[0] or f"{channel}_var" not in stats_b[0]:
+                continue
+            if stats_a[0][f"{channel}_var"].shape != stats_b[0][f"{channel}_var"].shape:
+                raise ValueError(f"{label}: {channel} shape {stats_a[0][f'{channel}_var'].shape} does not match "
+                                 f"{stats_b[0][f'{channel}_var'].shape}")
+            noise_diff = compare_channel(stats_a[0], stats_b[0], channel)
+            signal_diff = compare_touch_signal(stats_a[0], stats_a[1], stats_b[0], stats_b[1], channel,
+                                               touch_numbers)
+            diffs[label][channel] = noise_diff
+            rows.extend(ranked_rows(label, channel, noise_diff, signal_diff, z_threshold))
+
+    rows.sort(key=lambda row: -abs(row[-2]) if np.isfinite(row[-2]) else 0)
+    return diffs, rows
+
+
+def _cache_dir(capture_path):
+    return os.path.join(os.path.dirname(capture_path), "output", CACHE_FOLDER)
+
+
+def file_label(label):
+    """
+    pattern pair label usable in file names, "White:Black" -> "White_vs_Black"
+    """
+    return label.replace(":", "_vs_").replace("/", "_")
+
+
+def write_ranked_csv(output_path, rows):
+    with open(output_path, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["pattern", "channel", "metric", "node", "a", "b", "ratio_dB", "z", "significant"])
+        for row in rows:
+            writer.writerow(row[:4] + ["{:.2f}".format(val) for val in row[4:8]] + [row[8]])
+    print("Successfully generate {}!!!!!".format(output_path))
+
+
+def plot_diff_heatmap(output_folder, label, noise_diff, z_threshold, metric="rms"):
+    """
+    heatmap of the mct noise change in dB, for rms the significant nodes are outlined
+    :param metric: "p2p" or "rms"
+    """
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+    from matplotlib import patches
+
+    fig = plt.figure(figsize=(16, 9), dpi=110)
+    ax = sns.heatmap(data=noise_diff[f"{metric}_ratio_dB"], annot=True, fmt='.1f', center=0, cmap="coolwarm")
+    ax.set_ylabel('Row')
+    ax.set_xlabel('Column')
+    title = f'{label}: MCT {metric} noise change b / a [dB]'
+    if f"{metric}_z" in noise_diff:
+        for ynode, xnode in zip(*np.nonzero(np.abs(noise_diff[f"{metric}_z"]) >= z_threshold)):
+            ax.add_patch(patches.Rectangle((xnode, ynode), 1, 1, fill=False, edgecolor='black', lw=2))
+        title += f', outlined |z| >= {z_threshold}'
+    plt.title(title)
+    plt.tight_layout()
+    output_path = os.path.join(output_folder, f"Figure_diff_{file_label(label)}_mct_{metric}.png")
+    fig.savefig(output_path)
+    plt.close(fig)
+    return output_path
+
+
+class CompareOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="compare noise and signal of two datasets node by node")
+
+        self.parser.add_argument("--dataset_a", type=str, help="folder path of the reference dataset", required=True)
+
+        self.parser.add_argument("--dataset_b", type=str, help="folder path of the compared dataset", required=True)
+
+        self.parser.add_argument('--pattern_folder',
+                                 nargs='+',
+                                 required=True,
+                                 help='patterns to compare, "name" for the same folder in both datasets or '
+                                      '"name_a:name_b"')
+
+        self.parser.add_argument("--prefix_notouch", type=str, help="no touch raw data prefix", default="wo")
+
+        self.parser.add_argument("--prefix_touch", type=str, help="touch raw data prefix", default="w")
+
+        self.parser.add_argument("--output", type=str, help="output folder of the diff table and heatmaps",
+                                 default="compare_output")
+
+        self.parser.add_argument("--z_threshold", type=float, help="|z| of a significant change", default=4.0)
+
+        self.parser.add_argument("--no_cache", help="do not read or write the per capture stats cache",
+                                 action="store_true")
+
+        self.parser.add_argument("--plot", help="write diff heatmaps", action="store_true")
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        return self.options
+
+
+if __name__ == '__main__':
+    from ETS_Analysis import get_pattern_capture_paths
+
+    opts = CompareOptions().parse()
+    pairs = []
+    for spec in opts.pattern_folder:
+        pattern_a, _, pattern_b = spec.partition(":")
+        pattern_b = pattern_b or pattern_a
+        pairs.append((spec,
+                      get_pattern_capture_paths(opts.dataset_a, pattern_a, opts.prefix_notouch, opts.prefix_touch),
+                      get_pattern_capture_paths(opts.dataset_b, pattern_b, opts.prefix_notouch, opts.prefix_touch)))
+
+    diffs, rows = compare_patterns(pairs, opts.z_threshold, cache=not opts.no_cache, prefix_touch=opts.prefix_touch)
+    if not os.path.exists(opts.output):
+        os.makedirs(opts.output)
+    write_ranked_csv(os.path.join(opts.output, "compare_ranked.csv"), rows)
+    for label, channels in diffs.items():
+        if "mct" in channels:
+            for metric in ["p2p", "rms"]:
+                np.savetxt(os.path.join(opts.output, f"{file_label(label)}_mct_{metric}_ratio_dB.csv"),
+                           channels["mct"][f"{metric}_ratio_dB"], delimiter=",", fmt="%.2f")
+                if opts.plot:
+                    plot_diff_heatmap(opts.output, label, channels["mct"], opts.z_threshold, metric)
+    print(f"{sum(row[-1] for row in rows)} significant changes in {len(diffs)} pattern pairs")
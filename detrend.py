@@ -0,0 +1,76 @@
+"""Module providing baseline drift removal over frames for capture tensors """
+
+import numpy as np
+
+DETREND_METHODS = ["poly", "movavg"]
+
+# float64 working memory per node block
+DETREND_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def parse_detrend(text):
+    """
+    parse a detrend spec as used by --detrend
+    :param text: "poly:<order>" (per node polynomial over frames) or "movavg:<window>" (moving baseline)
+    :return: (method, parameter) or None
+    """
+    if text is None or text == "":
+        return None
+    method, _, param = text.partition(":")
+    if method not in DETREND_METHODS:
+        raise ValueError(f"unknown detrend method {method}, choose from {DETREND_METHODS}")
+    if param == "":
+        param = "1" if method == "poly" else "64"
+    return method, int(param)
+
+
+def polynomial_trend(frames, order):
+    """
+    least squares polynomial over frames for all nodes at once, one shared pseudo inverse of the design matrix
+    :param frames: [frames, nodes]
+    :return: [frames, nodes] fitted trend
+    """
+    t = np.linspace(-1.0, 1.0, frames.shape[0])
+    design = np.vander(t, order + 1)
+    return design @ (np.linalg.pinv(design) @ frames)
+
+
+def moving_baseline(frames, window):
+    """
+    centered moving average over frames via cumulative sums, the window shrinks at both ends
+    :param frames: [frames, nodes]
+    :return: [frames, nodes] moving baseline
+    """
+    frame_num = frames.shape[0]
+    csum = np.zeros((frame_num + 1, frames.shape[1]))
+    np.cumsum(frames, axis=0, out=csum[1:])
+    idx = np.arange(frame_num)
+    lo = np.clip(idx - window // 2, 0, frame_num)
+    hi = np.clip(idx + window - window // 2, 0, frame_num)
+    return (csum[hi] - csum[lo]) / (hi - lo)[:, None]
+
+
+def detrend_frames(data, method="poly", param=1, chunk_bytes=DETREND_CHUNK_BYTES):
+    """
+    Remove slow baseline drift over frames from every node. Only the variation of the trend is removed,
+    the mean level of every node (i.e. the touch signal) is kept.
+    :param data: capture tensor [frames, ...nodes]
+    :param method: "poly" or "movavg"
+    :param param: polynomial order or moving average window in frames
+    :return: (detrended float tensor like data, drift p2p per node [...nodes])
+    """
+    frame_num = data.shape[0]
+    frames = data.reshape(frame_num, -1)
+    out = np.empty(frames.shape)
+    drift = np.empty(frames.shape[1])
+    chunk = max(1, chunk_bytes // (frame_num * 8))
+    for start in range(0, frames.shape[1], chunk):
+        block = frames[:, start:start + chunk]
+        if method == "poly":
+            trend = polynomial_trend(block, param)
+        else:
+            trend = moving_baseline(block, param)
+        trend -= trend.mean(axis=0)
+        drift[start:start + chunk] = trend.max(axis=0) - trend.min(axis=0)
+        np.subtract(block, trend, out=out[:, start:start + chunk])
+    return out.reshape(data.shape), drift.reshape(data.shape[1:])
@@ -0,0 +1,52 @@
+"""Module providing per frame signal and noise time series of captures """
+
+import numpy as np
+
+FRAME_SERIES_EXT = ".npz"
+
+
+def node_series(captures, nodes, masks=None):
+    """
+    samples of one node per capture over all frames, captures of different length are padded with nan
+    :param captures: list of capture tensors [frames, ...nodes]
+    :param nodes: node index tuple per capture
+    :param masks: optional list of bool masks like the captures (or None), masked samples become nan
+    :return: [captures, max frames] float array
+    """
+    ret = np.full((len(captures), max((len(data) for data in captures), default=0)), np.nan)
+    for idx, (data, node) in enumerate(zip(captures, nodes)):
+        index = (slice(None),) + tuple(node)
+        ret[idx, :len(data)] = data[index]
+        if masks is not None and masks[idx] is not None:
+            ret[idx, :len(data)][masks[idx][index]] = np.nan
+    return ret
+
+
+def frame_noise(data, mask=None):
+    """
+    per frame noise proxy of a no touch capture, every node relative to its mean over frames
+    :param data: capture tensor [frames, ...nodes]
+    :param mask: optional bool mask like data, masked samples are left out
+    :return: (p2p over nodes [frames], rms over nodes [frames])
+    """
+    frames = data.reshape(len(data), -1).astype(float)
+    if mask is not None:
+        frames[mask.reshape(len(data), -1)] = np.nan
+    with np.errstate(invalid="ignore"):
+        deviation = frames - np.nanmean(frames, axis=0)
+        p2p = np.nanmax(deviation, axis=1) - np.nanmin(deviation, axis=1)
+        rms = np.sqrt(np.nanmean(deviation ** 2, axis=1))
+    return p2p, rms
+
+
+def write_frame_series(path, series):
+    """
+    one compressed columnar file, series is a dict name -> array
+    """
+    np.savez_compressed(path, **series)
+    return path
+
+
+def read_frame_series(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
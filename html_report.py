@@ -0,0 +1,249 @@
+"""Module providing an incremental html report over all patterns of a dataset """
+
+import os
+import json
+import html
+import hashlib
+import argparse
+import datetime
+import numpy as np
+from result_files import cached_file_hash, write_json
+from metric_plan import FINAL_RESULT_COLUMNS
+
+REPORT_FORMAT = "ets_snr_report_v1"
+
+MANIFEST_NAME = "report_manifest.json"
+
+# figures of a pattern section: file suffix -> title
+SECTION_FIGURES = {
+    "notouch_p2p": "No Touch MCT p2p noise",
+    "snr_map": "Full panel SmaxNppR_dB",
+}
+
+
+def section_key(pattern, input_hashes, render_options):
+    """
+    key of a pattern section: hash of its captures and of the rendering options
+    """
+    text = json.dumps([REPORT_FORMAT, pattern, input_hashes, render_options], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def html_table(header, rows):
+    lines = ["<table>", "<tr>" + "".join(f"<th>{html.escape(str(val))}</th>" for val in header) + "</tr>"]
+    for row in rows:
+        lines.append("<tr>" + "".join(f"<td>{html.escape(_cell(val))}</td>" for val in row) + "</tr>")
+    lines.append("</table>")
+    return "\n".join(lines)
+
+
+def _cell(val):
+    if isinstance(val, (float, np.floating)):
+        return "{:.2f}".format(val)
+    return str(val)
+
+
+def summary_tables(summary):
+    """
+    html tables of one vendor summary, one per channel section
+    """
+    parts = []
+    for section, table_key in [("mct_summary", "snr_summary"), ("sct_row_summary", "snr_sct_row_summary"),
+                               ("sct_col_summary", "snr_sct_col_summary")]:
+        if section not in summary:
+            continue
+        table = summary[section][table_key]
+        touch_num = len(next(iter(table.values())))
+        rows = [[f"Touch {idx + 1}"] + [table[column][idx] for column in table] for idx in range(touch_num)]
+        parts.append(f"<h4>{html.escape(section)}</h4>")
+        parts.append(html_table([""] + list(table), rows))
+        final_results = summary[section]["final_results"]
+        parts.append(html_table(list(final_results), [list(final_results.values())]))
+    return "\n".join(parts)
+
+
+class HtmlReport:
+    def __init__(self, report_dir, vendors=("BOE",), dpi=80, annot=True):
+        """
+        :param report_dir: folder of index.html, section fragments and figure assets
+        :param vendors: report vendors rendered in every section
+        :param dpi: figure resolution
+        :param annot: annotate heatmap cells
+        """
+        self.report_dir = report_dir
+        self.render_options = {"vendors": list(vendors), "dpi": dpi, "annot": annot}
+        self.section_dir = os.path.join(report_dir, "sections")
+        self.asset_dir = os.path.join(report_dir, "assets")
+        for folder in [self.section_dir, self.asset_dir]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        self.manifest = self.load_manifest()
+        self.rendered = []
+        self.reused = []
+
+    def load_manifest(self):
+        path = os.path.join(self.report_dir, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get("format", None) == REPORT_FORMAT:
+                return manifest
+        return {"format": REPORT_FORMAT, "file_hashes": {}, "sections": {}}
+
+    def save_manifest(self):
+        path = os.path.join(self.report_dir, MANIFEST_NAME)
+        write_json(path, self.manifest, indent=1)
+
+    def section_path(self, key):
+        return os.path.join(self.section_dir, key + ".json")
+
+    def section(self, pattern, notouch_path, touch_paths, Header_index):
+        """
+        fragment of one pattern, only rendered again when its captures or the rendering options changed
+        :return: dict with "key", "html", "final_row"
+        """
+        input_hashes = [cached_file_hash(path, self.manifest["file_hashes"])
+                        for path in [notouch_path] + list(touch_paths)]
+        key = section_key(pattern, input_hashes, self.render_options)
+        if os.path.exists(self.section_path(key)):
+            with open(self.section_path(key)) as f:
+                self.reused.append(pattern)
+                return json.load(f)
+
+        fragment = self.render_section(key, pattern, notouch_path, touch_paths, Header_index)
+        write_json(self.section_path(key), fragment)
+        self.rendered.append(pattern)
+        return fragment
+
+    def render_section(self, key, pattern, notouch_path, touch_paths, Header_index):
+        from ETS_Analysis import AnalyseData, build_final_result_row
+
+        DataAnalyse = AnalyseData(notouch_path, touch_paths, Header_index)
+        summaries = DataAnalyse.snr_summaries(self.render_options["vendors"])
+        parts = [f'<h2 id="{html.escape(pattern)}">{html.escape(pattern)}</h2>',
+                 f"<p>{len(touch_paths)} touch captures, {DataAnalyse.NoTouchFrame.frame_num} no touch frames</p>"]
+        for vendor, summary in summaries.items():
+            parts.append(f"<h3>{html.escape(vendor)}</h3>")
+            parts.append(summary_tables(summary))
+
+        if DataAnalyse.NoTouchFrame.mct_grid is not None:
+            snr_map = DataAnalyse.full_panel_snr_map()
+            grids = {
+                "notouch_p2p": (DataAnalyse.NoTouchFrame.mct_grid_p2p, ""),
+                "snr_map": (snr_map["SmaxNppR_dB"], f" ({snr_map['noise_label']} noise)"),
+            }
+            for name, (grid, label) in grids.items():
+                asset = self.render_figure(f"{key[:16]}_{name}.png", grid,
+                                           f"{pattern}: {SECTION_FIGURES[name]}{label}")
+                parts.append(f'<img src="assets/{asset}" alt="{html.escape(SECTION_FIGURES[name])}">')
+
+        final_row = None
+        if "BOE" in summaries:
+            final_row = build_final_result_row(pattern, summaries["BOE"])
+        return {"key": key, "html": "\n".join(parts), "final_row": final_row}
+
+    def render_figure(self, name, grid, title):
+        import seaborn as sns
+        from matplotlib import pyplot as plt
+
+        fig = plt.figure(figsize=[12.99, 8.49], dpi=self.render_options["dpi"])
+        ax = sns.heatmap(data=grid, annot=self.render_options["annot"], fmt='.1f')
+        ax.set_ylabel('Row')
+        ax.set_xlabel('Column')
+        plt.title(title)
+        plt.tight_layout()
+        fig.savefig(os.path.join(self.asset_dir, name))
+        plt.close(fig)
+        return name
+
+    def build(self, pattern_paths, Header_index):
+        """
+        :param pattern_paths: dict pattern -> (no touch path, [touch path, ...])
+        :return: path of index.html
+        """
+        fragments = {pattern: self.section(pattern, notouch_path, touch_paths, Header_index)
+                     for pattern, (notouch_path, touch_paths) in pattern_paths.items()}
+
+        final_rows = [fragment["final_row"] for fragment in fragments.values() if fragment["final_row"] is not None]
+        parts = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\"><title>SNR report</title>",
+                 "<style>table{border-collapse:collapse;margin:6px 0}td,th{border:1px solid #999;padding:2px 6px}"
+                 "img{max-width:100%}</style></head><body>",
+                 "<h1>SNR report</h1>",
+                 f"<p>generated {datetime.datetime.now().isoformat(timespec='seconds')}</p>",
+                 "<ul>" + "".join(f'<li><a href="#{html.escape(pattern)}">{html.escape(pattern)}</a></li>'
+                                  for pattern in fragments) + "</ul>"]
+        if len(final_rows) > 0:
+            parts.append("<h2>Final results</h2>")
+            parts.append(html_table(FINAL_RESULT_COLUMNS, final_rows))
+        parts.extend(fragment["html"] for fragment in fragments.values())
+        parts.append("</body></html>")
+
+        index_path = os.path.join(self.report_dir, "index.html")
+        with open(index_path, "w", encoding="UTF8") as f:
+            f.write("\n".join(parts))
+
+        self.manifest["sections"] = {pattern: fragment["key"] for pattern, fragment in fragments.items()}
+        self.save_manifest()
+        self.remove_stale(fragments.values())
+        return index_path
+
+    def remove_stale(self, fragments):
+        """
+        drop section fragments and figures which no longer belong to the report
+        """
+        keys = {fragment["key"] for fragment in fragments}
+        for file_name in os.listdir(self.section_dir):
+            if file_name.endswith(".json") and file_name[:-len(".json")] not in keys:
+                os.remove(os.path.join(self.section_dir, file_name))
+        prefixes = {key[:16] for key in keys}
+        for file_name in os.listdir(self.asset_dir):
+            if file_name[:16] not in prefixes:
+                os.remove(os.path.join(self.asset_dir, file_name))
+
+
+class HtmlReportOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="incremental html report over all patterns of a dataset")
+
+        self.parser.add_argument("--dataset", type=str, help="folder path to the raw data", required=True)
+
+        self.parser.add_argument('--pattern_folder', nargs='+', default=None,
+                                 help='patterns of the report, all folders of the dataset if not set')
+
+        self.parser.add_argument("--prefix_notouch", type=str, help="no touch raw data prefix", default="wo")
+
+        self.parser.add_argument("--prefix_touch", type=str, help="touch raw data prefix", default="w")
+
+        self.parser.add_argument("--report_vendor", nargs='+', default=["BOE"], help="vendor tables of the report")
+
+        self.parser.add_argument("--report_dir", type=str, help="output folder of the report, default "
+                                                                "<dataset>/report", default=None)
+
+        self.parser.add_argument("--dpi", type=int, help="figure resolution", default=80)
+
+        self.parser.add_argument("--no_annot", help="do not annotate heatmap cells", action="store_true")
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        if self.options.report_dir is None:
+            self.options.report_dir = os.path.join(self.options.dataset, "report")
+        return self.options
+
+
+if __name__ == '__main__':
+    from ETS_Dataframe import HEADER_ETS
+    from ETS_Analysis import get_pattern_capture_paths
+
+    opts = HtmlReportOptions().parse()
+    patterns = opts.pattern_folder
+    if patterns is None:
+        report_name = os.path.basename(os.path.normpath(opts.report_dir))
+        patterns = sorted(name for name in os.listdir(opts.dataset)
+                          if os.path.isdir(os.path.join(opts.dataset, name)) and name != report_name)
+
+    pattern_paths = {pattern: get_pattern_capture_paths(opts.dataset, pattern, opts.prefix_notouch, opts.prefix_touch)
+                     for pattern in patterns}
+    report = HtmlReport(opts.report_dir, opts.report_vendor, opts.dpi, not opts.no_annot)
+    index_path = report.build(pattern_paths, HEADER_ETS)
+    print(f"rendered {len(report.rendered)} sections, reused {len(report.reused)}")
+    print("Successfully generate {}!!!!!".format(index_path))
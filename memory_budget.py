@@ -0,0 +1,151 @@
+"""Module providing the memory budget of an analysis run: rss checks and spilling of raw frames to disk """
+
+import os
+import re
+import gc
+import atexit
+import shutil
+import tempfile
+import numpy as np
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_memory_size(text):
+    """
+    parse a memory size as used by --memory_budget, i.e. "2G", "512M", "1.5g" or plain bytes
+    :return: size in bytes or None
+    """
+    if text is None or text == "":
+        return None
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([kKmMgGtT]?)[bB]?\s*", text)
+    if match is None:
+        raise ValueError(f"invalid memory size {text}, i.e. 2G or 512M")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def current_rss_bytes():
+    """
+    resident set size of this process, falls back to the peak rss where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # linux reports kilobytes, macOS bytes
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+    except ImportError:
+        return 0
+
+
+def peak_rss_bytes():
+    """
+    highest resident set size of this process so far, 0 where it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # linux reports kilobytes, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def spill_array(array, path):
+    """
+    write an array to disk and return a read only memory map of it, pages are only loaded when touched
+    """
+    np.save(path, np.ascontiguousarray(array))
+    return np.load(path, mmap_mode="r")
+
+
+class SpillWriter:
+    def __init__(self, path, dtype, node_shape):
+        """
+        append blocks of frames to a raw spill file, the frame count does not need to be known up front
+        :param node_shape: shape of one frame
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.node_shape = tuple(node_shape)
+        self.frame_num = 0
+        self.f = open(path, "wb")
+
+    def append(self, block):
+        self.f.write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+        self.frame_num += len(block)
+
+    def close(self):
+        """
+        :return: read only memory map of all appended frames [frames, ...node_shape]
+        """
+        self.f.close()
+        if self.frame_num == 0:
+            return np.empty((0,) + self.node_shape, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode="r", shape=(self.frame_num,) + self.node_shape)
+
+
+class MemoryBudget:
+    def __init__(self, budget_bytes, spill_dir=None):
+        """
+        :param budget_bytes: max resident memory of the process
+        :param spill_dir: folder for memory mapped raw frames, a temporary folder is used if None
+        """
+        self.budget_bytes = budget_bytes
+        self.own_spill_dir = spill_dir is None
+        self.spill_dir = tempfile.mkdtemp(prefix="ets_spill_") if spill_dir is None else spill_dir
+        if not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        self.peak_rss = 0
+        self.spill_count = 0
+        # also remove the temporary folder when the run stops with an error
+        atexit.register(self.cleanup)
+
+    def spill_path(self, name, ext=".npy"):
+        self.spill_count += 1
+        return os.path.join(self.spill_dir, f"{self.spill_count:06d}_{name}{ext}")
+
+    def check(self, what=""):
+        """
+        raise MemoryError when the resident memory exceeds the budget, now or at any moment since the start
+        (peak rss of the process), so short peaks between two checks are caught as well
+        """
+        rss = current_rss_bytes()
+        self.peak_rss = max(self.peak_rss, rss, peak_rss_bytes())
+        if self.peak_rss > self.budget_bytes:
+            raise MemoryError(f"memory budget exceeded {what}: peak rss {self.peak_rss / 1e6:.0f} MB > "
+                              f"{self.budget_bytes / 1e6:.0f} MB, reduce the capture with --frames/--channels "
+                              f"or raise --memory_budget")
+        return rss
+
+    def headroom(self):
+        """
+        bytes which can still be allocated before the current resident memory reaches the budget
+        """
+        return max(self.budget_bytes - current_rss_bytes(), 0)
+
+    def release(self, paths):
+        """
+        remove spilled files which are no longer referenced
+        """
+        gc.collect()
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                # still mapped (windows), removed with the spill folder
+                pass
+
+    def cleanup(self):
+        gc.collect()
+        if self.own_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def report(self):
+        self.peak_rss = max(self.peak_rss, peak_rss_bytes())
+        return (f"memory budget {self.budget_bytes / 1e6:.0f} MB: peak rss {self.peak_rss / 1e6:.0f} MB, "
+                f"{self.spill_count} arrays spilled to {self.spill_dir}")
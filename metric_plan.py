@@ -0,0 +1,412 @@
+"""Module providing the metric registry and the vendor report plan for snr summaries """
+
+from collections import namedtuple
+import numpy as np
+from percentile_noise import noise_label
+
+Metric = namedtuple("Metric", ["name", "deps", "func"])
+
+# structured results of a vendor report, values are plain python numbers
+# metrics: metric name -> one value per touch; final_results: value name -> FinalResult
+# noise: label of the noise term used in place of p2p, None for p2p
+VendorResult = namedtuple("VendorResult", ["vendor", "label", "channels", "frames_used", "noise"])
+ChannelResult = namedtuple("ChannelResult", ["channel", "metrics", "final_results"])
+# touch is counted from 1, position_name is the report key of the touch, i.e. "Position_P2P"
+FinalResult = namedtuple("FinalResult", ["metric", "value", "touch", "position_name"])
+
+# channel -> attributes used to look the channel up on ETS_Dataframe and to name the summary sections
+Channel = namedtuple("Channel", ["data", "stat_prefix", "position", "summary_key", "table_key", "final_prefix"])
+
+CHANNELS = {
+    "mct": Channel("mct_grid", "mct_grid", "mct_signal_position", "mct_summary", "snr_summary", ""),
+    "sct_row": Channel("sct_row", "sct_row", "sct_row_signal_position", "sct_row_summary",
+                       "snr_sct_row_summary", "sct_row_"),
+    "sct_col": Channel("sct_col", "sct_col", "sct_col_signal_position", "sct_col_summary",
+                       "snr_sct_col_summary", "sct_col_"),
+}
+
+METRICS = {}
+
+
+def register_metric(name, deps=()):
+    """
+    Register a metric which is computed once per channel from the metrics it depends on.
+    The decorated function is called as func(ctx, *deps) where ctx is a PlanContext.
+    """
+
+    def wrapper(func):
+        METRICS[name] = Metric(name, tuple(deps), func)
+        return func
+
+    return wrapper
+
+
+class PlanContext:
+    def __init__(self, analysis, channel, noise=None):
+        """
+        :param noise: optional (lo, hi) percentiles, the percentile spread replaces max - min as p2p noise term
+        """
+        self.analysis = analysis
+        self.channel = CHANNELS[channel]
+        self.noise = noise
+
+    def stat(self, frame, stat):
+        """
+        read a per node statistic (max, min, mean, p2p, rms) of a capture for the current channel
+        """
+        return getattr(frame, f"{self.channel.stat_prefix}_{stat}")
+
+    def spread(self, frame):
+        """
+        per node peak-peak noise term of a capture: p2p, or the selected percentile spread
+        """
+        if self.noise is None:
+            return self.stat(frame, "p2p")
+        return getattr(frame, f"{self.channel.stat_prefix}_pctl")(*self.noise)
+
+
+# ********************************************************
+# *********** shared intermediates ***********************
+# ********************************************************
+
+@register_metric("touch_position")
+def _touch_position(ctx):
+    return [tuple(int(idx) for idx in getattr(TouchFrame, ctx.channel.position)[1:])
+            for TouchFrame in ctx.analysis.TouchFrameSets]
+
+
+@register_metric("notouch_p2p")
+def _notouch_p2p(ctx):
+    return ctx.spread(ctx.analysis.NoTouchFrame)
+
+
+@register_metric("notouch_p2p_max", deps=["notouch_p2p"])
+def _notouch_p2p_max(ctx, notouch_p2p):
+    return notouch_p2p.max()
+
+
+for _stat in ["max", "min", "mean", "rms"]:
+    register_metric(f"touch_{_stat}")(
+        lambda ctx, stat=_stat: [ctx.stat(TouchFrame, stat) for TouchFrame in ctx.analysis.TouchFrameSets])
+
+
+@register_metric("touch_p2p", deps=["touch_max", "touch_min"])
+def _touch_p2p(ctx, touch_max, touch_min):
+    if ctx.noise is not None:
+        return [ctx.spread(TouchFrame) for TouchFrame in ctx.analysis.TouchFrameSets]
+    return [grid_max - grid_min for grid_max, grid_min in zip(touch_max, touch_min)]
+
+
+# ********************************************************
+# *********** per touch signal and noise *****************
+# ********************************************************
+
+@register_metric("touched_node", deps=["touch_position"])
+def _touched_node(ctx, touch_position):
+    return [pos if len(pos) > 1 else pos[0] for pos in touch_position]
+
+
+def _register_node_lookup(name, grids):
+    """
+    metric reading the touched node from one grid per touch
+    """
+    register_metric(name, deps=[grids, "touch_position"])(
+        lambda ctx, grid_list, touch_position: [grid[pos] for grid, pos in zip(grid_list, touch_position)])
+
+
+_register_node_lookup("signal_max", "touch_max")
+_register_node_lookup("signal_min", "touch_min")
+_register_node_lookup("signal_mean", "touch_mean")
+_register_node_lookup("noise_p2p_touch", "touch_p2p")
+_register_node_lookup("noise_rms_touch", "touch_rms")
+
+
+@register_metric("noise_p2p_notouch", deps=["notouch_p2p", "touch_position"])
+def _noise_p2p_notouch(ctx, notouch_p2p, touch_position):
+    return [notouch_p2p[pos] for pos in touch_position]
+
+
+@register_metric("noise_p2p_fullscreen", deps=["notouch_p2p_max", "touch_position"])
+def _noise_p2p_fullscreen(ctx, notouch_p2p_max, touch_position):
+    return [notouch_p2p_max] * len(touch_position)
+
+
+# ********************************************************
+# *********** snr ratios *********************************
+# ********************************************************
+
+# ratio name -> (signal, noise)
+RATIOS = {
+    "SmaxNppnotouchR": ("signal_max", "noise_p2p_notouch"),
+    "SminNppnotouchR": ("signal_min", "noise_p2p_notouch"),
+    "SmeanNppnotouchR": ("signal_mean", "noise_p2p_notouch"),
+    "SminNpptouchR": ("signal_min", "noise_p2p_touch"),
+    "SmaxNppfullscreenR": ("signal_max", "noise_p2p_fullscreen"),
+    "SmeanNrmsR": ("signal_mean", "noise_rms_touch"),
+}
+
+for _ratio, (_signal, _noise) in RATIOS.items():
+    register_metric(_ratio, deps=[_signal, _noise])(
+        lambda ctx, signal, noise: [sig / noi for sig, noi in zip(signal, noise)])
+    register_metric(_ratio + "_dB", deps=[_ratio])(
+        lambda ctx, ratio: [20 * np.log10(val) for val in ratio])
+
+# ********************************************************
+# *********** vendor report layouts **********************
+# ********************************************************
+
+# columns: (csv column, metric); final_results: (metric to minimise, value name, position name)
+# "{prefix}" is replaced by the channel final prefix, i.e. "sct_row_"
+VENDOR_REPORTS = {
+    "BOE": {
+        "Vendor": "BOE",
+        "channels": ["mct", "sct_row", "sct_col"],
+        "columns": [
+            ("touched node", "touched_node"),
+            ("noise_p2p_fullscreen", "noise_p2p_fullscreen"),
+            ("noise_p2p_notouch", "noise_p2p_notouch"),
+            ("noise_rms_touch", "noise_rms_touch"),
+            ("signal_max", "signal_max"),
+            ("signal_mean", "signal_mean"),
+            ("SmaxNppmotouchR", "SmaxNppnotouchR"),
+            ("SmaxNppnotouchR_dB", "SmaxNppnotouchR_dB"),
+            ("SmaxNppfullscreenR", "SmaxNppfullscreenR"),
+            ("SmaxNppfullscreenR_dB", "SmaxNppfullscreenR_dB"),
+            ("SmaxNrmsR", "SmeanNrmsR"),
+            ("SmeanNrmsR_dB", "SmeanNrmsR_dB"),
+        ],
+        "final_results": [
+            ("SmaxNppfullscreenR_dB", "min_{prefix}SmaxNppfullscreenR_dB", "Position_P2P"),
+            ("SmeanNrmsR_dB", "min_{prefix}SmeanNrmsR_dB", "Position_RMS"),
+        ],
+    },
+    # huawei quick test only need touch raw data, only peak-peak snr is calculated
+    "Huawei_quick": {
+        "Vendor": "Huawei_quick",
+        "channels": ["mct"],
+        "columns": [
+            ("touched node", "touched_node"),
+            ("noise_p2p_touch", "noise_p2p_touch"),
+            ("signal_min", "signal_min"),
+            ("SminNpptouchR", "SminNpptouchR"),
+            ("SminNpptouchR_dB", "SminNpptouchR_dB"),
+        ],
+        "final_results": [
+            ("SminNpptouchR_dB", "min_{prefix}SminNpptouch_dB", "min_{prefix}SminNpptouch_dB_index"),
+        ],
+    },
+    # huawei thp afe test using no touch data as the source of noise, only peak-peak snr is calculated
+    "Huawei_thp_afe": {
+        "Vendor": "Huawei_quick",
+        "channels": ["mct"],
+        "columns": [
+            ("touched node", "touched_node"),
+            ("noise_p2p_notouch", "noise_p2p_notouch"),
+            ("signal_min", "signal_min"),
+            ("signal_mean", "signal_mean"),
+            ("SminNppnotouchR", "SminNppnotouchR"),
+            ("SminNppnotouchR_dB", "SminNppnotouchR_dB"),
+            ("SmeanNppnotouchR", "SmeanNppnotouchR"),
+            ("SmeanNppnotouchR_dB", "SmeanNppnotouchR_dB"),
+        ],
+        "final_results": [
+            ("SminNppnotouchR_dB", "min_{prefix}SminNppnotouch_dB", "min_{prefix}SminNppnotouch_dB_index"),
+            ("SmeanNppnotouchR_dB", "min_{prefix}SmeanNppnotouch_dB", "min_{prefix}SmeanNppnotouch_dB_index"),
+        ],
+    },
+}
+
+# columns of result_summary.csv, one row per pattern from the BOE final results
+FINAL_RESULT_COLUMNS = ["pattern (fullscreen)", "SNppR MCT", "SNrmsR MCT", "SNppR SCT Row",
+                        "SNrmsR SCT Row", "SNppR SCT Col", "SNrmsR SCT Col"]
+
+
+def vendor_metrics(vendor):
+    """
+    all metrics a vendor report reads, per touch columns and final result sources
+    """
+    report = VENDOR_REPORTS[vendor]
+    names = [metric for _, metric in report["columns"]]
+    names.extend(metric for metric, _, _ in report["final_results"])
+    return names
+
+
+def plan_metrics(names, channels):
+    """
+    plan of named metrics (and their dependencies) for the given channels
+    :return: list of (channel, metric name) in dependency order
+    """
+    plan = []
+    for channel in channels:
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            for dep in METRICS[name].deps:
+                visit(dep)
+            visited.add(name)
+            plan.append((channel, name))
+
+        for name in names:
+            visit(name)
+    return plan
+
+
+def compute_metrics(analysis, channel, names, noise=None):
+    """
+    evaluate a few named metrics of one channel outside of a vendor report
+    :return: dict metric name -> value
+    """
+    values = evaluate_plan(plan_metrics(names, [channel]), analysis, noise)
+    return {name: values[(channel, name)] for name in names}
+
+
+def compile_plan(vendors, channels):
+    """
+    Compile the selected vendor reports into one deduplicated plan in dependency order.
+    :param vendors: list of report vendors, see VENDOR_REPORTS
+    :param channels: list of channels available in the data, i.e. ["mct", "sct_row"]
+    :return: list of (channel, metric name), every entry appears once
+    """
+    plan = []
+    visited = set()
+
+    def visit(channel, name):
+        if (channel, name) in visited:
+            return
+        for dep in METRICS[name].deps:
+            visit(channel, dep)
+        visited.add((channel, name))
+        plan.append((channel, name))
+
+    for vendor in vendors:
+        if vendor not in VENDOR_REPORTS:
+            raise ValueError(f"unknown report vendor {vendor}, choose from {list(VENDOR_REPORTS)}")
+        for channel in VENDOR_REPORTS[vendor]["channels"]:
+            if channel not in channels:
+                continue
+            for name in vendor_metrics(vendor):
+                visit(channel, name)
+    return plan
+
+
+def evaluate_plan(plan, analysis, noise=None):
+    """
+    Evaluate every planned metric exactly once.
+    :param plan: output of compile_plan
+    :param analysis: AnalyseData instance
+    :param noise: optional (lo, hi) percentile spread used as p2p noise term
+    :return: dict (channel, metric name) -> value
+    """
+    values = {}
+    contexts = {}
+    for channel, name in plan:
+        if channel not in contexts:
+            contexts[channel] = PlanContext(analysis, channel, noise)
+        metric = METRICS[name]
+        values[(channel, name)] = metric.func(contexts[channel], *[values[(channel, dep)] for dep in metric.deps])
+    return values
+
+
+def _plain(value):
+    """
+    numpy scalars to python numbers, tuples of nodes stay as they are
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def vendor_result(vendor, values, channels, noise=None):
+    """
+    Collect the evaluated metrics of one vendor report into a VendorResult.
+    """
+    report = VENDOR_REPORTS[vendor]
+    channel_results = {}
+    for channel in report["channels"]:
+        if channel not in channels:
+            continue
+        spec = CHANNELS[channel]
+        metrics = {metric: [_plain(val) for val in values[(channel, metric)]] for _, metric in report["columns"]}
+        final_results = {}
+        for metric, value_name, position_name in report["final_results"]:
+            metric_values = values[(channel, metric)]
+            min_value = min(metric_values)
+            final_results[value_name.format(prefix=spec.final_prefix)] = FinalResult(
+                metric, _plain(min_value), metric_values.index(min_value) + 1,
+                position_name.format(prefix=spec.final_prefix))
+        channel_results[channel] = ChannelResult(channel, metrics, final_results)
+    return VendorResult(vendor, report["Vendor"], channel_results, None,
+                        None if noise is None else noise_label(noise))
+
+
+def report_summary(result):
+    """
+    Fan a VendorResult out into the nested summary layout of one vendor, as used by write_out_csv.
+    """
+    report = VENDOR_REPORTS[result.vendor]
+    ret = {"Vendor": result.label}
+    for channel, channel_result in result.channels.items():
+        spec = CHANNELS[channel]
+        table = {column: channel_result.metrics[metric] for column, metric in report["columns"]}
+        final_results = {}
+        for value_name, final in channel_result.final_results.items():
+            final_results[value_name] = "{:.2f}".format(final.value)
+            final_results[final.position_name] = f"Touch {final.touch}"
+        ret[spec.summary_key] = {spec.table_key: table, "final_results": final_results}
+    if result.frames_used is not None:
+        ret["frames_used"] = result.frames_used
+    if result.noise is not None:
+        ret["noise_term"] = result.noise
+    return ret
+
+
+def result_to_json(result):
+    """
+    VendorResult as plain dicts and lists, i.e. for json.dumps
+    """
+    return {
+        "vendor": result.vendor,
+        "label": result.label,
+        "frames_used": result.frames_used,
+        "noise": result.noise or "p2p",
+        "channels": {
+            channel: {
+                "metrics": {name: [list(val) if isinstance(val, tuple) else val for val in vals]
+                            for name, vals in channel_result.metrics.items()},
+                "final_results": {name: final._asdict() for name, final in channel_result.final_results.items()},
+            } for channel, channel_result in result.channels.items()
+        },
+    }
+
+
+def available_channels(analysis):
+    """
+    channels which have no touch data loaded
+    """
+    return [channel for channel, spec in CHANNELS.items()
+            if getattr(analysis.NoTouchFrame, spec.data) is not None]
+
+
+class MetricPlan:
+    def __init__(self, vendors, noise=None):
+        """
+        :param vendors: report vendors, see VENDOR_REPORTS
+        :param noise: optional (lo, hi) percentiles, the percentile spread replaces max - min as p2p noise term
+        """
+        self.vendors = list(vendors)
+        self.noise = noise
+
+    def results(self, analysis):
+        """
+        compute every selected vendor report from one shared evaluation
+        :return: dict vendor -> VendorResult
+        """
+        channels = available_channels(analysis)
+        values = evaluate_plan(compile_plan(self.vendors, channels), analysis, self.noise)
+        return {vendor: vendor_result(vendor, values, channels, self.noise) for vendor in self.vendors}
+
+    def summaries(self, analysis):
+        """
+        :return: dict vendor -> summary dict in the report layout
+        """
+        return {vendor: report_summary(result) for vendor, result in self.results(analysis).items()}
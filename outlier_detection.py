@@ -0,0 +1,97 @@
+"""Module providing spike / glitch frame detection and masked statistics for capture tensors """
+
+from collections import namedtuple
+import numpy as np
+
+# robust z-score of a normal distribution: sigma = 1.4826 * MAD
+MAD_SCALE = 1.4826
+
+# float32 working memory per node block
+OUTLIER_CHUNK_BYTES = 64 * 1024 * 1024
+
+OutlierResult = namedtuple("OutlierResult", ["node_mask", "frame_score", "frame_max_z"])
+
+
+def detect_outliers(data, z_threshold=6.0, min_scale=1.0, chunk_bytes=OUTLIER_CHUNK_BYTES):
+    """
+    Flag samples whose robust z-score |x - median| / (1.4826 * MAD) over frames exceeds z_threshold, per node.
+    Nodes are processed in blocks converted to float32, so only one block sized float copy exists at a time.
+    :param data: capture tensor [frames, ...nodes]
+    :param z_threshold: robust z-score above which a sample is an outlier
+    :param min_scale: lower limit of the noise scale in counts, avoids infinite scores on constant nodes
+    :param chunk_bytes: working memory of one node block
+    :return: OutlierResult(node_mask [frames, ...nodes] bool, frame_score [frames] fraction of outlier nodes,
+             frame_max_z [frames] max robust z-score in the frame)
+    """
+    frame_num = data.shape[0]
+    frames = data.reshape(frame_num, -1)
+    node_num = frames.shape[1]
+    chunk = max(1, chunk_bytes // (frame_num * 4))
+
+    node_mask = np.zeros(frames.shape, dtype=bool)
+    outlier_count = np.zeros(frame_num, dtype=np.int64)
+    frame_max_z = np.zeros(frame_num, dtype=np.float32)
+    for start in range(0, node_num, chunk):
+        block = frames[:, start:start + chunk].astype(np.float32)
+        median = np.median(block, axis=0)
+        dev = np.abs(np.subtract(block, median, out=block), out=block)
+        scale = np.maximum(MAD_SCALE * np.median(dev, axis=0), min_scale)
+        z = np.divide(dev, scale, out=dev)
+        flagged = z > z_threshold
+        node_mask[:, start:start + chunk] = flagged
+        outlier_count += flagged.sum(axis=1)
+        np.maximum(frame_max_z, z.max(axis=1), out=frame_max_z)
+
+    return OutlierResult(node_mask.reshape(data.shape), outlier_count / node_num, frame_max_z)
+
+
+def build_mask(node_mask, rejected_frames):
+    """
+    combine node outliers and whole rejected frames into one mask, True = excluded
+    nodes which would lose every frame keep all of them
+    """
+    mask = node_mask.copy()
+    mask[rejected_frames] = True
+    fully_masked = mask.all(axis=0)
+    if fully_masked.any():
+        mask[:, fully_masked] = False
+    return mask
+
+
+# *******************************************************************
+# ************    masked reductions over frames *********************
+# *******************************************************************
+
+def _lowest(dtype):
+    return np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else -np.inf
+
+
+def _highest(dtype):
+    return np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else np.inf
+
+
+def masked_max(data, mask):
+    return np.max(data, axis=0, where=~mask, initial=_lowest(data.dtype))
+
+
+def masked_min(data, mask):
+    return np.min(data, axis=0, where=~mask, initial=_highest(data.dtype))
+
+
+def masked_mean(data, mask):
+    return np.mean(data, axis=0, where=~mask)
+
+
+def masked_rms(data, mask):
+    return np.sqrt(np.var(data, axis=0, where=~mask))
+
+
+def masked_signal_position(data, mask):
+    """
+    position of the max value over all kept samples, same layout as np.unravel_index on data
+    """
+    node = np.unravel_index(masked_max(data, mask).argmax(), data.shape[1:])
+    series = data[(slice(None),) + node]
+    keep = ~mask[(slice(None),) + node]
+    frame = np.flatnonzero(keep)[series[keep].argmax()]
+    return (frame,) + node
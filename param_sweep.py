@@ -0,0 +1,245 @@
+"""Module providing the parameter sweep runner: many analysis configurations over captures which are loaded once """
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+from collections import namedtuple
+from ETS_Dataframe import HEADER_ETS, ETS_Dataframe, parse_frame_slice
+from ETS_Analysis import AnalyseData, get_pattern_capture_paths
+from metric_plan import VENDOR_REPORTS
+from percentile_noise import parse_noise
+
+# one analysis configuration, frames and noise are kept as their command line text
+SweepConfig = namedtuple("SweepConfig", ["frames", "noise", "vendor", "plots"])
+
+# sweep plot name -> AnalyseData method drawing it
+SWEEP_PLOTS = {
+    "noise_p2p": "plot_mct_noise_p2p",
+    "noise_rms": "plot_mct_noise_rms",
+    "noise_p2p_annotated": "plot_mct_noise_p2p_annotated",
+    "all_touch_signal": "plot_touch_signal_all",
+    "snr_map": "write_out_snr_map",
+}
+
+SWEEP_COLUMNS = ["config", "frames", "noise", "vendor", "plots", "pattern", "channel", "result", "value",
+                 "touch", "position"]
+
+
+def config_label(config):
+    return "frames={};noise={};vendor={}{}".format(config.frames or "all", config.noise or "p2p", config.vendor,
+                                                   ";plots=" + "+".join(config.plots) if config.plots else "")
+
+
+def window_label(frames):
+    """
+    folder name of a frame window, i.e. "frames_100-400", "frames_0-end_step2"
+    """
+    if not frames:
+        return "frames_all"
+    window = parse_frame_slice(frames)
+    label = "frames_{}-{}".format(window.start or 0, "end" if window.stop is None else window.stop)
+    return label if window.step is None else label + f"_step{window.step}"
+
+
+def build_grid(frames=None, noise=None, vendors=None, plots=None):
+    """
+    cartesian product of the sweep axes
+    :param frames: list of frame window texts ("" or None = all frames)
+    :param noise: list of noise term texts, see percentile_noise.parse_noise
+    :param vendors: list of report vendors
+    :param plots: list of plot name lists, see SWEEP_PLOTS
+    :return: list of SweepConfig
+    """
+    frames = [None] if not frames else [text or None for text in frames]
+    noise = [None] if not noise else [None if text in ["", "p2p"] else text for text in noise]
+    vendors = ["BOE"] if not vendors else vendors
+    plots = [()] if not plots else [tuple(names) for names in plots]
+    for vendor in vendors:
+        if vendor not in VENDOR_REPORTS:
+            raise ValueError(f"unknown report vendor {vendor}, choose from {list(VENDOR_REPORTS)}")
+    for names in plots:
+        for name in names:
+            if name not in SWEEP_PLOTS:
+                raise ValueError(f"unknown sweep plot {name}, choose from {list(SWEEP_PLOTS)}")
+    # reject invalid texts before anything is loaded
+    for text in frames:
+        parse_frame_slice(text)
+    for text in noise:
+        parse_noise(text)
+    return [SweepConfig(*values) for values in itertools.product(frames, noise, vendors, plots)]
+
+
+def load_grid(path):
+    """
+    sweep grid from a json file {"frames": [...], "noise": [...], "vendors": [...], "plots": [[...], ...]}
+    """
+    with open(path) as f:
+        grid = json.load(f)
+    return build_grid(grid.get("frames"), grid.get("noise"), grid.get("vendors"), grid.get("plots"))
+
+
+def window_frame(Frame, frames):
+    """
+    capture restricted to a frame window, the frames are views of the loaded capture and not copied, the loaded
+    capture itself is never modified by the preprocessing of a window
+    """
+    Windowed = ETS_Dataframe.from_arrays(mct=Frame.mct_grid, sct_row=Frame.sct_row, sct_col=Frame.sct_col,
+                                         frames=parse_frame_slice(frames), channels=Frame.channels)
+    Windowed.row_num, Windowed.col_num = Frame.row_num, Frame.col_num
+    return Windowed
+
+
+class PatternSweep:
+    def __init__(self, pattern, notouch_path, touch_paths, detrend=None, outliers=None):
+        """
+        all configurations of one pattern, its captures are loaded exactly once
+        :param detrend: optional (method, param) drift removal, applied per frame window
+        :param outliers: optional (z_threshold, frame_fraction) outlier rejection, applied per frame window
+        """
+        self.pattern = pattern
+        self.detrend = detrend
+        self.outliers = outliers
+        self.base = AnalyseData(no_touch_file_path=notouch_path, touch_file_paths=touch_paths,
+                                Header_index=HEADER_ETS)
+        self.windows = {}
+        self.results = {}
+        self.plotted = set()
+
+    def analysis(self, frames):
+        """
+        one analysis per frame window, shared by every configuration on that window, so that per node statistics
+        and percentile spreads of its captures are computed once
+        """
+        if frames not in self.windows:
+            analysis = AnalyseData.from_frames(window_frame(self.base.NoTouchFrame, frames),
+                                               [window_frame(TouchFrame, frames)
+                                                for TouchFrame in self.base.TouchFrameSets],
+                                               pattern=self.pattern, detrend=self.detrend, outliers=self.outliers)
+            analysis.output_folder = os.path.join(self.base._output_folder, "sweep", window_label(frames))
+            self.windows[frames] = analysis
+        return self.windows[frames]
+
+    def vendor_results(self, frames, noise, vendors):
+        """
+        results of all vendors of one (frame window, noise) from a single metric plan
+        :return: dict vendor -> VendorResult
+        """
+        key = (frames, noise)
+        if key not in self.results:
+            analysis = self.analysis(frames)
+            analysis.noise = parse_noise(noise)
+            self.results[key] = analysis.snr_results(vendors)
+        return self.results[key]
+
+    def plot(self, frames, names):
+        """
+        plots only depend on the frame window, each one is drawn once
+        """
+        for name in names:
+            if (frames, name) in self.plotted:
+                continue
+            analysis = self.analysis(frames)
+            if analysis.NoTouchFrame.mct_grid is None:
+                continue
+            getattr(analysis, SWEEP_PLOTS[name])()
+            self.plotted.add((frames, name))
+            # plotting libraries are only loaded here when a plot was drawn
+            from matplotlib import pyplot as plt
+            plt.close("all")
+
+    def run(self, configs):
+        """
+        :return: rows of the combined sweep table, see SWEEP_COLUMNS
+        """
+        vendors = [vendor for vendor in VENDOR_REPORTS if any(config.vendor == vendor for config in configs)]
+        rows = []
+        for config in configs:
+            result = self.vendor_results(config.frames, config.noise, vendors)[config.vendor]
+            self.plot(config.frames, config.plots)
+            for channel, channel_result in result.channels.items():
+                for name, final in channel_result.final_results.items():
+                    # touched node of the touch which gives the final result, every vendor report has touched_node
+                    position = channel_result.metrics["touched_node"][final.touch - 1]
+                    rows.append([config_label(config), config.frames or "all", config.noise or "p2p",
+                                 config.vendor, "+".join(config.plots), self.pattern, channel, name,
+                                 "{:.2f}".format(final.value), final.touch, position])
+        return rows
+
+
+def run_sweep(dataset, patterns, prefix_notouch, prefix_touch, configs, detrend=None, outliers=None):
+    """
+    run every configuration on every pattern, one pattern is held in memory at a time
+    :return: rows of the combined sweep table
+    """
+    rows = []
+    for pattern in patterns:
+        notouch_path, touch_paths = get_pattern_capture_paths(dataset, pattern, prefix_notouch, prefix_touch)
+        rows.extend(PatternSweep(pattern, notouch_path, touch_paths, detrend, outliers).run(configs))
+    return rows
+
+
+def write_sweep_csv(path, rows):
+    with open(path, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(SWEEP_COLUMNS)
+        writer.writerows(rows)
+    print("Successfully generate {}!!!!!".format(path))
+
+
+class ParamSweepOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="run a grid of snr analysis configurations, every capture "
+                                                          "is loaded once")
+
+        self.parser.add_argument("--dataset", type=str, help="folder path to the raw data", required=True)
+
+        self.parser.add_argument("--pattern_folder", nargs='+', help="pattern folders of the dataset",
+                                 required=True)
+
+        self.parser.add_argument("--prefix_notouch", type=str, help="file name prefix of the no touch capture",
+                                 default="wo")
+
+        self.parser.add_argument("--prefix_touch", type=str, help="file name prefix of the touch captures",
+                                 default="w")
+
+        self.parser.add_argument("--grid", type=str, help="json file with the sweep axes frames, noise, vendors "
+                                                          "and plots, replaces the axis options below",
+                                 default=None)
+
+        self.parser.add_argument("--frames", nargs='+', help="frame windows to sweep, i.e. :300 300:600, "
+                                                             "use all for every frame", default=None)
+
+        self.parser.add_argument("--noise", nargs='+', help="noise terms to sweep, i.e. p2p pctl:0.1:99.9",
+                                 default=None)
+
+        self.parser.add_argument("--report_vendor", nargs='+', help="report vendors to sweep", default=None)
+
+        self.parser.add_argument("--plots", nargs='+', help=f"plots drawn for every frame window, "
+                                                            f"from {list(SWEEP_PLOTS)}", default=None)
+
+        self.parser.add_argument("--output", type=str, help="combined sweep table, "
+                                                            "<dataset>/sweep_summary.csv if not set", default=None)
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        return self.options
+
+
+if __name__ == '__main__':
+    opts = ParamSweepOptions().parse()
+    if opts.grid is not None:
+        sweep_configs = load_grid(opts.grid)
+    else:
+        sweep_configs = build_grid([None if text == "all" else text for text in opts.frames or []], opts.noise,
+                                   opts.report_vendor, [opts.plots] if opts.plots else None)
+
+    start = time.perf_counter()
+    sweep_rows = run_sweep(opts.dataset, opts.pattern_folder, opts.prefix_notouch, opts.prefix_touch, sweep_configs)
+    write_sweep_csv(opts.output or os.path.join(opts.dataset, "sweep_summary.csv"), sweep_rows)
+    print(f"{len(sweep_configs)} configurations x {len(opts.pattern_folder)} patterns in "
+          f"{time.perf_counter() - start:.2f} s")
+    sys.exit(0)
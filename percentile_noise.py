@@ -0,0 +1,98 @@
+"""Module providing percentile and robust spread noise over frames via partition based selection """
+
+import numpy as np
+
+# working memory per node block
+PERCENTILE_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def parse_noise(text):
+    """
+    parse a noise term as used by --noise
+    :param text: "p2p" (max - min over frames) or "pctl:<lo>:<hi>", i.e. "pctl:0.1:99.9"
+    :return: None for p2p or (lo, hi) percentiles
+    """
+    if text is None or text == "" or text == "p2p":
+        return None
+    method, _, param = text.partition(":")
+    if method != "pctl":
+        raise ValueError(f"unknown noise term {text}, use p2p or pctl:<lo>:<hi>")
+    lo, _, hi = param.partition(":")
+    lo, hi = float(lo or 0.1), float(hi or 100 - float(lo or 0.1))
+    if not 0 <= lo < hi <= 100:
+        raise ValueError(f"invalid percentiles {text}, expected 0 <= lo < hi <= 100")
+    return lo, hi
+
+
+def noise_label(noise):
+    """
+    report label of a noise term, i.e. "p0.1-p99.9"
+    """
+    return "p2p" if noise is None else "p{:g}-p{:g}".format(*noise)
+
+
+def _ranks(frame_num, q):
+    """
+    linear interpolation ranks of a percentile, same as np.percentile(method="linear")
+    :return: (lower rank, upper rank, weight of the upper rank)
+    """
+    pos = (frame_num - 1) * q / 100.0
+    lower = int(np.floor(pos))
+    return lower, min(lower + 1, frame_num - 1), pos - lower
+
+
+def _partition_percentiles(block, ranks, out, cols):
+    """
+    write the interpolated percentiles of the nodes of block [frames, nodes] to out[..][cols]
+    :param ranks: list of _ranks per percentile, the same for all nodes of the block
+    """
+    kth = sorted({rank for lower, upper, _ in ranks for rank in (lower, upper)})
+    block = np.partition(block, kth, axis=0)
+    for ret, (lower, upper, weight) in zip(out, ranks):
+        ret[cols] = block[lower] * (1 - weight) + block[upper] * weight
+
+
+def percentiles(data, qs, mask=None, chunk_bytes=PERCENTILE_CHUNK_BYTES):
+    """
+    Per node percentiles over frames for all nodes at once. One np.partition per node block places only the
+    needed ranks, no full sort of the frames is done.
+    :param data: capture tensor [frames, ...nodes]
+    :param qs: percentiles in [0, 100]
+    :param mask: optional bool mask like data, True = excluded. Masked samples are moved behind the kept ones
+                 as +inf and the ranks follow the kept frame count of the node, nan where no frame is kept
+    :return: list of [...nodes] arrays, one per percentile
+    """
+    frame_num = data.shape[0]
+    frames = data.reshape(frame_num, -1)
+    node_mask = None if mask is None else mask.reshape(frame_num, -1)
+    ranks = [_ranks(frame_num, q) for q in qs]
+    out = [np.empty(frames.shape[1]) for _ in qs]
+
+    itemsize = frames.dtype.itemsize if mask is None else max(frames.dtype.itemsize, 8)
+    chunk = max(1, chunk_bytes // (frame_num * itemsize))
+    for start in range(0, frames.shape[1], chunk):
+        cols = slice(start, start + chunk)
+        if node_mask is None or not node_mask[:, cols].any():
+            _partition_percentiles(frames[:, cols], ranks, out, cols)
+            continue
+        block_mask = node_mask[:, cols]
+        block = np.where(block_mask, np.inf, frames[:, cols])
+        kept = frame_num - np.count_nonzero(block_mask, axis=0)
+        # nodes with the same kept frame count share their ranks, a rejected frame gives one group for all nodes
+        for count in np.unique(kept):
+            group = np.flatnonzero(kept == count)
+            if count == 0:
+                for ret in out:
+                    ret[start + group] = np.nan
+                continue
+            _partition_percentiles(block[:, group], [_ranks(count, q) for q in qs], out, start + group)
+
+    return [ret.reshape(data.shape[1:]) for ret in out]
+
+
+def percentile_spread(data, lo, hi, mask=None):
+    """
+    robust spread noise per node: percentile hi - percentile lo over frames, p0-p100 is the p2p noise
+    """
+    low, high = percentiles(data, [lo, hi], mask)
+    return high - low
@@ -0,0 +1,119 @@
+"""Module providing the phase sweep snr: compensated signal and noise of every node over a range of demodulation angles """
+
+from collections import namedtuple
+import numpy as np
+from phase_utilities import calc_phase_compensation
+from snr_map import snr_db
+
+# working memory of one [angles, frames, nodes] block
+SWEEP_CHUNK_BYTES = 64 * 1024 * 1024
+
+# angles: [K] radians
+# noise: [K, ...nodes] p2p of the compensated no touch frames
+# signal: [touches, K, ...nodes] mean compensated touch delta (reference - touch) over frames
+# node_signal: [K, ...nodes] signal of the strongest touch delta of every node
+# snr_dB: [K, ...nodes] snr of node_signal
+# touch_nodes: touched node of every touch capture
+# touch_snr_dB: [touches, K] snr curve at the touched node of every touch capture
+# peak_angles: single node phase compensation of every touch (calc_phase_compensation at its touched node)
+PhaseSweep = namedtuple("PhaseSweep", ["angles", "noise", "signal", "node_signal", "snr_dB", "touch_nodes",
+                                       "touch_snr_dB", "peak_angles"])
+
+# snr differences below this are ties, i.e. real captures where signal and noise scale alike with the angle
+SNR_TIE_DB = 1e-6
+
+
+def sweep_angles(angle_num):
+    """
+    :return: angle_num equally spaced angles over [0, 2pi)
+    """
+    return np.linspace(0, 2 * np.pi, angle_num, endpoint=False)
+
+
+def compensated_stats(data, angles, reference=None, chunk_bytes=SWEEP_CHUNK_BYTES):
+    """
+    Real part of the phase compensated frames, exp(1j * angle) * (reference - frame), for all angles, frames and
+    nodes as one broadcast [angles, frames, nodes] per node block.
+    :param data: capture tensor [frames, ...nodes], complex or real
+    :param angles: [K] compensation angles in radians
+    :param reference: optional [...nodes] reference, the frames are used as they are if None
+    :return: (mean over frames [K, ...nodes], p2p over frames [K, ...nodes])
+    """
+    frame_num = data.shape[0]
+    frames = data.reshape(frame_num, -1)
+    if reference is not None:
+        frames = reference.reshape(1, -1) - frames
+    cos = np.cos(angles)[:, None, None]
+    sin = np.sin(angles)[:, None, None]
+    mean = np.empty((len(angles), frames.shape[1]))
+    p2p = np.empty((len(angles), frames.shape[1]))
+
+    chunk = max(1, chunk_bytes // (len(angles) * frame_num * 8))
+    for start in range(0, frames.shape[1], chunk):
+        block = frames[:, start:start + chunk]
+        # real(exp(1j * a) * z) = cos(a) * real(z) - sin(a) * imag(z)
+        compensated = cos * np.real(block)[None] - sin * np.imag(block)[None]
+        mean[:, start:start + chunk] = compensated.mean(axis=1)
+        p2p[:, start:start + chunk] = compensated.max(axis=1) - compensated.min(axis=1)
+    return mean.reshape((len(angles),) + data.shape[1:]), p2p.reshape((len(angles),) + data.shape[1:])
+
+
+def phase_sweep(notouch, touches, angle_num=72):
+    """
+    snr of every node against the compensation angle
+    :param notouch: no touch frames [frames, ...nodes]
+    :param touches: list of touch frames [frames, ...nodes]
+    :param angle_num: number of swept angles over [0, 2pi)
+    :return: PhaseSweep
+    """
+    angles = sweep_angles(angle_num)
+    reference = notouch.mean(axis=0)
+    _, noise = compensated_stats(notouch, angles)
+    signal = np.stack([compensated_stats(touch, angles, reference)[0] for touch in touches])
+
+    # every node is judged by the touch capture with the strongest delta at the node
+    deltas = np.stack([np.abs(reference - touch.mean(axis=0)) for touch in touches])
+    strongest = np.argmax(deltas, axis=0)
+    node_signal = np.take_along_axis(signal, strongest[None, None], axis=0)[0]
+    snr = snr_db(node_signal, noise)
+
+    touch_nodes, touch_snr, peak_angles = [], [], []
+    for idx, touch in enumerate(touches):
+        node = np.unravel_index(np.argmax(deltas[idx]), deltas[idx].shape)
+        touch_nodes.append(tuple(int(val) for val in node))
+        touch_snr.append(snr_db(signal[(idx, slice(None)) + node], noise[(slice(None),) + node]))
+        peak_angles.append(calc_phase_compensation(complex((reference - touch.mean(axis=0))[node])))
+    return PhaseSweep(angles, noise, signal, node_signal, snr, touch_nodes, np.array(touch_snr), peak_angles)
+
+
+def _best_index(snr, signal):
+    """
+    index along axis 0 of the max snr, ties are resolved by the larger compensated signal
+    """
+    snr = np.nan_to_num(snr, nan=-np.inf)
+    ties = snr >= snr.max(axis=0) - SNR_TIE_DB
+    return np.argmax(np.where(ties, signal, -np.inf), axis=0)
+
+
+def optimal_angle_map(sweep):
+    """
+    :return: angle in degree which maximizes the snr of every node
+    """
+    return np.degrees(sweep.angles[_best_index(sweep.snr_dB, sweep.node_signal)])
+
+
+def panel_min_curve(sweep):
+    """
+    :return: [K] min snr over the touched nodes for every angle
+    """
+    return sweep.touch_snr_dB.min(axis=0)
+
+
+def best_panel_angle(sweep):
+    """
+    :return: (angle in degree which maximizes the min snr over the touched nodes, that min snr)
+    """
+    curve = panel_min_curve(sweep)
+    touch_signal = np.array([sweep.signal[(idx, slice(None)) + node] for idx, node in enumerate(sweep.touch_nodes)])
+    idx = int(_best_index(curve, touch_signal.min(axis=0)))
+    return np.degrees(sweep.angles[idx]), curve[idx]
@@ -0,0 +1,273 @@
+"""Module providing the regression gate: golden captures, reference summaries and stage runtime baselines """
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from ETS_Dataframe import ETS_Dataframe, new_header_index
+from ETS_Analysis import AnalyseData, get_pattern_capture_paths
+
+GATE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+REFERENCE_FILE = os.path.join(GATE_FOLDER, "reference.json")
+
+# golden dataset: pattern -> touch nodes (row, col), a fixed seed makes the captures reproducible
+GOLDEN_SEED = 20220701
+GOLDEN_GRID = (16, 28)
+GOLDEN_FRAMES = 300
+GOLDEN_PATTERNS = {
+    "White": [(1, 2), (8, 14), (14, 25)],
+    "Z1": [(0, 0), (5, 20), (15, 27)],
+}
+
+# summary method of AnalyseData -> vendor
+GOLDEN_SUMMARIES = {
+    "BOE_snr_summary": "BOE",
+    "HW_quick_snr_summary": "Huawei_quick",
+    "HW_thp_afe_snr_summary": "Huawei_thp_afe",
+}
+
+STAGES = ["load", "stats"] + list(GOLDEN_SUMMARIES)
+
+
+def write_golden_capture(path, rng, touch=None, grid=GOLDEN_GRID, frame_num=GOLDEN_FRAMES):
+    """
+    write one capture in the .edl.csv layout parsed by ETS_Dataframe
+    :param rng: np.random.Generator, consumed in a fixed order
+    :param touch: touched node (row, col), None for a no touch capture
+    """
+    row_num, col_num = grid
+    header = ["Frame"] + [f"mct_deltas.values[{row}][{col}]" for row in range(row_num) for col in range(col_num)] \
+        + [f"sct_row_deltas[{col}]" for col in range(col_num)] + [f"sct_col_deltas[{row}]" for row in range(row_num)]
+
+    mct = rng.normal(0, 6, (frame_num, row_num, col_num)) + np.linspace(0, 3, frame_num)[:, None, None]
+    sct_row = rng.normal(0, 5, (frame_num, col_num))
+    sct_col = rng.normal(0, 5, (frame_num, row_num))
+    if touch is not None:
+        row, col = touch
+        mct[:, row, col] += 450 + rng.normal(0, 12, frame_num)
+        sct_row[:, col] += 320 + rng.normal(0, 8, frame_num)
+        sct_col[:, row] += 320 + rng.normal(0, 8, frame_num)
+    values = np.concatenate([mct.reshape(frame_num, -1), sct_row, sct_col], axis=1).round().astype(int)
+
+    with open(path, "w") as f:
+        f.write(",".join(header) + ",\n")
+        for idx, frame in enumerate(values):
+            f.write(",".join([str(idx)] + [str(val) for val in frame]) + ",\n")
+
+
+def make_golden_dataset(folder, seed=GOLDEN_SEED):
+    """
+    generate the golden dataset, pattern folders with wo.edl.csv and w<n>.edl.csv
+    :return: dict pattern -> (no touch path, [touch path, ...])
+    """
+    rng = np.random.default_rng(seed)
+    ret = {}
+    for pattern, touches in GOLDEN_PATTERNS.items():
+        pattern_folder = os.path.join(folder, pattern)
+        if not os.path.exists(pattern_folder):
+            os.makedirs(pattern_folder)
+        write_golden_capture(os.path.join(pattern_folder, "wo.edl.csv"), rng)
+        for idx, touch in enumerate(touches):
+            write_golden_capture(os.path.join(pattern_folder, f"w{idx + 1}.edl.csv"), rng, touch)
+        ret[pattern] = get_pattern_capture_paths(folder, pattern, "wo", "w")
+    return ret
+
+
+def _jsonable(value):
+    """
+    summary values as plain json values, tuples of nodes become lists
+    """
+    if isinstance(value, dict):
+        return {str(key): _jsonable(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(val) for val in value]
+    if isinstance(value, np.ndarray):
+        return _jsonable(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def run_golden(paths):
+    """
+    run the stages on the golden dataset once
+    :param paths: output of make_golden_dataset
+    :return: (dict pattern -> summary method -> summary, dict stage -> seconds summed over patterns)
+    """
+    summaries = {}
+    seconds = dict.fromkeys(STAGES, 0.0)
+    for pattern, (notouch_path, touch_paths) in paths.items():
+        start = time.perf_counter()
+        NoTouchFrame = ETS_Dataframe(notouch_path, new_header_index())
+        TouchFrames = [ETS_Dataframe(path, new_header_index()) for path in touch_paths]
+        seconds["load"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for Frame in [NoTouchFrame] + TouchFrames:
+            Frame.cache_stats()
+        seconds["stats"] += time.perf_counter() - start
+
+        summaries[pattern] = {}
+        for method in GOLDEN_SUMMARIES:
+            # a fresh analysis per summary, no metric is shared between the timed stages
+            analysis = AnalyseData.from_frames(NoTouchFrame, TouchFrames, pattern=pattern)
+            start = time.perf_counter()
+            summaries[pattern][method] = _jsonable(getattr(analysis, method)())
+            seconds[method] += time.perf_counter() - start
+    return summaries, seconds
+
+
+def measure_golden(paths, repeat=3):
+    """
+    :return: (summaries of the last run, dict stage -> best seconds over repeat runs)
+    """
+    summaries, best = None, None
+    for _ in range(repeat):
+        summaries, seconds = run_golden(paths)
+        best = seconds if best is None else {stage: min(best[stage], seconds[stage]) for stage in STAGES}
+    return summaries, best
+
+
+def compare_values(reference, current, rtol=1e-9, path=""):
+    """
+    :return: list of mismatch descriptions, empty if current equals reference (numbers up to rtol)
+    """
+    if isinstance(reference, dict) and isinstance(current, dict):
+        ret = []
+        for key in sorted(set(reference) | set(current)):
+            if key not in current or key not in reference:
+                ret.append(f"{path}/{key}: {'missing' if key not in current else 'unexpected'}")
+                continue
+            ret.extend(compare_values(reference[key], current[key], rtol, f"{path}/{key}"))
+        return ret
+    if isinstance(reference, list) and isinstance(current, list):
+        if len(reference) != len(current):
+            return [f"{path}: {len(current)} values, expected {len(reference)}"]
+        ret = []
+        for idx, (ref, cur) in enumerate(zip(reference, current)):
+            ret.extend(compare_values(ref, cur, rtol, f"{path}[{idx}]"))
+        return ret
+    numbers = (int, float)
+    if isinstance(reference, numbers) and isinstance(current, numbers) \
+            and not isinstance(reference, bool) and not isinstance(current, bool):
+        if np.isclose(current, reference, rtol=rtol, atol=0.0, equal_nan=True):
+            return []
+    elif reference == current:
+        return []
+    return [f"{path}: {current!r}, expected {reference!r}"]
+
+
+def compare_runtimes(baseline, seconds, tolerance=0.5, min_seconds=0.005):
+    """
+    :param baseline: dict stage -> reference seconds
+    :param tolerance: allowed slow down, 0.5 = 50 % slower
+    :param min_seconds: absolute slack, timer noise of very short stages is not a regression
+    :return: list of (stage, baseline seconds, seconds, ratio, passed)
+    """
+    ret = []
+    for stage in STAGES:
+        if stage not in baseline:
+            continue
+        ratio = seconds[stage] / max(baseline[stage], 1e-9)
+        passed = seconds[stage] <= baseline[stage] * (1 + tolerance) + min_seconds
+        ret.append((stage, baseline[stage], seconds[stage], ratio, passed))
+    return ret
+
+
+def write_reference(path, summaries, seconds):
+    folder = os.path.dirname(path)
+    if folder != "" and not os.path.exists(folder):
+        os.makedirs(folder)
+    reference = {"seed": GOLDEN_SEED, "grid": list(GOLDEN_GRID), "frames": GOLDEN_FRAMES,
+                 "summaries": summaries, "runtimes": seconds}
+    with open(path, "w") as f:
+        json.dump(reference, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+
+class RegressionGateOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="check summaries and stage runtimes on golden captures")
+
+        self.parser.add_argument("--reference", type=str, help="reference file of summaries and runtimes",
+                                 default=REFERENCE_FILE)
+
+        self.parser.add_argument("--update", help="store the current summaries and runtimes as reference",
+                                 action="store_true")
+
+        self.parser.add_argument("--update_runtimes", help="store only the current runtimes as baseline",
+                                 action="store_true")
+
+        self.parser.add_argument("--repeat", type=int, help="runs per check, best time counts", default=3)
+
+        self.parser.add_argument("--tolerance", type=float, help="allowed slow down per stage, 0.5 = 50 %%",
+                                 default=0.5)
+
+        self.parser.add_argument("--min_ms", type=float, help="absolute runtime slack per stage in ms", default=5.0)
+
+        self.parser.add_argument("--scale", type=float, help="multiplier of all runtime baselines, i.e. for slow "
+                                                             "build machines", default=1.0)
+
+        self.parser.add_argument("--rtol", type=float, help="relative tolerance of numeric equality", default=1e-9)
+
+        self.parser.add_argument("--skip_runtimes", help="check the summaries only", action="store_true")
+
+        self.parser.add_argument("--keep", type=str, help="generate the golden captures into this folder and keep "
+                                                          "them, a temporary folder is used if not set",
+                                 default=None)
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        return self.options
+
+
+if __name__ == '__main__':
+    opts = RegressionGateOptions().parse()
+
+    folder = tempfile.mkdtemp(prefix="ets_golden_") if opts.keep is None else opts.keep
+    try:
+        golden_paths = make_golden_dataset(folder)
+        current_summaries, current_seconds = measure_golden(golden_paths, opts.repeat)
+    finally:
+        if opts.keep is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    if opts.update or opts.update_runtimes:
+        if opts.update_runtimes and os.path.exists(opts.reference):
+            with open(opts.reference) as f:
+                current_summaries = json.load(f)["summaries"]
+        write_reference(opts.reference, current_summaries, current_seconds)
+        print("Successfully generate {}!!!!!".format(opts.reference))
+        sys.exit(0)
+
+    if not os.path.exists(opts.reference):
+        print(f"FAIL no reference {opts.reference}, create it with --update")
+        sys.exit(1)
+    with open(opts.reference) as f:
+        reference = json.load(f)
+
+    mismatches = compare_values(reference["summaries"], current_summaries, opts.rtol)
+    for mismatch in mismatches[:20]:
+        print(f"FAIL summary {mismatch}")
+    if len(mismatches) > 20:
+        print(f"FAIL ... {len(mismatches) - 20} more summary mismatches")
+    if len(mismatches) == 0:
+        print(f"ok   summaries: {len(GOLDEN_PATTERNS)} patterns x {len(GOLDEN_SUMMARIES)} reports match")
+
+    slower = []
+    if not opts.skip_runtimes:
+        baseline = {stage: seconds * opts.scale for stage, seconds in reference["runtimes"].items()}
+        print(f"{'stage':<24}{'baseline ms':>12}{'current ms':>12}{'ratio':>8}")
+        for stage, base, seconds, ratio, passed in compare_runtimes(baseline, current_seconds, opts.tolerance,
+                                                                     opts.min_ms / 1000):
+            print(f"{stage:<24}{base * 1000:>12.1f}{seconds * 1000:>12.1f}{ratio:>8.2f}  {'ok' if passed else 'SLOWER'}")
+            if not passed:
+                slower.append(stage)
+        for stage in slower:
+            print(f"FAIL runtime {stage} is more than {opts.tolerance:.0%} slower than the baseline")
+
+    sys.exit(0 if len(mismatches) == 0 and len(slower) == 0 else 1)
@@ -0,0 +1,112 @@
+"""Module providing the per pattern result cache for incremental result_summary.csv rebuilds """
+
+import os
+import json
+import hashlib
+import datetime
+from result_files import cached_file_hash, safe_name, restore_summary, write_json
+
+RESULT_CACHE_FORMAT = "ets_snr_result_cache_v1"
+RESULT_CACHE_EXT = ".result.json"
+FILE_HASHES_NAME = "file_hashes.json"
+
+# options which do not change the results or outputs of a pattern
+RESULT_CACHE_IGNORED_OPTIONS = [
+    "dataset", "pattern_folder", "manifest", "shard", "partial_dir", "merge_partials", "merge_output",
+    "results_db", "run_id", "prefetch_depth", "prefetch_memory_mb", "memory_budget", "spill_dir",
+    "result_cache", "result_cache_dir",
+]
+
+
+def options_key(options):
+    """
+    the analysis options of a run which affect the results of a pattern
+    :param options: argparse namespace or dict
+    :return: dict option -> json value
+    """
+    options = vars(options) if not isinstance(options, dict) else options
+    return {name: json.loads(json.dumps(value, default=str)) for name, value in sorted(options.items())
+            if name not in RESULT_CACHE_IGNORED_OPTIONS}
+
+
+class ResultCache:
+    def __init__(self, cache_dir):
+        """
+        Final results and vendor summaries of every pattern, keyed by the content hashes of its captures and the
+        analysis options. Capture hashes are kept per path, size and modification time, so an unchanged rerun
+        reads no capture at all.
+        :param cache_dir: cache folder, i.e. <dataset>/result_cache
+        """
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.file_hashes = {}
+        hashes_path = os.path.join(cache_dir, FILE_HASHES_NAME)
+        if os.path.exists(hashes_path):
+            with open(hashes_path, encoding="UTF8") as f:
+                self.file_hashes = json.load(f)
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, pattern):
+        return os.path.join(self.cache_dir, safe_name(pattern) + RESULT_CACHE_EXT)
+
+    def key(self, pattern, capture_paths, options):
+        """
+        :param capture_paths: no touch path followed by the touch paths
+        :return: (cache key, list of capture hashes)
+        """
+        input_hashes = [cached_file_hash(path, self.file_hashes) for path in capture_paths]
+        text = json.dumps([RESULT_CACHE_FORMAT, pattern, [os.path.basename(path) for path in capture_paths],
+                           input_hashes, options_key(options)], sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest(), input_hashes
+
+    def get(self, pattern, key):
+        """
+        :return: cached entry of the pattern if its key matches and its output files still exist, else None
+        """
+        path = self.entry_path(pattern)
+        entry = None
+        if os.path.exists(path):
+            with open(path, encoding="UTF8") as f:
+                entry = json.load(f)
+            if entry.get("format") != RESULT_CACHE_FORMAT or entry.get("key") != key or \
+                    not all(os.path.exists(output) for output in entry.get("outputs", [])):
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry["summaries"] = {vendor: restore_summary(summary) for vendor, summary in entry["summaries"].items()}
+        return entry
+
+    def put(self, pattern, key, input_hashes, summaries, final_result, touch_num, output_folder, outputs=()):
+        """
+        store the results of a freshly analysed pattern
+        :param summaries: dict vendor -> summary
+        :param final_result: row of result_summary.csv or None
+        :param outputs: report files of the pattern, the entry is dropped when one of them is gone
+        """
+        entry = {
+            "format": RESULT_CACHE_FORMAT,
+            "pattern": pattern,
+            "key": key,
+            "input_hashes": input_hashes,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "touch_num": touch_num,
+            "output_folder": output_folder,
+            "outputs": list(outputs),
+            "summaries": summaries,
+            "final_result": final_result,
+        }
+        # written then renamed so an interrupted run never leaves a half written entry
+        write_json(self.entry_path(pattern), entry)
+
+    def save(self):
+        """
+        persist the capture hashes for the next run
+        """
+        write_json(os.path.join(self.cache_dir, FILE_HASHES_NAME), self.file_hashes)
+
+    def report(self):
+        return f"result cache: reuse {self.hits} patterns, analyse {self.misses} patterns"
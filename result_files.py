@@ -0,0 +1,77 @@
+"""Module providing the json encoding, file naming and content hash helpers shared by the result files """
+
+import os
+import re
+import json
+import hashlib
+import numpy as np
+
+
+def file_sha256(file_path, block_size=1 << 20):
+    """
+    Hash a capture file by content so that results can be matched to the exact input data.
+    :param file_path: path of the file to hash
+    :param block_size: read size in bytes
+    :return: hex digest string
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cached_file_hash(file_path, file_hashes):
+    """
+    content hash of a capture, reused from file_hashes while size and modification time are unchanged
+    :param file_hashes: dict "path|size|mtime" -> sha256, updated in place
+    """
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    if key not in file_hashes:
+        file_hashes[key] = file_sha256(file_path)
+    return file_hashes[key]
+
+
+def to_json(value):
+    """
+    json default for the numpy values of summaries
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value)} is not serializable")
+
+
+def safe_name(pattern):
+    """
+    pattern name usable in file names
+    """
+    return re.sub(r"[^0-9A-Za-z_.-]+", "_", pattern).strip("_")
+
+
+def restore_summary(summary):
+    """
+    vendor summary read back from json, json turns touched node tuples into lists
+    """
+    for key, section in summary.items():
+        if not isinstance(section, dict):
+            continue
+        for table in section.values():
+            if isinstance(table, dict) and "touched node" in table:
+                table["touched node"] = [tuple(node) if isinstance(node, list) else node
+                                         for node in table["touched node"]]
+    return summary
+
+
+def write_json(path, value, **kwargs):
+    """
+    write then rename so readers never see a half written file
+    :param kwargs: passed to json.dump, i.e. indent
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="UTF8") as f:
+        json.dump(value, f, default=to_json, **kwargs)
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,266 @@
+"""Module providing a queryable SQLite store for historical SNR results """
+
+import os
+import csv
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import uuid
+import numpy as np
+from result_files import file_sha256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_seq     INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id      TEXT UNIQUE NOT NULL,
+    started_at  TEXT NOT NULL,
+    dataset     TEXT,
+    command     TEXT
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    run_seq     INTEGER NOT NULL,
+    pattern     TEXT NOT NULL,
+    file_path   TEXT NOT NULL,
+    sha256      TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS touch_results (
+    run_seq     INTEGER NOT NULL,
+    dataset     TEXT,
+    pattern     TEXT NOT NULL,
+    vendor      TEXT NOT NULL,
+    section     TEXT NOT NULL,
+    touch       INTEGER NOT NULL,
+    metric      TEXT NOT NULL,
+    value       REAL,
+    text        TEXT,
+    input_hash  TEXT
+);
+CREATE TABLE IF NOT EXISTS final_results (
+    run_seq     INTEGER NOT NULL,
+    dataset     TEXT,
+    pattern     TEXT NOT NULL,
+    vendor      TEXT NOT NULL,
+    section     TEXT NOT NULL,
+    metric      TEXT NOT NULL,
+    value       REAL,
+    text        TEXT,
+    input_hash  TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_touch_metric ON touch_results (metric, pattern, run_seq);
+CREATE INDEX IF NOT EXISTS idx_final_metric ON final_results (metric, pattern, run_seq);
+CREATE INDEX IF NOT EXISTS idx_inputs_run ON inputs (run_seq, pattern);
+"""
+
+# summary dict key -> (section name, per touch table key)
+SUMMARY_SECTIONS = {
+    "mct_summary": ("mct", "snr_summary"),
+    "sct_row_summary": ("sct_row", "snr_sct_row_summary"),
+    "sct_col_summary": ("sct_col", "snr_sct_col_summary"),
+}
+
+
+def combine_hashes(hashes):
+    """
+    Combine several file hashes into one order independent input hash.
+    :param hashes: iterable of hex digests
+    :return: hex digest string
+    """
+    sha = hashlib.sha256()
+    for digest in sorted(hashes):
+        sha.update(digest.encode())
+    return sha.hexdigest()
+
+
+def split_value(value):
+    """
+    Split a summary cell into (numeric value, text) columns.
+    Formatted numbers like "21.98" are stored as numbers, positions and labels as text.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return float(value), None
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value), None
+    if isinstance(value, str):
+        try:
+            return float(value), None
+        except ValueError:
+            return None, value
+    if isinstance(value, (tuple, list, np.ndarray)):
+        return None, str(tuple(int(v) for v in value))
+    return None, str(value)
+
+
+class ResultsStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        folder = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def begin_run(self, dataset=None, command=None, run_id=None):
+        """
+        Register a new run and return its sequence number, runs are ordered by this number.
+        :param dataset: dataset folder of the run
+        :param command: command line used for the run
+        :param run_id: optional external run id, a random one is generated otherwise
+        :return: (run_seq, run_id)
+        """
+        if run_id is None:
+            run_id = uuid.uuid4().hex
+        started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        cur = self.conn.execute("INSERT INTO runs (run_id, started_at, dataset, command) VALUES (?, ?, ?, ?)",
+                                (run_id, started_at, dataset, command))
+        self.conn.commit()
+        return cur.lastrowid, run_id
+
+    def add_inputs(self, run_seq, pattern, file_paths, digests=None):
+        """
+        Hash and record the capture files of one pattern.
+        :param digests: optional sha256 per file already known, i.e. from the result cache, the files are not read
+        :return: combined input hash of the pattern
+        """
+        hashes = []
+        rows = []
+        for idx, file_path in enumerate(file_paths):
+            digest = file_sha256(file_path) if digests is None else digests[idx]
+            hashes.append(digest)
+            rows.append((run_seq, pattern, os.path.abspath(file_path), digest))
+        self.conn.executemany("INSERT INTO inputs (run_seq, pattern, file_path, sha256) VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+        return combine_hashes(hashes)
+
+    def append_summary(self, run_seq, dataset, pattern, vendor, summary, input_hash=None):
+        """
+        Append one vendor summary (as returned by AnalyseData.*_snr_summary) to the store.
+        :param vendor: report vendor as selected by --report_vendor
+        :param summary: nested summary dict with per touch rows and final results
+        """
+        touch_rows = []
+        final_rows = []
+        for summary_key, (section, table_key) in SUMMARY_SECTIONS.items():
+            section_ret = summary.get(summary_key, None)
+            if section_ret is None:
+                continue
+            for metric, values in section_ret[table_key].items():
+                for touch_idx, value in enumerate(values):
+                    num, text = split_value(value)
+                    touch_rows.append((run_seq, dataset, pattern, vendor, section, touch_idx + 1,
+                                       metric, num, text, input_hash))
+            for metric, value in section_ret["final_results"].items():
+                num, text = split_value(value)
+                final_rows.append((run_seq, dataset, pattern, vendor, section, metric, num, text, input_hash))
+
+        self.conn.executemany("INSERT INTO touch_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", touch_rows)
+        self.conn.executemany("INSERT INTO final_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", final_rows)
+        self.conn.commit()
+
+    def query(self, sql, params=()):
+        """
+        Run any read query against the store.
+        :return: (column names, list of rows)
+        """
+        cur = self.conn.execute(sql, params)
+        columns = [desc[0] for desc in cur.description]
+        return columns, cur.fetchall()
+
+    def metric_trend(self, metric, last_runs=50, agg="min", vendor=None):
+        """
+        Aggregate a final result metric per pattern over the most recent runs, i.e.
+        min SmaxNppfullscreenR_dB per pattern over the last 50 runs.
+        :param metric: final result name (with or without the "min_" prefix)
+        :param last_runs: number of most recent runs to include
+        :param agg: sql aggregate, one of min, max, avg, count
+        :param vendor: optional vendor filter
+        :return: (column names, list of rows)
+        """
+        if agg.lower() not in ("min", "max", "avg", "count"):
+            raise ValueError(f"unsupported aggregate {agg}")
+        sql = (f"SELECT pattern, vendor, section, {agg}(value) AS {agg}_value, count(*) AS runs "
+               "FROM final_results "
+               "WHERE metric IN (?, ?) AND run_seq > (SELECT coalesce(max(run_seq), 0) - ? FROM runs)")
+        params = [metric, "min_" + metric, int(last_runs)]
+        if vendor is not None:
+            sql += " AND vendor = ?"
+            params.append(vendor)
+        sql += " GROUP BY pattern, vendor, section ORDER BY pattern"
+        return self.query(sql, params)
+
+
+def export_csv(out_path, columns, rows):
+    with open(out_path, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+class ResultsStoreOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="query historical SNR results and export them to csv")
+
+        self.parser.add_argument("--db",
+                                 type=str,
+                                 help="path to the results store",
+                                 required=True)
+
+        self.parser.add_argument("--sql",
+                                 type=str,
+                                 help="any sql query on tables runs, inputs, touch_results, final_results",
+                                 default=None)
+
+        self.parser.add_argument("--metric",
+                                 type=str,
+                                 help="final result metric to aggregate per pattern, i.e. SmaxNppfullscreenR_dB",
+                                 default=None)
+
+        self.parser.add_argument("--last_runs",
+                                 type=int,
+                                 help="number of most recent runs used with --metric",
+                                 default=50)
+
+        self.parser.add_argument("--agg",
+                                 type=str,
+                                 help="aggregate used with --metric",
+                                 default="min",
+                                 choices=["min", "max", "avg", "count"])
+
+        self.parser.add_argument("--vendor",
+                                 type=str,
+                                 help="vendor filter used with --metric",
+                                 default=None)
+
+        self.parser.add_argument("--csv",
+                                 type=str,
+                                 help="export query result into this csv file instead of printing",
+                                 default=None)
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        if self.options.sql is None and self.options.metric is None:
+            self.parser.error("one of --sql or --metric is required")
+        return self.options
+
+
+if __name__ == '__main__':
+    opts = ResultsStoreOptions().parse()
+    store = ResultsStore(opts.db)
+
+    if opts.sql is not None:
+        columns, rows = store.query(opts.sql)
+    else:
+        columns, rows = store.metric_trend(opts.metric, opts.last_runs, opts.agg, opts.vendor)
+
+    if opts.csv is not None:
+        export_csv(opts.csv, columns, rows)
+        print(f"write {len(rows)} rows into {opts.csv}")
+    else:
+        print(",".join(columns))
+        for row in rows:
+            print(",".join(str(val) for val in row))
+    store.close()
@@ -0,0 +1,171 @@
+"""Module providing shared memory / memory mapped backing of capture tensors for zero copy worker processes """
+
+import os
+import atexit
+import weakref
+import tempfile
+import shutil
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+from memory_budget import spill_array
+
+# picklable reference to one shared array, kind "shm" (name = shared memory block) or "memmap" (name = .npy path)
+SharedArray = namedtuple("SharedArray", ["kind", "name", "shape", "dtype"])
+
+
+def _attach_block(name):
+    """
+    Attach to a shared memory block without taking over its lifetime, the owner (SharedFrameStore) unlinks it.
+    Before python 3.13 attaching registers the block with the resource tracker, which unlinks it when the tracker
+    exits. Workers of a multiprocessing pool share the tracker of the owner, there the registration is harmless;
+    a separate process starts its own tracker, so the block is unregistered from it again.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    from multiprocessing import resource_tracker
+    shared_tracker = getattr(resource_tracker._resource_tracker, "_fd", None) is not None
+    shm = shared_memory.SharedMemory(name=name)
+    if not shared_tracker:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def attach_array(handle):
+    """
+    read only view of a shared array without copying
+    :return: (ndarray, owner object which must stay referenced while the array is used)
+    """
+    if handle.kind == "memmap":
+        array = np.load(handle.name, mmap_mode="r")
+        return array, None
+    shm = _attach_block(handle.name)
+    array = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+    array.flags.writeable = False
+    return array, shm
+
+
+class SharedFrameStore:
+    def __init__(self, backend="shm", folder=None):
+        """
+        Owner of the shared buffers of captures, the buffers live until close() (or interpreter exit). Captures
+        which moved their frames into the store (see adopt) get private copies back when the store is closed.
+        :param backend: "shm" for multiprocessing.shared_memory, "memmap" for memory mapped .npy files
+        :param folder: folder of the memmap files, a temporary folder is used if None
+        """
+        if backend not in ["shm", "memmap"]:
+            raise ValueError(f"unknown shared backend {backend}, choose from ['shm', 'memmap']")
+        self.backend = backend
+        self.blocks = []
+        self.views = []
+        self.owners = []
+        self.own_folder = folder is None
+        self.folder = None
+        if backend == "memmap":
+            self.folder = tempfile.mkdtemp(prefix="ets_shared_") if folder is None else folder
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+        self.closed = False
+        atexit.register(self._release_at_exit)
+
+    def share(self, array, name="array"):
+        """
+        copy an array into a shared buffer once
+        :return: (SharedArray handle, read only view on the shared buffer)
+        """
+        array = np.ascontiguousarray(array)
+        if self.backend == "memmap":
+            path = os.path.join(self.folder, f"{len(self.blocks):06d}_{name}.npy")
+            view = spill_array(array, path)
+            self.blocks.append(path)
+            self.views.append((name, weakref.ref(view)))
+            return SharedArray("memmap", path, array.shape, array.dtype.str), view
+
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        view.flags.writeable = False
+        self.blocks.append(shm)
+        self.views.append((name, weakref.ref(view)))
+        return SharedArray("shm", shm.name, array.shape, array.dtype.str), view
+
+    def adopt(self, owner):
+        """
+        register an object whose own arrays are views on this store, owner.unshare() is called on close()
+        """
+        if owner not in self.owners:
+            self.owners.append(owner)
+
+    def views_in_use(self):
+        """
+        :return: names of the shared arrays which are still referenced, slices of a view keep the view alive
+        """
+        return [name for name, view in self.views if view() is not None]
+
+    def close(self):
+        """
+        Restore private copies in the adopted owners, then release all shared buffers. Unmapping a buffer which
+        is still viewed would crash the process on the next access, so closing is refused while views handed
+        out by share() are referenced elsewhere.
+        """
+        if self.closed:
+            return
+        for owner in self.owners:
+            owner.unshare()
+        self.owners = []
+        in_use = self.views_in_use()
+        if in_use:
+            raise BufferError(f"shared arrays {in_use} are still referenced, drop them before closing the store")
+        self.closed = True
+        atexit.unregister(self._release_at_exit)
+        for block in self.blocks:
+            if isinstance(block, str):
+                continue
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        if self.folder is not None and self.own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+        self.blocks = []
+        self.views = []
+
+    def _release_at_exit(self):
+        """
+        remove the shared memory names and temporary files of a store which was never closed, the mappings
+        themselves go away with the process
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for block in self.blocks:
+            if isinstance(block, str):
+                continue
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        if self.folder is not None and self.own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def map_shared(func, handles, processes=None):
+    """
+    run func(handle) in worker processes, i.e. func attaches with AnalyseData.attach and computes summaries
+    :param func: picklable (module level) function
+    :param handles: list of handles from AnalyseData.share / ETS_Dataframe.share
+    :return: list of results in the order of handles
+    """
+    import multiprocessing
+
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        return pool.map(func, handles)
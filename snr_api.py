@@ -0,0 +1,67 @@
+"""Module providing the in memory snr analysis api: captures from arrays or buffers in, structured results out """
+
+import copy
+import numpy as np
+from ETS_Dataframe import ETS_Dataframe
+from ETS_Analysis import AnalyseData
+from metric_plan import VendorResult, ChannelResult, FinalResult, report_summary, result_to_json
+
+__all__ = ["capture", "analyse", "analyse_captures", "report_summary", "result_to_json",
+           "VendorResult", "ChannelResult", "FinalResult"]
+
+
+def capture(data, frames=None, channels=None):
+    """
+    build an ETS_Dataframe from data in memory
+    :param data: ETS_Dataframe (a shallow copy is returned, the preprocessing of an analysis replaces the frames
+                 of the copy and never touches the caller's capture; with frames or channels a new capture of views
+                 on its frames without its masks and cached statistics), csv content as bytes, an mct array
+                 [frames, rows, cols] or a dict with "mct", "sct_row" and / or "sct_col" arrays
+    :param frames: optional slice of frames to keep
+    :param channels: optional list of channels to keep
+    """
+    if isinstance(data, ETS_Dataframe) and (frames is not None or channels is not None):
+        Frame = ETS_Dataframe.from_arrays(mct=data.mct_grid, sct_row=data.sct_row, sct_col=data.sct_col,
+                                          frames=frames, channels=data.channels if channels is None else channels)
+        Frame.row_num, Frame.col_num = data.row_num, data.col_num
+        return Frame
+    if isinstance(data, ETS_Dataframe):
+        Frame = copy.copy(data)
+        Frame.masks = dict(data.masks)
+        Frame.drift = dict(data.drift)
+        Frame.compact_stats = dict(data.compact_stats)
+        # spill files and shared buffers stay owned by the caller's capture
+        Frame.spill_paths = []
+        Frame.shared_blocks = []
+        Frame.shared_views = {}
+        return Frame
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return ETS_Dataframe.from_csv_bytes(bytes(data), frames=frames, channels=channels)
+    if isinstance(data, dict):
+        return ETS_Dataframe.from_arrays(**data, frames=frames, channels=channels)
+    return ETS_Dataframe.from_arrays(mct=np.asarray(data), frames=frames, channels=channels)
+
+
+def analyse_captures(notouch, touches, frames=None, channels=None, detrend=None, outliers=None,
+                     pattern="in_memory", noise=None):
+    """
+    :param notouch: no touch capture, anything accepted by capture()
+    :param touches: list of touch captures
+    :param detrend: optional (method, param) drift removal, see detrend.parse_detrend
+    :param outliers: optional (z_threshold, frame_fraction) outlier rejection
+    :param noise: optional (lo, hi) percentile spread used as p2p noise term, see percentile_noise.parse_noise
+    :return: AnalyseData without output folder, nothing is written unless output_folder is set
+    """
+    return AnalyseData.from_frames(capture(notouch, frames, channels),
+                                   [capture(touch, frames, channels) for touch in touches],
+                                   pattern=pattern, detrend=detrend, outliers=outliers, noise=noise)
+
+
+def analyse(notouch, touches, vendors=("BOE",), frames=None, channels=None, detrend=None, outliers=None,
+            noise=None):
+    """
+    snr results of captures in memory without any file system access
+    :return: dict vendor -> VendorResult
+    """
+    analysis = analyse_captures(notouch, touches, frames, channels, detrend, outliers, noise=noise)
+    return analysis.snr_results(list(vendors))
@@ -0,0 +1,44 @@
+"""Module providing full panel snr maps from the touched nodes of all touch captures """
+
+import numpy as np
+
+
+def idw_interpolate(points, values, shape, power=2.0):
+    """
+    Inverse distance weighted interpolation of scattered node values onto the whole grid, computed as one
+    [nodes, points] distance matrix. Nodes which were touched keep their own value (mean of repeated touches).
+    :param points: [points, dims] node indices of the known values
+    :param values: [points] known values
+    :param shape: grid shape
+    :param power: distance power of the weights
+    :return: grid of interpolated values
+    """
+    points = np.asarray(points, dtype=float).reshape(len(values), -1)
+    values = np.asarray(values, dtype=float)
+    nodes = np.indices(shape).reshape(len(shape), -1).T.astype(float)
+    dist2 = ((nodes[:, None, :] - points[None, :, :]) ** 2).sum(axis=2)
+
+    exact = dist2 == 0
+    with np.errstate(divide="ignore"):
+        weights = np.where(exact, 0.0, dist2 ** (-power / 2))
+    ret = (weights * values).sum(axis=1) / weights.sum(axis=1)
+
+    touched = exact.any(axis=1)
+    ret[touched] = (exact[touched] * values).sum(axis=1) / exact[touched].sum(axis=1)
+    return ret.reshape(shape)
+
+
+def snr_db(signal, noise):
+    """
+    20 * log10(signal / noise) per node, nodes without noise give inf
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 20 * np.log10(np.asarray(signal, dtype=float) / noise)
+
+
+def min_over_panel(grid):
+    """
+    :return: (min value, node of min value)
+    """
+    node = np.unravel_index(np.nanargmin(grid), grid.shape)
+    return grid[node], tuple(int(idx) for idx in node)
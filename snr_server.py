@@ -0,0 +1,344 @@
+"""Module providing a long running local snr analysis server with a content hash keyed capture cache """
+
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from ETS_Dataframe import ETS_Dataframe, parse_frame_slice, parse_channels
+from ETS_Analysis import AnalyseData
+from metric_plan import VENDOR_REPORTS, result_to_json
+
+
+class CaptureCache:
+    def __init__(self, max_bytes):
+        """
+        LRU cache of decoded captures with their per node statistics, bounded by the memory of the entries
+        :param max_bytes: max memory of all cached captures
+        """
+        self.max_bytes = max_bytes
+        # key -> (capture, size counted when it was added)
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        """
+        cached capture of key, loader() decodes it on a miss, concurrent misses of one key decode it once
+        """
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key][0]
+                event = self.loading.get(key, None)
+                if event is None:
+                    self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            event.wait()
+
+        try:
+            Frame = loader()
+            Frame.cache_stats()
+            self.put(key, Frame)
+            return Frame
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def put(self, key, Frame):
+        size = Frame.nbytes
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (Frame, size)
+            self.bytes += size
+            # the entry just added stays even when it alone exceeds the budget
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                # subtract the size that was added, the statistics of an entry may have grown since
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class ServerMetrics:
+    def __init__(self, window=1000):
+        """
+        :param window: number of recent requests kept for latency percentiles
+        """
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+
+    def record(self, seconds, ok=True):
+        with self.lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.latencies.append(seconds)
+            self.finished.append(time.time())
+
+    def report(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            now = time.time()
+            recent = sum(1 for stamp in self.finished if now - stamp <= 60.0)
+            ret = {"uptime_s": now - self.started, "requests": self.requests, "errors": self.errors,
+                   "throughput_rps": self.requests / max(now - self.started, 1e-9),
+                   "throughput_last_60s_rps": recent / 60.0}
+        if len(latencies) > 0:
+            for name, q in [("p50", 50), ("p95", 95), ("p99", 99)]:
+                ret[f"latency_{name}_ms"] = float(np.percentile(latencies, q)) * 1000
+            ret["latency_max_ms"] = float(latencies.max()) * 1000
+        return ret
+
+
+class SNRService:
+    def __init__(self, cache_bytes=1024 ** 3, max_concurrent=4, max_request_bytes=256 * 1024 ** 2):
+        """
+        :param cache_bytes: memory budget of the capture cache
+        :param max_concurrent: analyses running at the same time, bounds the working memory
+        :param max_request_bytes: largest accepted request body, inline captures included
+        """
+        self.cache = CaptureCache(cache_bytes)
+        self.max_request_bytes = max_request_bytes
+        self.metrics = ServerMetrics()
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.path_hashes = {}
+        self.path_lock = threading.Lock()
+
+    def content_hash(self, spec):
+        """
+        :param spec: {"path": capture path} or {"data": base64 csv content}
+        :return: (hex digest, bytes or None when the content was not read)
+        """
+        if "data" in spec:
+            raw_bytes = base64.b64decode(spec["data"])
+            return hashlib.sha256(raw_bytes).hexdigest(), raw_bytes
+
+        stat = os.stat(spec["path"])
+        key = (os.path.abspath(spec["path"]), stat.st_size, stat.st_mtime_ns)
+        with self.path_lock:
+            digest = self.path_hashes.get(key, None)
+        if digest is not None:
+            return digest, None
+        with open(spec["path"], "rb") as f:
+            raw_bytes = f.read()
+        digest = hashlib.sha256(raw_bytes).hexdigest()
+        with self.path_lock:
+            self.path_hashes[key] = digest
+        return digest, raw_bytes
+
+    def capture(self, spec, frame_window, channels):
+        """
+        decoded capture from the cache
+        :param frame_window: frame window text, i.e. "0:300" or None
+        """
+        if not isinstance(spec, dict) or ("path" not in spec and "data" not in spec):
+            raise ValueError(f"a capture is {{\"path\": ...}} or {{\"data\": base64 csv}}, got {spec!r:.100}")
+        digest, raw_bytes = self.content_hash(spec)
+        frames = parse_frame_slice(frame_window)
+
+        def loader():
+            content = raw_bytes
+            if content is None:
+                with open(spec["path"], "rb") as f:
+                    content = f.read()
+            return ETS_Dataframe.from_csv_bytes(content, frames=frames, channels=channels)
+
+        key = (digest, frame_window, tuple(channels) if channels is not None else None)
+        return self.cache.get(key, loader)
+
+    def analyse(self, request):
+        """
+        :param request: {"notouch": spec, "touches": [spec, ...], "vendors": ["BOE"], "frames": "a:b",
+                         "channels": "mct,sct_row"}, a spec is {"path": ...} or {"data": base64 csv}
+        :return: dict vendor -> result json
+        """
+        with self.slots:
+            return self._analyse(request)
+
+    def analyse_body(self, read_body):
+        """
+        analyse a json request whose body is only read once a slot is free, so that request bodies, their base64
+        decoding and hashing are bounded by max_concurrent as well
+        :param read_body: callable returning the raw request body
+        """
+        with self.slots:
+            return self._analyse(json.loads(read_body()))
+
+    def _analyse(self, request):
+        """
+        see analyse, the caller holds a slot
+        """
+        if not isinstance(request, dict):
+            raise ValueError(f"request must be a json object, got {type(request).__name__}")
+        if not isinstance(request.get("touches", None), list):
+            raise ValueError("request needs a list of touch captures in \"touches\"")
+        vendors = request.get("vendors", ["BOE"])
+        for vendor in vendors:
+            if vendor not in VENDOR_REPORTS:
+                raise ValueError(f"unknown report vendor {vendor}, choose from {list(VENDOR_REPORTS)}")
+        frame_window = request.get("frames", None)
+        # reject an invalid window before anything is decoded
+        parse_frame_slice(frame_window)
+        channels = parse_channels(request.get("channels", None))
+
+        NoTouchFrame = self.capture(request["notouch"], frame_window, channels)
+        TouchFrames = [self.capture(spec, frame_window, channels) for spec in request["touches"]]
+        analysis = AnalyseData.from_frames(NoTouchFrame, TouchFrames, pattern=request.get("pattern", "request"))
+        results = analysis.snr_results(vendors)
+        return {vendor: result_to_json(result) for vendor, result in results.items()}
+
+
+class SNRRequestHandler(BaseHTTPRequestHandler):
+    # set by make_server()
+    service: SNRService = None
+    quiet = False
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload, default=_json_default).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, {"server": self.service.metrics.report(), "cache": self.service.cache.stats()})
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/analyse":
+            self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+            return
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # the end of the body is unknown, the connection can not be reused
+            self.close_connection = True
+            self.service.metrics.record(time.perf_counter() - start, False)
+            self.send_json(400, {"error": f"invalid Content-Length {self.headers.get('Content-Length')}"})
+            return
+        if length > self.service.max_request_bytes:
+            # discarded in blocks so the client gets the answer instead of a broken pipe
+            for offset in range(0, length, 1 << 20):
+                self.rfile.read(min(1 << 20, length - offset))
+            self.service.metrics.record(time.perf_counter() - start, False)
+            self.send_json(413, {"error": f"request of {length} bytes exceeds the limit of "
+                                          f"{self.service.max_request_bytes} bytes"})
+            return
+        try:
+            payload = self.service.analyse_body(lambda: self.rfile.read(length))
+            code = 200
+        except (ValueError, KeyError, TypeError, OSError) as err:
+            payload, code = {"error": f"{type(err).__name__}: {err}"}, 400
+        except Exception as err:
+            # any other failure still answers the client and is counted as an error
+            payload, code = {"error": f"{type(err).__name__}: {err}"}, 500
+        self.service.metrics.record(time.perf_counter() - start, code == 200)
+        self.send_json(code, payload)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not json serializable")
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def make_server(service, host="127.0.0.1", port=8765, unix_socket=None, quiet=False):
+    """
+    :return: http server bound to localhost or to a unix socket, call serve_forever() on it
+    """
+    handler = type("Handler", (SNRRequestHandler,), {"service": service, "quiet": quiet})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class SNRServerOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="local snr analysis server, POST /analyse, GET /metrics")
+
+        self.parser.add_argument("--host", type=str, help="bind address, keep it local", default="127.0.0.1")
+
+        self.parser.add_argument("--port", type=int, help="tcp port", default=8765)
+
+        self.parser.add_argument("--unix_socket", type=str, help="serve on this unix socket instead of tcp",
+                                 default=None)
+
+        self.parser.add_argument("--cache_mb", type=int, help="memory budget of the capture cache in MB",
+                                 default=1024)
+
+        self.parser.add_argument("--max_concurrent", type=int, help="analyses running at the same time", default=4)
+
+        self.parser.add_argument("--max_request_mb", type=float,
+                                 help="largest accepted request in MB, larger requests are answered with 413",
+                                 default=256)
+
+        self.parser.add_argument("--quiet", help="do not log every request", action="store_true")
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        return self.options
+
+
+if __name__ == '__main__':
+    opts = SNRServerOptions().parse()
+    service = SNRService(opts.cache_mb * 1024 ** 2, opts.max_concurrent, int(opts.max_request_mb * 1024 ** 2))
+    server = make_server(service, opts.host, opts.port, opts.unix_socket, opts.quiet)
+    print(f"serve snr analysis on {opts.unix_socket or f'http://{opts.host}:{opts.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if opts.unix_socket is not None and os.path.exists(opts.unix_socket):
+            os.remove(opts.unix_socket)
+    sys.exit(0)
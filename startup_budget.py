@@ -0,0 +1,81 @@
+"""Module providing the import time budget check of the command line entry points """
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# entry point modules -> max import time in seconds, measured in a fresh interpreter
+IMPORT_BUDGETS = {
+    "ETS_Analysis": 0.3,
+    "ETS_Dataframe": 0.25,
+    "html_report": 0.25,
+    "dataset_compare": 0.25,
+    "results_store": 0.25,
+}
+
+# modules which must not be loaded before a plot or a pandas backed writer is used
+DEFERRED_MODULES = ["pandas", "seaborn", "matplotlib"]
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [name for name in {deferred!r} if name in sys.modules]}}))
+"""
+
+
+def measure_import(module, repeat=5):
+    """
+    import a module in fresh interpreters
+    :return: (best import time in seconds, deferred modules it loaded)
+    """
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", _PROBE.format(module=module, deferred=DEFERRED_MODULES)],
+                             cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                             check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        best = result["seconds"] if best is None else min(best, result["seconds"])
+        loaded = result["loaded"]
+    return best, loaded
+
+
+def check_import_budgets(budgets=None, repeat=5, scale=1.0):
+    """
+    :param budgets: dict module -> seconds, IMPORT_BUDGETS if None
+    :param scale: multiplier of all budgets, i.e. for slow build machines
+    :return: list of (module, seconds, budget, deferred modules loaded, passed)
+    """
+    budgets = IMPORT_BUDGETS if budgets is None else budgets
+    ret = []
+    for module, budget in budgets.items():
+        seconds, loaded = measure_import(module, repeat)
+        ret.append((module, seconds, budget * scale, loaded, seconds <= budget * scale and len(loaded) == 0))
+    return ret
+
+
+class StartupBudgetOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="check the import time budget of the entry points")
+
+        self.parser.add_argument("--repeat", type=int, help="fresh interpreters per module, best time counts",
+                                 default=5)
+
+        self.parser.add_argument("--scale", type=float, help="multiplier of all budgets", default=1.0)
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        return self.options
+
+
+if __name__ == '__main__':
+    opts = StartupBudgetOptions().parse()
+    results = check_import_budgets(repeat=opts.repeat, scale=opts.scale)
+    for module, seconds, budget, loaded, passed in results:
+        extra = f", loads {', '.join(loaded)}" if len(loaded) > 0 else ""
+        print(f"{'ok  ' if passed else 'FAIL'} {module}: {seconds * 1000:.0f} ms of {budget * 1000:.0f} ms{extra}")
+    sys.exit(0 if all(result[-1] for result in results) else 1)
@@ -0,0 +1,365 @@
+"""Module providing a synthetic capture generator for load and scale testing, streamed to csv or capture archives """
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from collections import namedtuple
+import numpy as np
+from capture_archive import ARCHIVE_EXT, DEFAULT_CHUNK_FRAMES, write_archive
+
+# frames generated per block, every block draws from its own seeded generator and the colored noise continues from
+# the state at the end of the previous block, blocks() always starts from the first block so a capture only depends
+# on its seed
+GEN_BLOCK_FRAMES = 256
+
+# cumulative sums of colored noise are rescaled before the scaling factor exceeds this, keeps float32 exact enough
+_COLORED_MAX_GAIN = 1e3
+
+# csv text of every int16 value, filled on first use
+_CSV_TABLE = None
+
+# panel and noise model of synthetic captures, amplitudes in raw delta counts
+SynthSpec = namedtuple("SynthSpec", [
+    "rows", "cols",
+    # frame rate of the captures in Hz
+    "report_hz",
+    # per node noise spectrum: white part, first order low pass part (pole in [0, 1)), border nodes are edge_gain
+    # times noisier, every node gets a random node_spread variation of its sigma
+    "white_sigma", "colored_sigma", "colored_pole", "edge_gain", "node_spread",
+    # display coupled noise: refresh rate, amplitude of the fundamental, number of harmonics (amplitude 1/h),
+    # the phase advances over the rows like the display scan
+    "display_hz", "display_amp", "display_harmonics",
+    # common mode noise of a whole frame and of every row
+    "common_mode_sigma", "row_common_mode_sigma",
+    # slow baseline drift: per node rate in counts per 1000 frames and a settling offset with its time constant
+    "drift_rate", "drift_settle", "drift_tau_frames",
+    # glitch frames (a part of the nodes jumps) and single sample spikes
+    "glitch_frame_prob", "glitch_amp", "spike_prob", "spike_amp",
+    # gaussian touch blob: peak delta, sigma in nodes, relative frame to frame jitter, self cap peak delta
+    "touch_amp", "touch_sigma", "touch_jitter", "sct_touch_amp",
+], defaults=[
+    120.0,
+    5.0, 3.0, 0.95, 1.5, 0.2,
+    60.0, 4.0, 2,
+    3.0, 1.5,
+    2.0, 8.0, 2000.0,
+    0.001, 60.0, 1e-5, 150.0,
+    450.0, 0.6, 0.02, 320.0,
+])
+
+
+def csv_header(rows, cols):
+    """
+    column names of the .edl.csv layout parsed by ETS_Dataframe
+    """
+    return ["Frame"] + [f"mct_deltas.values[{row}][{col}]" for row in range(rows) for col in range(cols)] \
+        + [f"sct_row_deltas[{col}]" for col in range(cols)] + [f"sct_col_deltas[{row}]" for row in range(rows)]
+
+
+def _csv_table():
+    """
+    [65536, 7] bytes, the text "value," of every int16 value right aligned with space padding
+    """
+    global _CSV_TABLE
+    if _CSV_TABLE is None:
+        text = "".join(f"{value},".rjust(7) for value in range(-32768, 32768))
+        _CSV_TABLE = np.frombuffer(text.encode(), dtype=np.uint8).reshape(65536, 7)
+    return _CSV_TABLE
+
+
+def format_csv_block(values, first_frame):
+    """
+    Encode int16 frames as csv lines "frame,v0,v1,...,vn,\\n" without formatting every value in python: the fixed
+    width text of all values is gathered from a lookup table and the padding is removed in one pass.
+    :param values: [frames, columns] int16 array
+    :return: bytes
+    """
+    values = np.asarray(values)
+    if values.dtype != np.int16:
+        raise ValueError(f"csv blocks are encoded from int16 samples, got {values.dtype}")
+    text = _csv_table()[values.astype(np.int32) + 32768].reshape(len(values), -1)
+    width = len(str(first_frame + len(values))) + 1
+    index = "".join(f"{frame},".rjust(width) for frame in range(first_frame, first_frame + len(values)))
+    index = np.frombuffer(index.encode(), dtype=np.uint8).reshape(len(values), width)
+    newline = np.full((len(values), 1), ord("\n"), dtype=np.uint8)
+    return np.concatenate([index, text, newline], axis=1).tobytes().translate(None, b" ")
+
+
+class SyntheticCapture:
+    def __init__(self, spec, frame_num, seed=0, capture_id=0, touch=None):
+        """
+        one synthetic capture, generated block by block
+        :param spec: SynthSpec
+        :param frame_num: number of frames
+        :param seed: dataset seed
+        :param capture_id: id of the capture within the dataset, captures of one seed differ by their id
+        :param touch: touch center (row, col) in nodes (float), None for a no touch capture
+        """
+        self.spec = spec
+        self.frame_num = frame_num
+        self.seed = seed
+        self.capture_id = capture_id
+        self.touch = touch
+
+        rng = np.random.default_rng([seed, capture_id])
+        rows, cols = spec.rows, spec.cols
+        self.node_num = rows * cols + cols + rows
+        row_idx = np.concatenate([np.repeat(np.arange(rows), cols), np.full(cols, rows / 2), np.arange(rows)])
+        col_idx = np.concatenate([np.tile(np.arange(cols), rows), np.arange(cols), np.full(rows, cols / 2)])
+        edge = (row_idx <= 0) | (row_idx >= rows - 1) | (col_idx <= 0) | (col_idx >= cols - 1)
+        spread = 1 + spec.node_spread * rng.standard_normal(self.node_num)
+        gain = np.where(edge, spec.edge_gain, 1.0) * np.clip(spread, 0.2, None)
+        self.white_sigma = spec.white_sigma * gain
+        self.colored_sigma = spec.colored_sigma * gain
+        self.row_of_node = np.clip(row_idx, 0, rows - 1).astype(int)
+        self.display_phase = 2 * np.pi * row_idx / max(rows, 1) + rng.uniform(0, 2 * np.pi)
+        self.display_gain = 1 + 0.5 * np.cos(np.pi * row_idx / max(rows, 1))
+        self.drift_rate = spec.drift_rate * rng.standard_normal(self.node_num) / 1000.0
+        self.touch_profile = self.build_touch_profile(row_idx, col_idx)
+
+    def build_touch_profile(self, row_idx, col_idx):
+        """
+        touch delta of every node: a gaussian blob on the mutual grid, its row / column profile on self cap
+        """
+        if self.touch is None:
+            return None
+        spec = self.spec
+        rows, cols = spec.rows, spec.cols
+        touch_row, touch_col = self.touch
+        dist2 = (row_idx - touch_row) ** 2 + (col_idx - touch_col) ** 2
+        profile = spec.touch_amp * np.exp(-dist2 / (2 * spec.touch_sigma ** 2))
+        mutual = rows * cols
+        profile[mutual:mutual + cols] = spec.sct_touch_amp * np.exp(
+            -(np.arange(cols) - touch_col) ** 2 / (2 * spec.touch_sigma ** 2))
+        profile[mutual + cols:] = spec.sct_touch_amp * np.exp(
+            -(np.arange(rows) - touch_row) ** 2 / (2 * spec.touch_sigma ** 2))
+        return profile
+
+    def colored_noise(self, rng, frame_num, state):
+        """
+        first order low pass noise x[t] = pole * x[t - 1] + e[t], computed with cumulative sums over sub blocks
+        instead of a loop over frames
+        :param state: x of the frame before the block, zeros for the first block
+        :return: ([frames, nodes] noise, x of the last frame)
+        """
+        spec = self.spec
+        pole = min(max(spec.colored_pole, 0.0), 0.9999)
+        drive = rng.standard_normal((frame_num, self.node_num), dtype=np.float32) * \
+            (self.colored_sigma * np.sqrt(1 - pole ** 2)).astype(np.float32)
+        if pole == 0:
+            return drive, state
+        ret = np.empty_like(drive)
+        step = frame_num if pole ** frame_num > 1 / _COLORED_MAX_GAIN else \
+            max(1, int(np.log(_COLORED_MAX_GAIN) / -np.log(pole)))
+        for start in range(0, frame_num, step):
+            powers = (pole ** np.arange(1, min(step, frame_num - start) + 1)).astype(np.float32)
+            block = drive[start:start + len(powers)]
+            ret[start:start + len(powers)] = powers[:, None] * (
+                np.cumsum(block / powers[:, None], axis=0) + state)
+            state = ret[start + len(powers) - 1]
+        return ret, state
+
+    def block(self, block_idx, colored_state=None):
+        """
+        :param colored_state: colored noise state returned for the previous block, zeros if None
+        :return: ([frames, nodes] float32 samples of one block, colored noise state for the next block), nodes in
+                 csv column order: mct (row major), sct_row_deltas (one per column), sct_col_deltas (one per row)
+        """
+        spec = self.spec
+        start = block_idx * GEN_BLOCK_FRAMES
+        frame_num = min(GEN_BLOCK_FRAMES, self.frame_num - start)
+        rng = np.random.default_rng([self.seed, self.capture_id, block_idx + 1])
+        frames = np.arange(start, start + frame_num, dtype=float)
+
+        data = rng.standard_normal((frame_num, self.node_num), dtype=np.float32) * self.white_sigma.astype(np.float32)
+        colored, colored_state = self.colored_noise(
+            rng, frame_num, np.zeros(self.node_num) if colored_state is None else colored_state)
+        data += colored
+
+        # display coupled periodic noise, sin(wt + phase) = sin(wt) cos(phase) + cos(wt) sin(phase) as two outer
+        # products instead of a sin of every sample
+        t = frames / spec.report_hz
+        for harmonic in range(1, spec.display_harmonics + 1):
+            amp = (spec.display_amp / harmonic) * self.display_gain
+            wt = 2 * np.pi * harmonic * spec.display_hz * t
+            data += np.outer(np.sin(wt), amp * np.cos(harmonic * self.display_phase)).astype(np.float32)
+            data += np.outer(np.cos(wt), amp * np.sin(harmonic * self.display_phase)).astype(np.float32)
+
+        # common mode of the frame and of every row
+        data += spec.common_mode_sigma * rng.standard_normal((frame_num, 1))
+        row_common_mode = spec.row_common_mode_sigma * rng.standard_normal((frame_num, spec.rows), dtype=np.float32)
+        mutual = spec.rows * spec.cols
+        data[:, :mutual].reshape(frame_num, spec.rows, spec.cols)[...] += row_common_mode[:, :, None]
+        data[:, mutual:] += row_common_mode[:, self.row_of_node[mutual:]]
+
+        # drift
+        data += np.outer(frames, self.drift_rate).astype(np.float32)
+        data += (spec.drift_settle * (1 - np.exp(-frames / spec.drift_tau_frames))).astype(np.float32)[:, None]
+
+        # glitch frames and spikes
+        glitch = np.flatnonzero(rng.random(frame_num) < spec.glitch_frame_prob)
+        for frame in glitch:
+            nodes = rng.random(self.node_num) < 0.2
+            data[frame, nodes] += spec.glitch_amp * rng.standard_normal(nodes.sum())
+        spike_num = rng.binomial(data.size, spec.spike_prob)
+        if spike_num > 0:
+            data.reshape(-1)[rng.integers(0, data.size, spike_num)] += spec.spike_amp * rng.choice([-1, 1], spike_num)
+
+        if self.touch_profile is not None:
+            jitter = 1 + spec.touch_jitter * rng.standard_normal((frame_num, 1), dtype=np.float32)
+            touched = np.flatnonzero(self.touch_profile > 1e-3)
+            data[:, touched] += jitter * self.touch_profile[touched].astype(np.float32)
+        return data, colored_state
+
+    def blocks(self):
+        """
+        generate the capture block by block from the first frame, every call yields the same blocks
+        :return: iterator of dict channel -> int16 block in the ETS_Dataframe layout, {"mct": [frames, rows, cols],
+                 "sct_row": [frames, rows], "sct_col": [frames, cols]}
+        """
+        rows, cols = self.spec.rows, self.spec.cols
+        mutual = rows * cols
+        colored_state = None
+        for block_idx in range((self.frame_num + GEN_BLOCK_FRAMES - 1) // GEN_BLOCK_FRAMES):
+            data, colored_state = self.block(block_idx, colored_state)
+            data = np.clip(np.round(data), -32768, 32767).astype(np.int16)
+            # ETS_Dataframe.sct_row holds the sct_col_deltas columns (one per row) and sct_col the sct_row_deltas
+            yield {"mct": data[:, :mutual].reshape(-1, rows, cols), "sct_row": data[:, mutual + cols:],
+                   "sct_col": data[:, mutual:mutual + cols]}
+
+    def write_csv(self, path):
+        """
+        stream the capture into an .edl.csv file
+        :return: number of bytes written
+        """
+        size = 0
+        first_frame = 0
+        with open(path, "wb") as f:
+            size += f.write((",".join(csv_header(self.spec.rows, self.spec.cols)) + ",\n").encode())
+            for block in self.blocks():
+                values = np.concatenate([block["mct"].reshape(len(block["mct"]), -1), block["sct_col"],
+                                         block["sct_row"]], axis=1)
+                size += f.write(format_csv_block(values, first_frame))
+                first_frame += len(values)
+        return size
+
+    def write_archive(self, path, chunk_frames=DEFAULT_CHUNK_FRAMES, codec="auto", level=None):
+        """
+        stream the capture into memory mapped channel files next to path, then pack them into a capture archive
+        :return: number of bytes written
+        """
+        rows, cols = self.spec.rows, self.spec.cols
+        shapes = {"mct": (rows, cols), "sct_row": (rows,), "sct_col": (cols,)}
+        folder = tempfile.mkdtemp(prefix="ets_synth_", dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            channels = {channel: np.lib.format.open_memmap(os.path.join(folder, channel + ".npy"), mode="w+",
+                                                           dtype=np.int16, shape=(self.frame_num,) + shape)
+                        for channel, shape in shapes.items()}
+            start = 0
+            for block in self.blocks():
+                for channel, data in block.items():
+                    channels[channel][start:start + len(data)] = data
+                start += len(block["mct"])
+            write_archive(path, channels, chunk_frames, codec, level,
+                          meta={"row_num": rows, "col_num": cols, "source": "synthetic",
+                                "seed": self.seed, "capture_id": self.capture_id})
+            del channels
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        return os.path.getsize(path)
+
+    def write(self, path, fmt="csv", **kwargs):
+        return self.write_csv(path) if fmt == "csv" else self.write_archive(path, **kwargs)
+
+
+def touch_positions(spec, touch_num, rng):
+    """
+    touch centers spread over the panel: a jittered grid of about touch_num cells, one touch per cell
+    """
+    grid_rows = max(1, int(round(np.sqrt(touch_num * spec.rows / spec.cols))))
+    grid_cols = max(1, int(np.ceil(touch_num / grid_rows)))
+    cells = [(row, col) for row in range(grid_rows) for col in range(grid_cols)][:touch_num]
+    ret = []
+    for row, col in cells:
+        ret.append((min(spec.rows - 1.0, (row + rng.uniform(0.2, 0.8)) * spec.rows / grid_rows),
+                    min(spec.cols - 1.0, (col + rng.uniform(0.2, 0.8)) * spec.cols / grid_cols)))
+    return ret
+
+
+def generate_dataset(folder, patterns, touch_num, frame_num, spec, fmt="csv", seed=0, prefix_notouch="wo",
+                     prefix_touch="w", **kwargs):
+    """
+    synthesise pattern folders with a no touch and touch_num touch captures each, deterministic under seed
+    :param fmt: "csv" (.edl.csv) or "etsz" (capture archive)
+    :return: (list of written paths, bytes written)
+    """
+    ext = ".edl.csv" if fmt == "csv" else ".edl." + ARCHIVE_EXT
+    paths = []
+    size = 0
+    for pattern_idx, pattern in enumerate(patterns):
+        pattern_folder = os.path.join(folder, pattern)
+        if not os.path.exists(pattern_folder):
+            os.makedirs(pattern_folder)
+        positions = touch_positions(spec, touch_num, np.random.default_rng([seed, pattern_idx]))
+        captures = [(prefix_notouch, None)] + [(f"{prefix_touch}{idx + 1}", pos) for idx, pos in enumerate(positions)]
+        for capture_idx, (name, touch) in enumerate(captures):
+            path = os.path.join(pattern_folder, name + ext)
+            capture = SyntheticCapture(spec, frame_num, seed, pattern_idx * 100000 + capture_idx, touch)
+            size += capture.write(path, fmt, **kwargs)
+            paths.append(path)
+    return paths, size
+
+
+class SyntheticCaptureOptions:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(description="generate synthetic no touch and touch captures")
+
+        self.parser.add_argument("--output", type=str, help="dataset folder", required=True)
+
+        self.parser.add_argument("--pattern_folder", nargs='+', help="pattern folders to generate",
+                                 default=["White"])
+
+        self.parser.add_argument("--rows", type=int, help="rows of the panel", default=16)
+
+        self.parser.add_argument("--cols", type=int, help="columns of the panel", default=28)
+
+        self.parser.add_argument("--frames", type=int, help="frames per capture", default=300)
+
+        self.parser.add_argument("--touches", type=int, help="touch captures per pattern", default=5)
+
+        self.parser.add_argument("--seed", type=int, help="seed, the same seed gives the same captures", default=0)
+
+        self.parser.add_argument("--format", type=str, help="csv (.edl.csv) or etsz (capture archive)",
+                                 choices=["csv", ARCHIVE_EXT], default="csv")
+
+        self.parser.add_argument("--codec", type=str, help="codec of etsz archives", default="auto")
+
+        for name in ["report_hz", "white_sigma", "colored_sigma", "colored_pole", "display_hz", "display_amp",
+                     "common_mode_sigma", "row_common_mode_sigma", "drift_rate", "glitch_frame_prob", "spike_prob",
+                     "touch_amp", "touch_sigma"]:
+            self.parser.add_argument(f"--{name}", type=float, help=f"noise model, see SynthSpec ({name})",
+                                     default=SynthSpec._field_defaults[name])
+
+    def parse(self):
+        self.options = self.parser.parse_args()
+        return self.options
+
+
+if __name__ == '__main__':
+    opts = SyntheticCaptureOptions().parse()
+    synth_spec = SynthSpec(opts.rows, opts.cols, **{name: getattr(opts, name) for name in SynthSpec._fields
+                                                    if name not in ["rows", "cols"] and hasattr(opts, name)})
+    archive_args = {"codec": opts.codec} if opts.format == ARCHIVE_EXT else {}
+    start = time.perf_counter()
+    written, written_bytes = generate_dataset(opts.output, opts.pattern_folder, opts.touches, opts.frames,
+                                              synth_spec, opts.format, opts.seed, **archive_args)
+    elapsed = time.perf_counter() - start
+    for written_path in written:
+        print("Successfully generate {}!!!!!".format(written_path))
+    print(f"{len(written)} captures, {written_bytes / 1024 ** 2:.1f} MB in {elapsed:.2f} s "
+          f"({written_bytes / 1024 ** 2 / max(elapsed, 1e-9):.1f} MB/s, "
+          f"{len(written) * opts.frames / max(elapsed, 1e-9):.0f} frames/s)")
+    sys.exit(0)